@@ -1,8 +1,20 @@
+import sys
 import pytest
+import asyncio
+import orjson
+import backend_logic
+import db_routing
 
 from colorama import Fore, Style
 from dateutil.parser import isoparse
-from backend_logic import get_db_session, get_kpis, get_customer_segments, get_monthly_revenue, get_top_customers, get_product_category_performance, get_customer_satisfaction, get_churn_risk, get_rfm_segmentation
+from db_routing import DatabasePool, create_router
+from admission import AdmissionController, Overloaded
+from shared_cache import create_shared_cache
+from lookalike import LOOKALIKE_FEATURES, LookalikeIndex
+from db_routing import write_session
+from sqlalchemy.sql import text
+from datetime import date
+from backend_logic import profile_cache, ingest_events, get_customer_profiles, get_cohort_retention, get_product_affinity, get_lookalikes, get_snapshot_manifest, get_snapshot_file, get_approx_kpis, get_scopes, get_db_session, get_kpis, get_customer_segments, get_monthly_revenue, get_top_customers, get_product_category_performance, get_customer_satisfaction, get_churn_risk, get_rfm_segmentation
 
 def is_valid_datetime(date_string):
     try:
@@ -50,7 +62,7 @@ async def test_customer_segments():
     result = None
      ## Test the API Response
     try:
-        result = await get_customer_segments()
+        result = orjson.loads(await get_customer_segments())
         print(f"{Fore.GREEN}{Style.BRIGHT}[+] get_customer_segments() endpoint is responding...{Style.RESET_ALL}")
     except Exception as e:
         print(f"{Fore.RED}{Style.BRIGHT}[-] Unable to get response from API: {e}{Style.RESET_ALL}")
@@ -75,7 +87,7 @@ async def test_customer_segments():
 async def test_monthly_revenue():
     result = None
     try:
-        result = await get_monthly_revenue()
+        result = orjson.loads(await get_monthly_revenue())
         print(f"{Fore.GREEN}{Style.BRIGHT}[+] get_monthly_revenue() endpoint is responding...{Style.RESET_ALL}")
     except Exception as e:
         print(f"{Fore.RED}{Style.BRIGHT}[-] Unable to get response from API: {e}{Style.RESET_ALL}")
@@ -117,7 +129,7 @@ async def test_product_category_performance():
     result = None
     ## Test the responsiveness of the endpoint
     try:
-        result = await get_product_category_performance()
+        result = orjson.loads(await get_product_category_performance())
         print(f"{Fore.GREEN}{Style.BRIGHT}[+] get_product_category_performance() endpoint is responding properly.{Style.RESET_ALL}")
     except Exception as e:
         print(f"{Fore.RED}{Style.BRIGHT}[-] get_product_category_performance() endpoint not responding...{Style.RESET_ALL}")
@@ -140,7 +152,7 @@ async def test_average_customer_satisfaction():
     result = None
     ## Test the responsiveness of the endpoint
     try:
-        result = await get_customer_satisfaction()
+        result = orjson.loads(await get_customer_satisfaction())
         print(f"{Fore.GREEN}{Style.BRIGHT}[+] get_customer_satisfaction() endpoint is responding properly.{Style.RESET_ALL}")
     except Exception as e:
         print(f"{Fore.RED}{Style.BRIGHT}[-] get_customer_satisfaction() endpoint not responding...{Style.RESET_ALL}")
@@ -159,7 +171,7 @@ async def test_get_churn_risk():
     result = None
     ## Test the responsiveness of the endpoint
     try:
-        result = await get_churn_risk()
+        result = orjson.loads(await get_churn_risk())
         print(f"{Fore.GREEN}{Style.BRIGHT}[+] get_churn_risk() endpoint is responding properly.{Style.RESET_ALL}")
     except Exception as e:
         print(f"{Fore.RED}{Style.BRIGHT}[-] get_churn_risk() endpoint not responding...{Style.RESET_ALL}")
@@ -182,7 +194,7 @@ async def test_get_rfm_segmentation():
     result = None
     ## Test the responsiveness of the endpoint
     try:
-        result = await get_rfm_segmentation()
+        result = orjson.loads(await get_rfm_segmentation())
         print(f"{Fore.GREEN}{Style.BRIGHT}[+] get_rfm_segmentation() endpoint is responding properly.{Style.RESET_ALL}")
     except Exception as e:
         print(f"{Fore.RED}{Style.BRIGHT}[-] get_rfm_segmentation() endpoint not responding...{Style.RESET_ALL}")
@@ -203,3 +215,249 @@ async def test_get_rfm_segmentation():
         print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for get_rfm_segmentation() passed...{Style.RESET_ALL}")
     except AssertionError as e:
         print(f"{Fore.RED}{Style.BRIGHT}{e}{Style.RESET_ALL}")
+
+@pytest.mark.asyncio
+async def test_read_routing():
+    # two pools on the primary stand in for read replicas, plain servers report no replication lag
+    router = await create_router()
+    try:
+        replicas = [DatabasePool("replica_a", router.primary.engine), DatabasePool("replica_b", router.primary.engine)]
+        router.replicas = replicas
+        replicas[0].in_flight = 3
+        assert await router.read_pool() is replicas[1], "[-] Reads not routed to the least loaded replica"
+        assert replicas[1].lag_seconds == 0, f"[-] Unexpected replication lag {replicas[1].lag_seconds}"
+
+        router.max_lag_seconds = -1
+        assert await router.read_pool() is router.primary, "[-] Lagging replicas not skipped"
+        print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for read routing passed...{Style.RESET_ALL}")
+    finally:
+        await router.dispose()
+
+@pytest.mark.asyncio
+async def test_router_created_once(monkeypatch):
+    # concurrent first requests share a single router
+    created = []
+
+    async def create_router():
+        await asyncio.sleep(0.05)
+        created.append(db_routing.ConnectionRouter(None, []))
+        return created[-1]
+
+    monkeypatch.setattr(db_routing, "create_router", create_router)
+    monkeypatch.setattr(db_routing, "router", None)
+    routers = await asyncio.gather(*[db_routing.get_router() for _ in range(5)])
+    assert len(created) == 1, f"[-] {len(created)} routers created"
+    assert all(router is created[0] for router in routers), "[-] Requests got different routers"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] Router created once...{Style.RESET_ALL}")
+
+@pytest.mark.asyncio
+async def test_customer_profiles():
+    profiles = await get_customer_profiles([1, -1])
+    assert profiles[-1] is None, "[-] Profile returned for an unknown customer"
+    profile = profiles[1]
+    assert profile["customer_id"] == 1, f"[-] Wrong customer {profile['customer_id']}"
+    dates = [purchase["purchase_date"] for purchase in profile["recent_purchases"]]
+    assert dates == sorted(dates, reverse=True), "[-] Recent purchases not ordered by date"
+
+    hits = profile_cache.hits
+    assert (await get_customer_profiles([1]))[1] is profile, "[-] Profile not served from the cache"
+    assert profile_cache.hits == hits + 1, "[-] Cache hit not counted"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for get_customer_profiles() passed...{Style.RESET_ALL}")
+
+@pytest.mark.asyncio
+async def test_cohort_retention():
+    result = orjson.loads(await get_cohort_retention(12))
+    assert result["data"][0]["type"] == "heatmap", f"[-] Unexpected chart type {result['data'][0]['type']}"
+    assert len(result["data"][0]["y"]) <= 12, "[-] Cohorts outside of the window returned"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for get_cohort_retention() passed...{Style.RESET_ALL}")
+
+@pytest.mark.asyncio
+async def test_product_affinity():
+    result = await get_product_affinity(1, 5, "confidence")
+    assert result["product_id"] == 1, f"[-] Unexpected product {result['product_id']}"
+    assert len(result["related_products"]) <= 5, "[-] More related products than the limit"
+    confidences = [related["confidence"] for related in result["related_products"]]
+    assert confidences == sorted(confidences, reverse=True), "[-] Related products not sorted by confidence"
+    assert all(related["product_id"] != 1 for related in result["related_products"]), "[-] Product related to itself"
+    assert await get_product_affinity(-1) is None, "[-] Unknown product returned"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for get_product_affinity() passed...{Style.RESET_ALL}")
+
+@pytest.mark.asyncio
+async def test_lookalikes():
+    # customers 1 to 3 are alike, 4 is close to them and 5 far, 6 has no features at all
+    features = [[10.0] * len(LOOKALIKE_FEATURES)] * 3 + [[11.0] * len(LOOKALIKE_FEATURES), [90.0] * len(LOOKALIKE_FEATURES), [None] * len(LOOKALIKE_FEATURES)]
+    index = LookalikeIndex([1, 2, 3, 4, 5, 6], features)
+    lookalikes, missing = index.search([1, 2, 7], 3)
+    assert missing == [7], f"[-] Unexpected missing seeds {missing}"
+    assert [lookalike["customer_id"] for lookalike in lookalikes] == [3, 4, 6], f"[-] Unexpected lookalikes {lookalikes}"
+    assert lookalikes[0]["distance"] == 0, "[-] An identical customer is at a distance"
+
+    result = await get_lookalikes([1], 5)
+    assert len(result["lookalikes"]) == 5, "[-] Fewer lookalikes than asked for"
+    assert all(lookalike["customer_id"] != 1 for lookalike in result["lookalikes"]), "[-] Seed returned as its own lookalike"
+    distances = [lookalike["distance"] for lookalike in result["lookalikes"]]
+    assert distances == sorted(distances), "[-] Lookalikes not sorted by distance"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for get_lookalikes() passed...{Style.RESET_ALL}")
+
+@pytest.mark.asyncio
+async def test_approx_kpis():
+    result = await get_approx_kpis(3)
+    for name, kpi in result.items():
+        if name.endswith("_quantiles"):
+            assert set(kpi) == {"p50", "p90", "p99"}, f"[-] Unexpected quantiles {set(kpi)}"
+        else:
+            assert kpi["error"] is not None and kpi["error"] >= 0, f"[-] No error bound for {name}"
+    assert result["active_customers"]["value"] <= result["total_customers"]["value"] + result["active_customers"]["error"], "[-] More active customers than customers"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for get_approx_kpis() passed...{Style.RESET_ALL}")
+
+@pytest.mark.asyncio
+async def test_scoped_dashboards():
+    scopes = await get_scopes()
+    assert scopes["brand"] and scopes["category"], "[-] No brand or category scopes"
+    brand = ("brand", next(iter(scopes["brand"])))
+    kpis = await get_kpis(brand)
+    assert kpis["total_customers"] == scopes["brand"][brand[1]]["customers"], "[-] Scope KPIs differ from the scope totals"
+    assert kpis["total_customers"] <= (await get_kpis())["total_customers"], "[-] More customers in a brand than in total"
+
+    segments = orjson.loads(await get_customer_segments(brand))
+    assert set(segments["data"][0]["labels"]) <= {"Low Value", "Medium Value", "High Value"}, "[-] Unexpected segments of the brand"
+    top_customers = await get_top_customers(brand)
+    values = [customer["total_lifetime_value"] for customer in top_customers]
+    assert values == sorted(values, reverse=True), "[-] Top customers of the brand not sorted"
+    category = ("category", next(iter(scopes["category"])))
+    performance = orjson.loads(await get_product_category_performance(12, category))
+    assert set(performance["data"][0]["x"]) <= {category[1]}, "[-] Other categories in a category scope"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for the scoped dashboards passed...{Style.RESET_ALL}")
+
+@pytest.mark.asyncio
+async def test_concurrent_purchase_ingestion():
+    # batches of the same customer ingested concurrently must all add up in customer_360
+    customer_id, batches, amount = 5, 20, 100.0
+    async with write_session() as session:
+        before = (await session.execute(text("SELECT * FROM customer_360 WHERE customer_id = :customer_id"), {"customer_id": customer_id})).mappings().one()
+        await session.execute(text(backend_logic.ingestion_log_init_query))
+        await session.commit()
+        started = (await session.execute(text("SELECT CAST(pg_current_snapshot() AS TEXT)"))).scalar()
+    event = {"customer_id": customer_id, "product_id": 1, "purchase_date": date.today(), "quantity": 1, "total_amount": amount, "store_id": -1}
+    try:
+        await asyncio.gather(*[ingest_events("purchases", [event]) for _ in range(batches)])
+        async with write_session() as session:
+            after = (await session.execute(text("SELECT * FROM customer_360 WHERE customer_id = :customer_id"), {"customer_id": customer_id})).mappings().one()
+        assert after["total_purchases"] == (before["total_purchases"] or 0) + batches, f"[-] Lost purchases: {after['total_purchases']}"
+        assert after["total_lifetime_value"] == pytest.approx((before["total_lifetime_value"] or 0) + batches * amount, abs=0.1), f"[-] Lost revenue: {after['total_lifetime_value']}"
+        print(f"{Fore.GREEN}{Style.BRIGHT}[+] Concurrent ingestion batches all applied...{Style.RESET_ALL}")
+    finally:
+        async with write_session() as session:
+            await session.execute(text("DELETE FROM purchase_transactions WHERE customer_id = :customer_id AND store_id = -1"), {"customer_id": customer_id})
+            # the batches of the test, left in the log they would be rebuilt by the next build
+            await session.execute(
+                text("DELETE FROM customer_360_ingestion_log WHERE customer_id = :customer_id AND NOT pg_visible_in_snapshot(xact_id, CAST(CAST(:started AS TEXT) AS pg_snapshot))"),
+                {"customer_id": customer_id, "started": started},
+            )
+            await session.execute(
+                text(f"UPDATE customer_360 SET {', '.join(f'{column} = :{column}' for column in before.keys())} WHERE customer_id = :customer_id"),
+                dict(before),
+            )
+            await session.commit()
+        profile_cache.evict([customer_id])
+
+@pytest.mark.asyncio
+async def test_rebuild_jobs(monkeypatch):
+    command = backend_logic.rebuild_command({"job_id": "j", "mode": "incremental", "customer_ids": [1, 2], "since": None})
+    assert command[-4:] == ["j", "--incremental", "--customer-ids", "1,2"], f"[-] Unexpected command {command}"
+    for name in ("rebuild_queue", "rebuild_worker", "queued_full_rebuild", "rebuild_lock_connection"):
+        monkeypatch.setattr(backend_logic, name, None)
+    monkeypatch.setattr(backend_logic, "rebuild_command", lambda job: [sys.executable, "-c", "import time; time.sleep(0.3); print('built')"])
+    job_ids = ["orphaned-test-job"]
+    try:
+        async with write_session() as session:
+            await session.execute(text(backend_logic.rebuild_jobs_init_query))
+            await session.execute(text("INSERT INTO cdp_rebuild_jobs (job_id, mode, status) VALUES ('orphaned-test-job', 'full', 'running')"))
+            await session.commit()
+
+        running = await backend_logic.enqueue_rebuild("full")
+        job_ids.append(running["job_id"])
+        while (await backend_logic.get_rebuild_job(running["job_id"]))["status"] == "queued":
+            await asyncio.sleep(0.05)
+        # full rebuilds requested while one is queued are served by the queued one, not by the running one
+        queued = await backend_logic.enqueue_rebuild("full")
+        job_ids.append(queued["job_id"])
+        assert queued["job_id"] != running["job_id"], "[-] Full rebuild served by the running one"
+        assert (await backend_logic.enqueue_rebuild("full"))["job_id"] == queued["job_id"], "[-] Queued full rebuild not reused"
+
+        # only the job left behind by a stopped process fails, the jobs of this process hold their locks
+        assert await backend_logic.fail_orphaned_rebuild_jobs() == ["orphaned-test-job"], "[-] Jobs of a live process failed"
+        assert (await backend_logic.get_rebuild_job("orphaned-test-job"))["status"] == "failed", "[-] Job left behind not failed"
+
+        await backend_logic.rebuild_queue.join()
+        for job_id in job_ids[1:]:
+            job = await backend_logic.get_rebuild_job(job_id)
+            assert job["status"] == "success" and job["output"] == "built", f"[-] Unexpected job {job}"
+        assert await backend_logic.get_rebuild_job("unknown") is None, "[-] Unknown job returned"
+        print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for the rebuild jobs passed...{Style.RESET_ALL}")
+    finally:
+        backend_logic.rebuild_worker.cancel()
+        await backend_logic.rebuild_lock_connection.close()
+        async with write_session() as session:
+            await session.execute(text("DELETE FROM cdp_rebuild_jobs WHERE job_id = ANY(:job_ids)"), {"job_ids": job_ids})
+            await session.commit()
+
+@pytest.mark.asyncio
+async def test_admission_control():
+    admission = AdmissionController(capacity=2, heavy_share=0.5, max_queue=2, queue_timeout=0.2, limits={})
+
+    async def compute(seconds):
+        await asyncio.sleep(seconds)
+        return seconds
+
+    assert await admission.run("rfm_segmentation", compute, 0.1) == (0.1, None), "[-] Result not computed"
+    heavy = [asyncio.create_task(admission.run("rfm_segmentation", compute, 0.1)) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    assert admission.heavy_in_flight == 1, f"[-] {admission.heavy_in_flight} heavy requests running over the heavy share"
+    assert await admission.run("cohort_retention", compute, 0) == (0, None), "[-] Cheap request held back by heavy ones"
+
+    results = await asyncio.gather(*heavy)
+    assert any(age is not None for _, age in results), "[-] No stale result served to a shed request"
+    # the only heavy slot is taken, the second request times out in the queue
+    with pytest.raises(Overloaded):
+        async with admission.slot("kpis"):
+            async with admission.slot("kpis"):
+                pass
+    assert admission.endpoints["kpis"].shed == 1, "[-] Shed request not counted"
+    assert admission.in_flight == 0 and not admission.waiters, "[-] Slots leaked"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for AdmissionController passed...{Style.RESET_ALL}")
+
+@pytest.mark.asyncio
+async def test_shared_cache(tmp_path):
+    # two caches on the same directory stand in for two API processes
+    caches = [create_shared_cache(f"file://{tmp_path}") for _ in range(2)]
+    computed = []
+
+    async def compute():
+        computed.append(1)
+        await asyncio.sleep(0.1)
+        return {"value": 1}
+
+    results = await asyncio.gather(
+        *(cache.get_or_compute("payload", compute, lambda result: b'{"value":1}') for cache in caches)
+    )
+    assert len(computed) == 1, f"[-] Payload computed {len(computed)} times"
+    assert sorted(results, key=str) == [b'{"value":1}', {"value": 1}], f"[-] Unexpected results {results}"
+    assert await caches[1].get("payload") == b'{"value":1}', "[-] Payload not shared"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for SharedCache passed...{Style.RESET_ALL}")
+
+def test_snapshot_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(backend_logic, "SNAPSHOT_DIR", str(tmp_path))
+    assert get_snapshot_manifest() is None, "[-] Manifest returned without any snapshot"
+    (tmp_path / "run1").mkdir()
+    (tmp_path / "run1" / "part-00000.parquet").write_bytes(b"PAR1")
+    (tmp_path / "run1" / "manifest.json").write_bytes(orjson.dumps({"run_id": "run1", "rows": 1, "files": [{"file": "part-00000.parquet", "format": "parquet"}]}))
+    (tmp_path / "LATEST").write_text("run1")
+
+    manifest = get_snapshot_manifest()
+    assert manifest["run_id"] == "run1", "[-] Latest snapshot not returned"
+    assert manifest["files"][0]["url"] == "/exports/customer_360/run1/part-00000.parquet", f"[-] Unexpected url {manifest['files'][0]['url']}"
+    assert get_snapshot_file("run1", "part-00000.parquet")["media_type"] == "application/vnd.apache.parquet", "[-] Snapshot file not found"
+    assert get_snapshot_file("run1", "manifest.json") is None, "[-] File outside of the manifest served"
+    assert get_snapshot_manifest("..") is None and get_snapshot_manifest("run2") is None, "[-] Unknown snapshot returned"
+    print(f"{Fore.GREEN}{Style.BRIGHT}[+] All tests for the customer_360 snapshots passed...{Style.RESET_ALL}")
@@ -0,0 +1,238 @@
+import os
+import math
+import time
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Admission control of the dashboard endpoints of an API process. At most ADMISSION_CAPACITY requests are on the
+# database at a time, and each endpoint at most its own concurrency limit. Requests over the limits wait in a queue
+# served by priority: cheap endpoints (precomputed tables, indexed lookups, cached profiles, in-memory indexes) before
+# heavy ones (scans of customer_360 or purchase_transactions). Heavy endpoints never hold more than
+# ADMISSION_HEAVY_SHARE of the capacity, so cheap ones always find a free slot.
+#
+# A request is shed, instead of queued, when the queue is ADMISSION_MAX_QUEUE deep (half of it for heavy endpoints), or
+# when it waited ADMISSION_QUEUE_TIMEOUT_SECONDS without starting. A shed request is answered with the last result of
+# the same call if it is at most STALE_RESULT_MAX_AGE_SECONDS old, otherwise with a 503 and a Retry-After.
+#
+# ENDPOINT_CONCURRENCY_LIMITS overrides the limits of single endpoints, e.g. "rfm_segmentation=1,kpis=2".
+
+CAPACITY = int(os.environ.get("ADMISSION_CAPACITY", 10))
+HEAVY_SHARE = float(os.environ.get("ADMISSION_HEAVY_SHARE", 0.5))
+MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 50))
+QUEUE_TIMEOUT_SECONDS = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT_SECONDS", 2))
+STALE_RESULT_MAX_AGE_SECONDS = float(os.environ.get("STALE_RESULT_MAX_AGE_SECONDS", 600))
+
+# Results kept for stale answers, one per endpoint and arguments
+STALE_RESULT_ENTRIES = 256
+
+CHEAP, HEAVY = 0, 1
+
+# Priority and default concurrency limit of every admitted endpoint, None is no limit but the capacity
+ENDPOINTS = {
+    "kpis_approx": (CHEAP, None),
+    "cohort_retention": (CHEAP, None),
+    "top_customers": (CHEAP, None),
+    "customer_profiles": (CHEAP, None),
+    "product_affinity": (CHEAP, None),
+    "lookalikes": (CHEAP, None),
+    "scopes": (CHEAP, None),
+    "kpis": (HEAVY, 2),
+    "customer_segments": (HEAVY, 2),
+    "monthly_revenue": (HEAVY, 2),
+    "product_category_performance": (HEAVY, 2),
+    "customer_satisfaction": (HEAVY, 2),
+    "churn_risk": (HEAVY, 2),
+    "rfm_segmentation": (HEAVY, 1),
+}
+
+# Weight of the latest request in the moving average of the service time
+SERVICE_TIME_SMOOTHING = 0.1
+
+
+class Overloaded(Exception):
+    def __init__(self, endpoint: str, retry_after: int):
+        super().__init__(f"{endpoint} is overloaded, retry in {retry_after}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class EndpointState:
+    def __init__(self, name: str, priority: int, limit: Optional[int]):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.waited = 0
+        self.shed = 0
+        self.stale_served = 0
+        self.wait_seconds = 0.0
+        self.service_seconds: Optional[float] = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "priority": "cheap" if self.priority == CHEAP else "heavy",
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "waited": self.waited,
+            "shed": self.shed,
+            "stale_served": self.stale_served,
+            "average_wait_ms": round(self.wait_seconds / self.waited * 1000, 1) if self.waited else 0.0,
+            "average_service_ms": None if self.service_seconds is None else round(self.service_seconds * 1000, 1),
+        }
+
+
+def parse_limits(setting: str) -> Dict[str, int]:
+    limits = {}
+    for item in setting.split(","):
+        if item.strip():
+            name, limit = item.split("=")
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        capacity: int = CAPACITY,
+        heavy_share: float = HEAVY_SHARE,
+        max_queue: int = MAX_QUEUE,
+        queue_timeout: float = QUEUE_TIMEOUT_SECONDS,
+        stale_max_age: float = STALE_RESULT_MAX_AGE_SECONDS,
+        limits: Optional[Dict[str, int]] = None,
+    ):
+        self.capacity = capacity
+        self.heavy_capacity = max(1, math.floor(capacity * heavy_share))
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.stale_max_age = stale_max_age
+        limits = parse_limits(os.environ.get("ENDPOINT_CONCURRENCY_LIMITS", "")) if limits is None else limits
+        self.endpoints = {
+            name: EndpointState(name, priority, limits.get(name, limit))
+            for name, (priority, limit) in ENDPOINTS.items()
+        }
+        self.in_flight = 0
+        self.heavy_in_flight = 0
+        # (priority, arrival, endpoint, future) of the queued requests, in the order they are served
+        self.waiters: List[Tuple[int, int, EndpointState, asyncio.Future]] = []
+        self.arrivals = 0
+        self.results: "OrderedDict[Tuple[str, Tuple[Any, ...]], Tuple[float, Any]]" = OrderedDict()
+
+    def can_start(self, endpoint: EndpointState) -> bool:
+        return (
+            self.in_flight < self.capacity
+            and (endpoint.limit is None or endpoint.in_flight < endpoint.limit)
+            and (endpoint.priority == CHEAP or self.heavy_in_flight < self.heavy_capacity)
+        )
+
+    def start(self, endpoint: EndpointState):
+        self.in_flight += 1
+        endpoint.in_flight += 1
+        endpoint.admitted += 1
+        if endpoint.priority == HEAVY:
+            self.heavy_in_flight += 1
+
+    def release(self, endpoint: EndpointState):
+        self.in_flight -= 1
+        endpoint.in_flight -= 1
+        if endpoint.priority == HEAVY:
+            self.heavy_in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        # hands the freed slots to the first queued requests that can start, a request held back by the limit of its
+        # endpoint doesn't block the ones behind it
+        for waiter in list(self.waiters):
+            if self.in_flight >= self.capacity:
+                break
+            _, _, endpoint, future = waiter
+            if self.can_start(endpoint):
+                self.waiters.remove(waiter)
+                endpoint.queued -= 1
+                self.start(endpoint)
+                future.set_result(None)
+
+    def retry_after(self) -> int:
+        # time for the queue ahead to drain at the current service times
+        service_times = [e.service_seconds for e in self.endpoints.values() if e.service_seconds is not None]
+        service_seconds = sum(service_times) / len(service_times) if service_times else 1.0
+        return max(1, math.ceil(service_seconds * (len(self.waiters) / max(1, self.capacity) + 1)))
+
+    def shed(self, endpoint: EndpointState) -> Overloaded:
+        endpoint.shed += 1
+        return Overloaded(endpoint.name, self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self, name: str):
+        endpoint = self.endpoints[name]
+        if self.can_start(endpoint):
+            self.start(endpoint)
+        else:
+            max_queue = self.max_queue if endpoint.priority == CHEAP else self.max_queue // 2
+            if len(self.waiters) >= max_queue:
+                raise self.shed(endpoint)
+            future = asyncio.get_running_loop().create_future()
+            self.arrivals += 1
+            waiter = (endpoint.priority, self.arrivals, endpoint, future)
+            self.waiters.append(waiter)
+            self.waiters.sort(key=lambda waiter: waiter[:2])
+            endpoint.queued += 1
+            queued_at = time.monotonic()
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if future.done():
+                    # started just as the wait ended
+                    self.release(endpoint)
+                else:
+                    future.cancel()
+                    self.waiters.remove(waiter)
+                    endpoint.queued -= 1
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                raise self.shed(endpoint)
+            endpoint.waited += 1
+            endpoint.wait_seconds += time.monotonic() - queued_at
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            service_seconds = time.monotonic() - started_at
+            if endpoint.service_seconds is None:
+                endpoint.service_seconds = service_seconds
+            else:
+                endpoint.service_seconds += SERVICE_TIME_SMOOTHING * (service_seconds - endpoint.service_seconds)
+            self.release(endpoint)
+
+    async def run(self, name: str, compute: Callable[..., Awaitable[Any]], *args) -> Tuple[Any, Optional[float]]:
+        # (result, None) for a computed result, (result, age in seconds) for a stale one served to a shed request
+        key = (name, args)
+        try:
+            async with self.slot(name):
+                result = await compute(*args)
+        except Overloaded:
+            stored = self.results.get(key)
+            if stored is None or time.monotonic() - stored[0] > self.stale_max_age:
+                raise
+            self.endpoints[name].stale_served += 1
+            return stored[1], time.monotonic() - stored[0]
+        self.results[key] = (time.monotonic(), result)
+        self.results.move_to_end(key)
+        if len(self.results) > STALE_RESULT_ENTRIES:
+            self.results.popitem(last=False)
+        return result, None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "heavy_capacity": self.heavy_capacity,
+            "in_flight": self.in_flight,
+            "queued": len(self.waiters),
+            "max_queue": self.max_queue,
+            "endpoints": {name: endpoint.stats() for name, endpoint in self.endpoints.items()},
+        }
@@ -1,9 +1,158 @@
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse
+import os
+from datetime import date
+from typing import Any, Awaitable, Callable, List, Literal, Optional, Tuple
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, Response
+from pydantic import BaseModel
+from sqlalchemy.exc import IntegrityError
 import backend_logic
+import db_routing
+from admission import AdmissionController, Overloaded
 
 app = FastAPI()
 
+admission = AdmissionController()
+
+
+@app.on_event("startup")
+async def fail_orphaned_rebuild_jobs():
+    try:
+        await backend_logic.fail_orphaned_rebuild_jobs()
+    except Exception as e:
+        print(f"[-] Unable to look for rebuild jobs left behind: {e}")
+
+
+@app.on_event("shutdown")
+async def dispose_database_pools():
+    await db_routing.dispose_pools()
+
+# Upper bound on the number of events accepted in a single ingestion request
+MAX_INGEST_BATCH_SIZE = 10000
+
+# Upper bound on the number of customers looked up in a single batch request
+MAX_PROFILE_BATCH_SIZE = 5000
+
+# Upper bounds on the seed customers and on the lookalikes of a single lookalike search
+MAX_LOOKALIKE_SEEDS = 5000
+MAX_LOOKALIKES = 10000
+
+# Upper bound on the `months` window of the dashboards, 100 years. Longer windows would start before year 1.
+MAX_WINDOW_MONTHS = 1200
+
+# Upper bound on the customers of an incremental rebuild, they are passed to the build on its command line
+MAX_REBUILD_CUSTOMERS = 10000
+
+
+class RebuildRequest(BaseModel):
+    mode: Literal["full", "incremental"] = "full"
+    # an incremental build rebuilds either these customers, or the customers with activity since this day
+    customer_ids: Optional[List[int]] = None
+    since: Optional[date] = None
+
+
+class CustomerBatchRequest(BaseModel):
+    customer_ids: List[int]
+
+
+class LookalikeRequest(BaseModel):
+    customer_ids: List[int]
+    k: int = 100
+
+
+class PurchaseEvent(BaseModel):
+    customer_id: int
+    product_id: int
+    purchase_date: date
+    quantity: int
+    total_amount: float
+    store_id: int
+
+
+class ServiceInteractionEvent(BaseModel):
+    customer_id: int
+    interaction_date: date
+    interaction_type: str
+    product_id: int
+    resolution_status: str
+    satisfaction_score: int
+
+
+class WebSessionEvent(BaseModel):
+    customer_id: int
+    visit_date: date
+    pages_viewed: int
+    time_spent: int
+    source: str
+
+
+class CampaignResponseEvent(BaseModel):
+    campaign_id: int
+    customer_id: int
+    response_date: date
+    response_type: str
+
+
+async def ingest(event_type: str, events: list):
+    if not events:
+        raise HTTPException(status_code=422, detail="No events in the batch")
+    if len(events) > MAX_INGEST_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413, detail=f"At most {MAX_INGEST_BATCH_SIZE} events can be ingested per request"
+        )
+    try:
+        return await backend_logic.ingest_events(event_type, [event.model_dump() for event in events])
+    except IntegrityError:
+        # an unknown customer_id/product_id/campaign_id, the whole batch is rolled back. Other database errors are
+        # not the batch's fault and fail as a 500.
+        raise HTTPException(
+            status_code=422, detail="The batch references an unknown customer, product or campaign, nothing was ingested"
+        )
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=503, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+def json_response(payload: Any, headers: Optional[dict] = None) -> Response:
+    # `payload` encoded by `backend_logic.encode_json`, or already encoded
+    return Response(content=backend_logic.encode_json(payload), media_type="application/json", headers=headers)
+
+
+async def admitted(endpoint: str, compute: Callable[..., Awaitable[Any]], *args) -> Response:
+    # serves the payload shared by the API processes for the current build if there is one, otherwise runs `compute`
+    # under the admission control of `endpoint`. A stale result is flagged by its Age.
+    shared = await backend_logic.get_shared_result(endpoint, *args)
+    if shared is not None:
+        return json_response(shared)
+    result, age = await admission.run(endpoint, backend_logic.compute_shared_result, endpoint, compute, *args)
+    return json_response(result, {} if age is None else {"Age": str(int(age)), "X-Cache": "stale"})
+
+
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    # the admin endpoints are open unless ADMIN_TOKEN is set
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if admin_token and x_admin_token != admin_token:
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+
+async def dashboard_scope(
+    brand: Optional[str] = None, category: Optional[str] = None
+) -> Optional[Tuple[str, str]]:
+    # the brand or category a dashboard endpoint is scoped to, None for all customers
+    if brand is not None and category is not None:
+        raise HTTPException(status_code=422, detail="A dashboard is scoped to either a brand or a category")
+    if brand is None and category is None:
+        return None
+    scope = ("brand", brand) if brand is not None else ("category", category)
+    async with admission.slot("scopes"):
+        scopes = await backend_logic.get_scopes()
+    if scope[1] not in scopes[scope[0]]:
+        raise HTTPException(status_code=404, detail=f"Unknown {scope[0]} {scope[1]}")
+    return scope
+
 
 @app.get("/")
 async def root():
@@ -11,43 +160,203 @@ async def root():
 
 
 @app.get("/kpis")
-async def api_get_kpis():
-    return await backend_logic.get_kpis()
+async def api_get_kpis(
+    approx: bool = False,
+    months: Optional[int] = Query(None, ge=1, le=MAX_WINDOW_MONTHS),
+    scope: Optional[Tuple[str, str]] = Depends(dashboard_scope),
+):
+    # approx=true reads the sketches of the CDP build, `months` limits its purchase metrics to the last N months
+    if approx:
+        if scope:
+            raise HTTPException(status_code=422, detail="Approximate KPIs are not scoped to a brand or a category")
+        return await admitted("kpis_approx", backend_logic.get_approx_kpis, months)
+    return await admitted("kpis", backend_logic.get_kpis, scope)
 
 
 @app.get("/customer_segments")
-async def api_get_customer_segments():
-    return JSONResponse(content=await backend_logic.get_customer_segments())
+async def api_get_customer_segments(scope: Optional[Tuple[str, str]] = Depends(dashboard_scope)):
+    return await admitted("customer_segments", backend_logic.get_customer_segments, scope)
 
 
 @app.get("/monthly_revenue")
-async def api_get_monthly_revenue():
-    return JSONResponse(content=await backend_logic.get_monthly_revenue())
+async def api_get_monthly_revenue(
+    months: Optional[int] = Query(None, ge=1, le=MAX_WINDOW_MONTHS), scope: Optional[Tuple[str, str]] = Depends(dashboard_scope)
+):
+    return await admitted("monthly_revenue", backend_logic.get_monthly_revenue, months, scope)
+
+
+@app.get("/cohort_retention")
+async def api_get_cohort_retention(
+    months: Optional[int] = Query(None, ge=1, le=MAX_WINDOW_MONTHS), scope: Optional[Tuple[str, str]] = Depends(dashboard_scope)
+):
+    return await admitted("cohort_retention", backend_logic.get_cohort_retention, months, scope)
 
 
 @app.get("/top_customers")
-async def api_get_top_customers():
-    return await backend_logic.get_top_customers()
+async def api_get_top_customers(scope: Optional[Tuple[str, str]] = Depends(dashboard_scope)):
+    return await admitted("top_customers", backend_logic.get_top_customers, scope)
 
 
 @app.get("/product_category_performance")
-async def api_get_product_category_performance():
-    return JSONResponse(content=await backend_logic.get_product_category_performance())
+async def api_get_product_category_performance(
+    months: Optional[int] = Query(None, ge=1, le=MAX_WINDOW_MONTHS), scope: Optional[Tuple[str, str]] = Depends(dashboard_scope)
+):
+    return await admitted("product_category_performance", backend_logic.get_product_category_performance, months, scope)
 
 
 @app.get("/customer_satisfaction")
-async def api_get_customer_satisfaction():
-    return JSONResponse(content=await backend_logic.get_customer_satisfaction())
+async def api_get_customer_satisfaction(scope: Optional[Tuple[str, str]] = Depends(dashboard_scope)):
+    return await admitted("customer_satisfaction", backend_logic.get_customer_satisfaction, scope)
 
 
 @app.get("/churn_risk")
-async def api_get_churn_risk():
-    return JSONResponse(content=await backend_logic.get_churn_risk())
+async def api_get_churn_risk(scope: Optional[Tuple[str, str]] = Depends(dashboard_scope)):
+    return await admitted("churn_risk", backend_logic.get_churn_risk, scope)
 
 
 @app.get("/rfm_segmentation")
-async def api_get_rfm_segmentation():
-    return JSONResponse(content=await backend_logic.get_rfm_segmentation())
+async def api_get_rfm_segmentation(scope: Optional[Tuple[str, str]] = Depends(dashboard_scope)):
+    return await admitted("rfm_segmentation", backend_logic.get_rfm_segmentation, scope)
+
+
+@app.get("/scopes")
+async def api_get_scopes():
+    # the brands and categories the dashboard endpoints can be scoped to
+    async with admission.slot("scopes"):
+        return json_response(await backend_logic.get_scopes())
+
+
+@app.get("/product_affinity/{product_id}")
+async def api_get_product_affinity(
+    product_id: int,
+    limit: int = Query(10, ge=1, le=100),
+    sort: Literal["lift", "confidence", "support"] = "lift",
+):
+    async with admission.slot("product_affinity"):
+        affinity = await backend_logic.get_product_affinity(product_id, limit, sort)
+    if affinity is None:
+        raise HTTPException(status_code=404, detail=f"Unknown product {product_id}")
+    return json_response(affinity)
+
+
+@app.get("/customers/{customer_id}")
+async def api_get_customer(customer_id: int):
+    async with admission.slot("customer_profiles"):
+        profile = (await backend_logic.get_customer_profiles([customer_id]))[customer_id]
+    if profile is None:
+        raise HTTPException(status_code=404, detail=f"Unknown customer {customer_id}")
+    return json_response(profile)
+
+
+@app.post("/customers/batch")
+async def api_get_customers(request: CustomerBatchRequest):
+    if not request.customer_ids:
+        raise HTTPException(status_code=422, detail="No customer ids in the batch")
+    if len(request.customer_ids) > MAX_PROFILE_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413, detail=f"At most {MAX_PROFILE_BATCH_SIZE} customers can be looked up per request"
+        )
+    async with admission.slot("customer_profiles"):
+        profiles = await backend_logic.get_customer_profiles(list(dict.fromkeys(request.customer_ids)))
+    return json_response(
+        {
+            "profiles": [profile for profile in profiles.values() if profile is not None],
+            "missing": [customer_id for customer_id, profile in profiles.items() if profile is None],
+        }
+    )
+
+
+@app.post("/lookalikes")
+async def api_get_lookalikes(request: LookalikeRequest):
+    if not request.customer_ids:
+        raise HTTPException(status_code=422, detail="No seed customer ids")
+    if len(request.customer_ids) > MAX_LOOKALIKE_SEEDS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_LOOKALIKE_SEEDS} seed customers per search")
+    if not 1 <= request.k <= MAX_LOOKALIKES:
+        raise HTTPException(status_code=422, detail=f"k must be between 1 and {MAX_LOOKALIKES}")
+    async with admission.slot("lookalikes"):
+        result = await backend_logic.get_lookalikes(list(dict.fromkeys(request.customer_ids)), request.k)
+    if len(result["missing"]) == len(set(request.customer_ids)):
+        raise HTTPException(status_code=404, detail="None of the seed customers is known")
+    return json_response(result)
+
+
+@app.get("/exports/customer_360")
+async def api_get_latest_snapshot():
+    manifest = backend_logic.get_snapshot_manifest()
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="No customer_360 snapshot exported")
+    return json_response(manifest, {"Cache-Control": "no-cache"})
+
+
+@app.get("/exports/customer_360/{run_id}")
+async def api_get_snapshot(run_id: str):
+    manifest = backend_logic.get_snapshot_manifest(run_id)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail=f"No customer_360 snapshot of build {run_id}")
+    return json_response(manifest)
+
+
+@app.get("/exports/customer_360/{run_id}/{file_name}")
+async def api_get_snapshot_file(run_id: str, file_name: str):
+    file = backend_logic.get_snapshot_file(run_id, file_name)
+    if file is None:
+        raise HTTPException(status_code=404, detail=f"No file {file_name} in the customer_360 snapshot of build {run_id}")
+    # the files of a snapshot never change, clients can fetch parts of them with Range requests
+    return FileResponse(
+        file["path"],
+        media_type=file["media_type"],
+        filename=file_name,
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+
+@app.post("/ingest/purchases")
+async def api_ingest_purchases(events: List[PurchaseEvent]):
+    return await ingest("purchases", events)
+
+
+@app.post("/ingest/service_interactions")
+async def api_ingest_service_interactions(events: List[ServiceInteractionEvent]):
+    return await ingest("service_interactions", events)
+
+
+@app.post("/ingest/web_sessions")
+async def api_ingest_web_sessions(events: List[WebSessionEvent]):
+    return await ingest("web_sessions", events)
+
+
+@app.post("/ingest/campaign_responses")
+async def api_ingest_campaign_responses(events: List[CampaignResponseEvent]):
+    return await ingest("campaign_responses", events)
+
+
+@app.post("/admin/rebuild", status_code=202, dependencies=[Depends(require_admin)])
+async def api_rebuild(request: RebuildRequest):
+    if request.mode == "incremental" and (request.customer_ids is None) == (request.since is None):
+        raise HTTPException(status_code=422, detail="An incremental rebuild needs one of customer_ids or since")
+    if request.mode == "incremental" and request.customer_ids == []:
+        raise HTTPException(status_code=422, detail="No customers to rebuild")
+    if request.customer_ids is not None and len(request.customer_ids) > MAX_REBUILD_CUSTOMERS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {MAX_REBUILD_CUSTOMERS} customers can be rebuilt per request, use since or a full rebuild",
+        )
+    return await backend_logic.enqueue_rebuild(request.mode, request.customer_ids, request.since)
+
+
+@app.get("/admin/admission", dependencies=[Depends(require_admin)])
+async def api_get_admission():
+    # queued, shed and stale served requests per endpoint since the process started
+    return admission.stats()
+
+
+@app.get("/admin/rebuild/{job_id}", dependencies=[Depends(require_admin)])
+async def api_get_rebuild(job_id: str):
+    job = await backend_logic.get_rebuild_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown rebuild job {job_id}")
+    return job
 
 
 if __name__ == "__main__":
@@ -1,276 +1,733 @@
 import os
+import sys
+import time
+import uuid
 import asyncio
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import text
-from google.cloud.sql.connector import create_async_connector
 from dotenv import load_dotenv
-import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import json
+import orjson
+import numpy as np
+from datetime import date
+from decimal import Decimal
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from ingestion_queries import ingestion_queries, ingestion_log_init_query, log_customers_query
+from dashboard_queries import (
+    customer_segments_query,
+    monthly_revenue_query,
+    top_customers_query,
+    product_category_performance_query,
+    customer_satisfaction_query,
+    churn_risk_query,
+    rfm_segmentation_query,
+    cohort_retention_query,
+    product_query,
+    related_products_query,
+    related_brands_query,
+    scopes_query,
+    scope_kpis_query,
+    scope_dimension_query,
+    scope_satisfaction_query,
+    scope_monthly_revenue_query,
+    scope_category_performance_query,
+    scope_top_customers_query,
+    scope_rfm_segmentation_query,
+    scope_cohort_retention_query,
+)
+from db_routing import get_router, read_session, write_session
+from profile_cache import ProfileCache, MISSING, BUILD_VERSION_CHECK_SECONDS
+from shared_cache import create_shared_cache
+from lookalike import LOOKALIKE_FEATURES, LookalikeIndex, lookalike_features_query
+from sketches import HLL_RELATIVE_ERROR, DDSKETCH_RELATIVE_ACCURACY, hll_estimate, ddsketch_quantiles
+from profile_queries import (
+    customer_profiles_query,
+    recent_purchases_query,
+    recent_interactions_query,
+    build_version_query,
+)
+from rebuild_queries import (
+    rebuild_jobs_init_query,
+    insert_rebuild_job_query,
+    start_rebuild_job_query,
+    finish_rebuild_job_query,
+    rebuild_job_query,
+    rebuild_job_stages_query,
+    lock_rebuild_job_query,
+    unlock_rebuild_job_query,
+    fail_orphaned_rebuild_jobs_query,
+)
 
 load_dotenv()
 
+# Directory of the CDP build scripts run by the rebuild worker, /cdp in the backend image
+CDP_DIR = os.environ.get("CDP_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cdp"))
 
-async def init_connection_pool():
-    connector = await create_async_connector()
-    async def getconn():
-        conn = await connector.connect_async(
-            os.environ["INSTANCE_CONNECTION_NAME"],
-            "asyncpg",
-            user=os.environ["DB_USER"],
-            password=os.environ["DB_PASS"],
-            db=os.environ["DB_NAME"],
-        )
-        return conn
+# Directory of the columnar customer_360 snapshots written by the CDP build (its --snapshot-dir), None when builds
+# don't export them. The rebuild jobs of this process export there too.
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR")
+
+SNAPSHOT_MEDIA_TYPES = {"parquet": "application/vnd.apache.parquet", "arrow": "application/vnd.apache.arrow.file"}
+
+# Last lines of the build output kept with a finished rebuild job
+REBUILD_OUTPUT_LINES = 50
+
+# Rebuild jobs of this API process, run one at a time by a single worker task. Builds started by other API processes
+# or from the command line also wait for each other, on the build lock taken by `cdp_procedure.py`.
+rebuild_queue: Optional[asyncio.Queue] = None
+rebuild_worker: Optional[asyncio.Task] = None
+# A full build requested while another one is still waiting in the queue is served by the queued one
+queued_full_rebuild: Optional[Dict[str, Any]] = None
+# Connection holding the locks of the jobs queued or running in this process
+rebuild_lock_connection = None
+
+# Quantiles of lifetime and order values reported by the approximate KPIs
+KPI_QUANTILES = [0.5, 0.9, 0.99]
+
+# Purchases and service interactions returned with a customer profile
+RECENT_ACTIVITY_LIMIT = 10
+
+profile_cache = ProfileCache()
+
+# The ingestion log is created by the first batch of the process
+ingestion_log_ready = False
+
+# Dashboard payloads shared with the other API processes, None unless SHARED_CACHE_URL is set
+shared_cache = create_shared_cache()
+
+# Lookalike index of the current build of customer_360, built by the first search after a build
+lookalike_index: Optional[LookalikeIndex] = None
+lookalike_index_lock = asyncio.Lock()
+
+# Brand and category scopes of the dashboards, scope type -> scope -> totals, reloaded at most every
+# BUILD_VERSION_CHECK_SECONDS: the CDP build refreshes them after it published customer_360
+SCOPE_TYPES = ("brand", "category")
+scopes: Optional[Dict[str, Dict[str, Dict[str, Any]]]] = None
+scopes_loaded_at: Optional[float] = None
 
-    engine = create_async_engine(
-        "postgresql+asyncpg://",
-        async_creator=getconn,
-    )
-    return engine, connector
 
 async def get_db_session(engine):
     async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
     return async_session()
 
-async def get_kpis():
-    engine, connector = await init_connection_pool()
-    try:
-       async with await get_db_session(engine) as session:
-            total_customers = await session.execute(
-                text(
-                    "SELECT COUNT(DISTINCT customer_id) as total_customers FROM customer_360"
-                )
+def month_window_start(months: int) -> date:
+    # first day of the month `months - 1` months before the current one, i.e. a window of `months` calendar months
+    today = date.today()
+    month_index = today.year * 12 + today.month - months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+async def get_kpis(scope: Optional[Tuple[str, str]] = None):
+    if scope:
+        return await get_scope_kpis(scope)
+    async with read_session() as session:
+        total_customers = await session.execute(
+            text(
+                "SELECT COUNT(DISTINCT customer_id) as total_customers FROM customer_360"
             )
+        )
 
-            total_customers = (total_customers.fetchone())[0] # no need to use await as this is just data
+        total_customers = (total_customers.fetchone())[0] # no need to use await as this is just data
 
-            total_ltv = await session.execute(
-                text("SELECT SUM(total_lifetime_value) as total_ltv FROM customer_360")
-            )
-            total_ltv = (total_ltv.fetchone())[0] # no need to use await as this is just data
+        total_ltv = await session.execute(
+            text("SELECT SUM(total_lifetime_value) as total_ltv FROM customer_360")
+        )
+        total_ltv = (total_ltv.fetchone())[0] # no need to use await as this is just data
 
-            avg_order_value = await session.execute(
-                text("SELECT AVG(average_order_value) as avg_order_value FROM customer_360")
-            )
-            avg_order_value = (avg_order_value.fetchone())[0] # no need to use await as this is just data
-
-            retention_rate = await session.execute(
-                text(
-                    """
-                SELECT CAST(COUNT(CASE WHEN total_purchases > 1 THEN 1 END) AS FLOAT) / COUNT(*) as retention_rate
-                FROM customer_360
-            """
-                )
+        avg_order_value = await session.execute(
+            text("SELECT AVG(average_order_value) as avg_order_value FROM customer_360")
+        )
+        avg_order_value = (avg_order_value.fetchone())[0] # no need to use await as this is just data
+
+        retention_rate = await session.execute(
+            text(
+                """
+            SELECT CAST(COUNT(CASE WHEN total_purchases > 1 THEN 1 END) AS FLOAT) / COUNT(*) as retention_rate
+            FROM customer_360
+        """
             )
-            retention_rate = (retention_rate.fetchone())[0] # no need to use await as this is just data
-            
-            return {
-                "total_customers": total_customers,
-                "total_lifetime_value": round(total_ltv, 2),
-                "average_order_value": round(avg_order_value, 2),
-                "retention_rate": round(retention_rate * 100, 2),
+        )
+        retention_rate = (retention_rate.fetchone())[0] # no need to use await as this is just data
+
+        return {
+            "total_customers": total_customers,
+            "total_lifetime_value": round(total_ltv, 2),
+            "average_order_value": round(avg_order_value, 2),
+            "retention_rate": round(retention_rate * 100, 2),
+        }
+
+async def get_approx_kpis(months: Optional[int] = None):
+    # Merges the sketches of the CDP build instead of scanning customer_360 and purchase_transactions. Customer
+    # metrics cover all customers, purchase metrics the last `months` months. Every value comes with an absolute error
+    # bound: 0 for counters, ~95% bounds for HyperLogLog counts, guaranteed bounds for DDSketch quantiles.
+    window_filter = "bucket >= :since" if months else "TRUE"
+    params = {"since": month_window_start(months)} if months else {}
+    async with read_session() as session:
+        result = await session.execute(
+            text(
+                f"""
+            SELECT sketch, bin, SUM(value) AS value
+            FROM kpi_sketches
+            WHERE sketch LIKE 'customer%' OR {window_filter}
+            GROUP BY sketch, bin
+        """
+            ),
+            params,
+        )
+        sketch_bins = result.fetchall()
+        result = await session.execute(
+            text(
+                f"""
+            SELECT registers
+            FROM kpi_hll_sketches
+            WHERE sketch = 'purchase_customers_hll' AND {window_filter}
+        """
+            ),
+            params,
+        )
+        register_sets = [registers for registers, in result.fetchall()]
+
+    counters = {sketch: value for sketch, _, value in sketch_bins if not sketch.endswith("_dd")}
+    histograms = {}
+    for sketch, bin, value in sketch_bins:
+        if sketch.endswith("_dd"):
+            histograms.setdefault(sketch, []).append((bin, value))
+
+    def exact(value):
+        return {"value": value, "error": 0.0}
+
+    def quantiles(sketch):
+        values = ddsketch_quantiles(histograms.get(sketch, []), KPI_QUANTILES)
+        return {
+            f"p{round(quantile * 100)}": {
+                "value": None if value is None else round(value, 2),
+                "error": None if value is None else round(value * DDSKETCH_RELATIVE_ACCURACY, 2),
             }
-    finally:
-        await engine.dispose()
-        await connector.close_async()
-        print("[+] Resources Released....", end="\n\n")
+            for quantile, value in values.items()
+        }
 
-async def get_customer_segments():
-    engine, connector = await init_connection_pool()
-    try:
-        async with await get_db_session(engine) as session:
-            result = await session.execute(
-                text(
-                    "SELECT customer_segment, COUNT(*) as count FROM customer_360 GROUP BY customer_segment"
-                )
-            )
-            df = pd.DataFrame(
-                result.fetchall(), columns=["customer_segment", "count"] # no need to use await as this is just data
-            )
-            
-        fig = px.pie(
-            df,
-            values="count",
-            names="customer_segment",
-            title="Customer Segment Distribution",
+    customers = counters.get("customer_count", 0)
+    average_order_values = counters.get("customer_average_order_value_count", 0)
+    active_customers = hll_estimate(register_sets)
+    return {
+        "total_customers": exact(int(customers)),
+        "total_lifetime_value": exact(round(counters.get("customer_lifetime_value", 0), 2)),
+        "average_order_value": exact(
+            round(counters["customer_average_order_value_sum"] / average_order_values, 2) if average_order_values else None
+        ),
+        "retention_rate": exact(
+            round(counters.get("customer_repeat_count", 0) / customers * 100, 2) if customers else None
+        ),
+        "active_customers": {"value": round(active_customers), "error": round(active_customers * HLL_RELATIVE_ERROR)},
+        "purchases": exact(int(counters.get("purchase_count", 0))),
+        "revenue": exact(round(counters.get("purchase_revenue", 0), 2)),
+        "lifetime_value_quantiles": quantiles("customer_lifetime_value_dd"),
+        "order_value_quantiles": quantiles("purchase_amount_dd"),
+    }
+
+async def fetch_columns(
+    session, query: str, columns: List[str], params: Optional[Dict[str, Any]] = None
+) -> Dict[str, np.ndarray]:
+    # the columns of `query`, in its row order, as arrays aggregated by postgres instead of one row object per row
+    aggregates = ", ".join(f"array_agg({column} ORDER BY row_number)" for column in columns)
+    result = await session.execute(
+        text(f"SELECT {aggregates} FROM (SELECT *, row_number() OVER () AS row_number FROM ({query}) q) numbered"),
+        params or {},
+    )
+    return {column: np.array(values or []) for column, values in zip(columns, result.fetchone())}
+
+def encode_default(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def encode_json(payload: Any) -> bytes:
+    # the response body of `payload`, bytes are already encoded. Dates, datetimes and NumPy values are encoded
+    # natively, decimals as floats.
+    if isinstance(payload, bytes):
+        return payload
+    return orjson.dumps(payload, default=encode_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+def figure_json(fig: go.Figure) -> bytes:
+    return fig.to_json(engine="orjson").encode("utf-8")
+
+# The figures of the charts, built from a mapping of column name to values
+
+def customer_segments_figure(data) -> go.Figure:
+    return px.pie(data, values="count", names="customer_segment", title="Customer Segment Distribution")
+
+def monthly_revenue_figure(data) -> go.Figure:
+    return px.line(data, x="month", y="revenue", title="Monthly Revenue Trend")
+
+def product_category_performance_figure(data) -> go.Figure:
+    return px.bar(data, x="category", y="total_revenue", title="Product Category Performance")
+
+def churn_risk_figure(data) -> go.Figure:
+    return px.pie(data, values="count", names="churn_risk_score", title="Churn Risk Distribution")
+
+def rfm_segmentation_figure(data) -> go.Figure:
+    return px.scatter_3d(
+        data,
+        x="recency_score",
+        y="frequency_score",
+        z="monetary_score",
+        title="RFM Segmentation",
+        labels={
+            "recency_score": "Recency",
+            "frequency_score": "Frequency",
+            "monetary_score": "Monetary",
+        },
+    )
+
+def customer_satisfaction_figure(avg_satisfaction: Optional[float]) -> go.Figure:
+    return go.Figure(
+        go.Indicator(
+            mode="gauge+number",
+            value=avg_satisfaction,
+            title={"text": "Customer Satisfaction Score"},
+            domain={"x": [0, 1], "y": [0, 1]},
+            gauge={
+                "axis": {"range": [0, 10]},
+                "steps": [
+                    {"range": [0, 3], "color": "red"},
+                    {"range": [3, 7], "color": "yellow"},
+                    {"range": [7, 10], "color": "green"},
+                ],
+                "threshold": {
+                    "line": {"color": "black", "width": 4},
+                    "thickness": 0.75,
+                    "value": avg_satisfaction,
+                },
+            },
         )
-        return json.loads(fig.to_json())
-    finally:
-        await engine.dispose()
-        await connector.close_async()
-        print("[+] Resources Released....", end="\n\n")
-
-async def get_monthly_revenue():
-    engine, connector = await init_connection_pool()
-    try:
-        async with await get_db_session(engine) as session:
-            result = await session.execute(
-                text(
-                    """
-                SELECT DATE_TRUNC('month', purchase_date) as month, SUM(total_amount) as revenue
-                FROM purchase_transactions
-                GROUP BY month
-                ORDER BY month
-            """
-                )
-            )
-            df = pd.DataFrame(result.fetchall(), columns=["month", "revenue"])
+    )
 
-        fig = px.line(df, x="month", y="revenue", title="Monthly Revenue Trend")
-        return json.loads(fig.to_json())
-    finally:
-        await engine.dispose()
-        await connector.close_async()
-        print("[+] Resources Released....", end="\n\n")
+def cohort_retention_figure(data) -> go.Figure:
+    # registration month x months since registration, empty cells are months without data
+    cohorts, cohort_index = np.unique(
+        [cohort_month.strftime("%Y-%m") for cohort_month in data["cohort_month"]], return_inverse=True
+    )
+    months_since, months_since_index = np.unique(np.asarray(data["months_since"], dtype=int), return_inverse=True)
+    matrix = np.full((len(cohorts), len(months_since)), np.nan)
+    matrix[cohort_index, months_since_index] = np.round(
+        np.asarray(data["active_customers"], dtype=float) / np.asarray(data["cohort_size"], dtype=float) * 100, 2
+    )
+    return px.imshow(
+        matrix,
+        x=months_since,
+        y=cohorts,
+        labels={"x": "Months Since Registration", "y": "Registration Month", "color": "Retention (%)"},
+        title="Cohort Retention",
+        aspect="auto",
+    )
 
-async def get_top_customers():
-    engine, connector = await init_connection_pool()
-    try:
-        async with await get_db_session(engine) as session:
-            result = await session.execute(
-                text( ## needed to change this query since some values in the `customer_360` are null
-                """SELECT customer_id, first_name, last_name, total_lifetime_value
-                FROM customer_360
-                WHERE total_lifetime_value IS NOT NULL
-                ORDER BY total_lifetime_value DESC
-                LIMIT 5;""")
-            )       
-
-            df = pd.DataFrame(
-                result.fetchall(),
-                columns=["customer_id", "first_name", "last_name", "total_lifetime_value"],
-            )
+def window_params(months: Optional[int], column: str, conjunction: str = "WHERE") -> Dict[str, Any]:
+    # the {window_filter} of a dashboard query and its parameters, `conjunction` is AND after another condition
+    if not months:
+        return {"window_filter": "", "params": {}}
+    return {"window_filter": f"{conjunction} {column} >= :since", "params": {"since": month_window_start(months)}}
 
-        return df.to_dict(orient="records")
-    finally:
-        await engine.dispose()
-        await connector.close_async()
-        print("[+] Resources Released....", end="\n\n")
+def scope_params(scope: Tuple[str, str]) -> Dict[str, str]:
+    scope_type, scope_value = scope
+    return {"scope_type": scope_type, "scope": scope_value}
 
-async def get_product_category_performance():
-    engine, connector = await init_connection_pool()
-    try:
-        async with await get_db_session(engine) as session:
-            result = await session.execute(
-                text(
-                    """
-                SELECT pc.category, SUM(pt.total_amount) as total_revenue
-                FROM purchase_transactions pt
-                JOIN product_catalog pc ON pt.product_id = pc.product_id
-                GROUP BY pc.category
-                ORDER BY total_revenue DESC
-            """
-                )
-            )
-            
-            df = pd.DataFrame(
-                result.fetchall(), columns=["category", "total_revenue"]
+async def get_customer_segments(scope: Optional[Tuple[str, str]] = None) -> bytes:
+    async with read_session() as session:
+        if scope:
+            data = await fetch_columns(
+                session,
+                scope_dimension_query.format(dimension="customer_segment"),
+                ["customer_segment", "count"],
+                scope_params(scope),
             )
-            
-        fig = px.bar(
-            df, x="category", y="total_revenue", title="Product Category Performance"
+        else:
+            data = await fetch_columns(session, customer_segments_query, ["customer_segment", "count"])
+    return figure_json(customer_segments_figure(data))
+
+async def get_monthly_revenue(months: Optional[int] = None, scope: Optional[Tuple[str, str]] = None) -> bytes:
+    if scope:
+        window = window_params(months, "month", "AND")
+        query, params = scope_monthly_revenue_query, {**window["params"], **scope_params(scope)}
+    else:
+        window = window_params(months, "purchase_date")
+        query, params = monthly_revenue_query, window["params"]
+    async with read_session() as session:
+        data = await fetch_columns(
+            session, query.format(window_filter=window["window_filter"]), ["month", "revenue"], params
         )
-        return json.loads(fig.to_json())
-    finally:
-        await engine.dispose()
-        await connector.close_async()
-        print("[+] Resources Released....", end="\n\n")
-
-async def get_customer_satisfaction():
-    engine, connector = await init_connection_pool()
-    try:
-        async with await get_db_session(engine) as session:
-            result = await session.execute(
-                text(
-                    "SELECT AVG(average_satisfaction_score) as avg_satisfaction FROM customer_360"
-                )
-            )
-            avg_satisfaction = (result.fetchone())[0]
-            
-        fig = go.Figure(
-            go.Indicator(
-                mode="gauge+number",
-                value=avg_satisfaction,
-                title={"text": "Customer Satisfaction Score"},
-                domain={"x": [0, 1], "y": [0, 1]},
-                gauge={
-                    "axis": {"range": [0, 10]},
-                    "steps": [
-                        {"range": [0, 3], "color": "red"},
-                        {"range": [3, 7], "color": "yellow"},
-                        {"range": [7, 10], "color": "green"},
-                    ],
-                    "threshold": {
-                        "line": {"color": "black", "width": 4},
-                        "thickness": 0.75,
-                        "value": avg_satisfaction,
-                    },
-                },
-            )
+    return figure_json(monthly_revenue_figure(data))
+
+async def get_top_customers(scope: Optional[Tuple[str, str]] = None) -> List[Dict[str, Any]]:
+    # the lifetime value of a customer in a scope is their revenue in it
+    async with read_session() as session:
+        if scope:
+            result = await session.execute(text(scope_top_customers_query), scope_params(scope))
+        else:
+            result = await session.execute(text(top_customers_query))
+        return [dict(row) for row in result.mappings()]
+
+async def get_product_category_performance(
+    months: Optional[int] = None, scope: Optional[Tuple[str, str]] = None
+) -> bytes:
+    if scope:
+        window = window_params(months, "month", "AND")
+        query, params = scope_category_performance_query, {**window["params"], **scope_params(scope)}
+    else:
+        window = window_params(months, "pt.purchase_date")
+        query, params = product_category_performance_query, window["params"]
+    async with read_session() as session:
+        data = await fetch_columns(
+            session, query.format(window_filter=window["window_filter"]), ["category", "total_revenue"], params
         )
-        return json.loads(fig.to_json())
-    finally:
-        await engine.dispose()
-        await connector.close_async()
-        print("[+] Resources Released....", end="\n\n")
-
-async def get_churn_risk():
-    engine, connector = await init_connection_pool()
-    try:
-        async with await get_db_session(engine) as session:
-            result = await session.execute(
-                text(
-                    "SELECT churn_risk_score, COUNT(*) as count FROM customer_360 GROUP BY churn_risk_score"
-                )
-            )
-            df = pd.DataFrame(
-                result.fetchall(), columns=["churn_risk_score", "count"]
+    return figure_json(product_category_performance_figure(data))
+
+async def get_customer_satisfaction(scope: Optional[Tuple[str, str]] = None) -> bytes:
+    async with read_session() as session:
+        if scope:
+            result = await session.execute(text(scope_satisfaction_query), scope_params(scope))
+        else:
+            result = await session.execute(text(customer_satisfaction_query))
+        avg_satisfaction = result.scalar()
+    return figure_json(customer_satisfaction_figure(avg_satisfaction))
+
+async def get_churn_risk(scope: Optional[Tuple[str, str]] = None) -> bytes:
+    async with read_session() as session:
+        if scope:
+            data = await fetch_columns(
+                session,
+                scope_dimension_query.format(dimension="churn_risk_score"),
+                ["churn_risk_score", "count"],
+                scope_params(scope),
             )
-            
-        fig = px.pie(
-            df, values="count", names="churn_risk_score", title="Churn Risk Distribution"
+        else:
+            data = await fetch_columns(session, churn_risk_query, ["churn_risk_score", "count"])
+    return figure_json(churn_risk_figure(data))
+
+async def get_rfm_segmentation(scope: Optional[Tuple[str, str]] = None) -> bytes:
+    query, params = (scope_rfm_segmentation_query, scope_params(scope)) if scope else (rfm_segmentation_query, {})
+    async with read_session() as session:
+        data = await fetch_columns(session, query, ["recency_score", "frequency_score", "monetary_score"], params)
+    return figure_json(rfm_segmentation_figure(data))
+
+async def get_cohort_retention(months: Optional[int] = None, scope: Optional[Tuple[str, str]] = None) -> bytes:
+    # reads the matrix precomputed by the CDP build, optionally only the cohorts of the last `months` months
+    if scope:
+        window = window_params(months, "cohort_month", "AND")
+        query, params = scope_cohort_retention_query, {**window["params"], **scope_params(scope)}
+    else:
+        window = window_params(months, "cohort_month")
+        query, params = cohort_retention_query, window["params"]
+    async with read_session() as session:
+        data = await fetch_columns(
+            session,
+            query.format(window_filter=window["window_filter"]),
+            ["cohort_month", "months_since", "cohort_size", "active_customers"],
+            params,
         )
-        return json.loads(fig.to_json())
-    finally:
-        await engine.dispose()
-        await connector.close_async()
-        print("[+] Resources Released....", end="\n\n")
-
-async def get_rfm_segmentation():
-    engine, connector = await init_connection_pool()
+    return figure_json(cohort_retention_figure(data))
+
+async def get_scopes() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    # the brand and category scopes aggregated by the latest CDP build, with their customers and revenue
+    global scopes, scopes_loaded_at
+    if scopes_loaded_at is None or time.monotonic() - scopes_loaded_at >= BUILD_VERSION_CHECK_SECONDS:
+        loaded = {scope_type: {} for scope_type in SCOPE_TYPES}
+        async with read_session() as session:
+            for row in (await session.execute(text(scopes_query))).mappings():
+                loaded[row["scope_type"]][row["scope"]] = {"customers": row["customers"], "revenue": row["revenue"]}
+        scopes, scopes_loaded_at = loaded, time.monotonic()
+    return scopes
+
+async def get_scope_kpis(scope: Tuple[str, str]) -> Dict[str, Any]:
+    # the KPIs of the customers of a scope, from the totals precomputed by the CDP build
+    async with read_session() as session:
+        row = (await session.execute(text(scope_kpis_query), scope_params(scope))).mappings().first()
+    if row is None:
+        return {"total_customers": 0, "total_lifetime_value": 0, "average_order_value": None, "retention_rate": None}
+    return {
+        "total_customers": row["customers"],
+        "total_lifetime_value": round(row["revenue"], 2),
+        "average_order_value": round(row["average_order_value"], 2),
+        "retention_rate": round(row["repeat_customers"] / row["customers"] * 100, 2),
+    }
+
+# Orders of the related products and brands of /product_affinity
+AFFINITY_SORTS = ("lift", "confidence", "support")
+
+async def get_product_affinity(product_id: int, limit: int = 10, sort: str = "lift") -> Optional[Dict[str, Any]]:
+    # the products and brands most bought by the customers of a product, None for an unknown product
+    if sort not in AFFINITY_SORTS:
+        raise ValueError(f"Unknown affinity sort {sort}")
+    async with read_session() as session:
+        product = (await session.execute(text(product_query), {"product_id": product_id})).mappings().first()
+        if product is None:
+            return None
+        params = {"product_id": product_id, "brand": product["brand"], "limit": limit}
+        related_products = await session.execute(text(related_products_query.format(order=sort)), params)
+        related_brands = await session.execute(text(related_brands_query.format(order=sort)), params)
+        return {
+            **product,
+            "related_products": [dict(row) for row in related_products.mappings()],
+            "related_brands": [dict(row) for row in related_brands.mappings()],
+        }
+
+async def ingest_events(event_type: str, events: List[Dict[str, Any]]):
+    global ingestion_log_ready
+    config = ingestion_queries[event_type]
+    # one array per column, the batch is written with a single INSERT ... SELECT FROM UNNEST(...)
+    params = {column: [event[column] for event in events] for column in config["columns"]}
+    params["customer_ids"] = sorted({event["customer_id"] for event in events})
+
+    async with write_session() as session:
+        if not ingestion_log_ready:
+            await session.execute(text(ingestion_log_init_query))
+            await session.commit()
+            ingestion_log_ready = True
+        # the insert and the customer_360 updates commit together, or not at all. The customers are logged first, a
+        # build being published holds the log locked and the batch waits for it before touching customer_360.
+        try:
+            await session.execute(text(log_customers_query), params)
+            for query in config["queries"]:
+                result = await session.execute(text(query), params)
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+
+    profile_cache.evict(params["customer_ids"])
+    return {
+        "event_type": event_type,
+        "events_ingested": len(events),
+        "customers_updated": result.rowcount,
+    }
+
+async def fetch_build_version(session) -> Optional[str]:
+    # the history table is created by the first build
+    if not (await session.execute(text("SELECT to_regclass('cdp_run_history') IS NOT NULL"))).scalar():
+        return None
+    return (await session.execute(text(build_version_query))).scalar()
+
+async def fetch_customer_profiles(session, customer_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    params = {"customer_ids": customer_ids, "limit": RECENT_ACTIVITY_LIMIT}
+    profiles = {}
+    for row in (await session.execute(text(customer_profiles_query), params)).mappings():
+        profiles[row["customer_id"]] = {**row, "recent_purchases": [], "recent_interactions": []}
+    for key, query in (("recent_purchases", recent_purchases_query), ("recent_interactions", recent_interactions_query)):
+        for row in (await session.execute(text(query), params)).mappings():
+            if row["customer_id"] in profiles:
+                profiles[row["customer_id"]][key].append({k: v for k, v in row.items() if k != "customer_id"})
+    return profiles
+
+async def current_build_version() -> Optional[str]:
+    # the latest build of customer_360, looked up at most every BUILD_VERSION_CHECK_SECONDS
+    if profile_cache.version_check_due():
+        async with read_session() as session:
+            profile_cache.set_build_version(await fetch_build_version(session))
+    return profile_cache.build_version
+
+async def shared_result_key(name: str, args: tuple) -> str:
+    return json.dumps([await current_build_version(), name, list(args)], default=str)
+
+async def get_shared_result(name: str, *args) -> Optional[bytes]:
+    # the serialized payload of `name` computed for the current build by any API process, None if there is none
+    if shared_cache is None:
+        return None
+    return await shared_cache.get(await shared_result_key(name, args))
+
+async def compute_shared_result(name: str, compute: Callable[..., Awaitable[Any]], *args) -> Any:
+    # computes the payload of `name` and shares it. Processes missing the same payload meanwhile wait for it instead,
+    # and get it serialized.
+    if shared_cache is None:
+        return await compute(*args)
+    return await shared_cache.get_or_compute(await shared_result_key(name, args), compute, encode_json, *args)
+
+async def get_customer_profiles(customer_ids: List[int]) -> Dict[int, Optional[Dict[str, Any]]]:
+    # customer_id -> profile, None for an unknown customer. Only the customers that aren't cached are read.
+    await current_build_version()
+
+    profiles = {customer_id: profile_cache.get(customer_id) for customer_id in customer_ids}
+    uncached = [customer_id for customer_id, profile in profiles.items() if profile is None]
+    if uncached:
+        build_version = profile_cache.build_version
+        async with read_session() as session:
+            fetched = await fetch_customer_profiles(session, uncached)
+        for customer_id in uncached:
+            profiles[customer_id] = fetched.get(customer_id, MISSING)
+            # a profile read while a newer build was detected may predate it
+            if profile_cache.build_version == build_version:
+                profile_cache.put(customer_id, profiles[customer_id])
+
+    return {customer_id: None if profile is MISSING else profile for customer_id, profile in profiles.items()}
+
+async def get_lookalike_index() -> LookalikeIndex:
+    global lookalike_index
+    build_version = await current_build_version()
+    if lookalike_index is None or lookalike_index.build_version != build_version:
+        # concurrent searches wait for a single rebuild
+        async with lookalike_index_lock:
+            if lookalike_index is None or lookalike_index.build_version != build_version:
+                async with read_session() as session:
+                    columns = await fetch_columns(
+                        session, lookalike_features_query, ["customer_id", *LOOKALIKE_FEATURES]
+                    )
+                features = np.empty((len(columns["customer_id"]), len(LOOKALIKE_FEATURES)))
+                for column, feature in enumerate(LOOKALIKE_FEATURES):
+                    # nulls come as None, NaN in the index
+                    features[:, column] = columns[feature].astype(np.float64)
+                lookalike_index = LookalikeIndex(columns["customer_id"], features, build_version)
+    return lookalike_index
+
+async def get_lookalikes(seed_ids: List[int], k: int) -> Dict[str, Any]:
+    index = await get_lookalike_index()
+    lookalikes, missing = index.search(seed_ids, k)
+    return {"build_version": index.build_version, "lookalikes": lookalikes, "missing": missing}
+
+async def execute_rebuild_query(query: str, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    async with write_session() as session:
+        await session.execute(text(rebuild_jobs_init_query))
+        result = await session.execute(text(query), params)
+        rows = [dict(row) for row in result.mappings()] if result.returns_rows else []
+        await session.commit()
+        return rows
+
+def rebuild_command(job: Dict[str, Any]) -> List[str]:
+    command = [sys.executable, "cdp_procedure.py", "--run-id", job["job_id"]]
+    if job["mode"] == "incremental":
+        command.append("--incremental")
+        if job["customer_ids"] is not None:
+            command += ["--customer-ids", ",".join(str(customer_id) for customer_id in job["customer_ids"])]
+        else:
+            command += ["--since", job["since"].isoformat()]
+    return command
+
+async def lock_rebuild_job(query: str, job_id: str):
+    global rebuild_lock_connection
+    if rebuild_lock_connection is None or rebuild_lock_connection.closed:
+        rebuild_lock_connection = await (await get_router()).primary.engine.connect()
+    await rebuild_lock_connection.execute(text(query), {"job_id": job_id})
+    await rebuild_lock_connection.commit()
+
+async def fail_orphaned_rebuild_jobs() -> List[str]:
+    # The queue only lives in the memory of its API process. Jobs that a stopped process had queued or was running
+    # would otherwise be reported as queued or running forever.
+    job_ids = [row["job_id"] for row in await execute_rebuild_query(fail_orphaned_rebuild_jobs_query, {})]
+    for job_id in job_ids:
+        print(f"[-] Rebuild job {job_id} failed, the API process that ran it stopped")
+    return job_ids
+
+async def run_rebuild_job(job: Dict[str, Any]):
+    await execute_rebuild_query(start_rebuild_job_query, {"job_id": job["job_id"]})
+    # the build runs in its own process, so it doesn't hold up the event loop of the API
     try:
-        async with await get_db_session(engine) as session:
-            result = await session.execute(
-                text( # changed to ensure always non-null values
-                    """SELECT recency_score, frequency_score, monetary_score 
-                    FROM customer_360
-                    WHERE recency_score IS NOT NULL 
-                    AND frequency_score IS NOT NULL 
-                    AND monetary_score IS NOT NULL;"""
-                )
-            )
-            df = pd.DataFrame(
-                result.fetchall(),
-                columns=["recency_score", "frequency_score", "monetary_score"],
-            )
-            
-        fig = px.scatter_3d(
-            df,
-            x="recency_score",
-            y="frequency_score",
-            z="monetary_score",
-            title="RFM Segmentation",
-            labels={
-                "recency_score": "Recency",
-                "frequency_score": "Frequency",
-                "monetary_score": "Monetary",
-            },
+        process = await asyncio.create_subprocess_exec(
+            *rebuild_command(job),
+            cwd=CDP_DIR,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
         )
-        return json.loads(fig.to_json())
-    finally:
-        await engine.dispose()
-        await connector.close_async()
-        print("[+] Resources Released....", end="\n\n")
+        output, _ = await process.communicate()
+        exit_code = process.returncode
+        output = "\n".join(output.decode(errors="replace").splitlines()[-REBUILD_OUTPUT_LINES:])
+    except Exception as e:
+        exit_code, output = None, f"Unable to start the build: {e}"
+
+    await execute_rebuild_query(
+        finish_rebuild_job_query,
+        {
+            "job_id": job["job_id"],
+            "status": "success" if exit_code == 0 else "failed",
+            "exit_code": exit_code,
+            "output": output,
+        },
+    )
+    print(f"[+] Rebuild job {job['job_id']} finished with exit code {exit_code}")
+
+async def process_rebuild_jobs():
+    global queued_full_rebuild
+    while True:
+        job = await rebuild_queue.get()
+        if job is queued_full_rebuild:
+            queued_full_rebuild = None
+        try:
+            await run_rebuild_job(job)
+        except Exception as e:
+            print(f"[-] Rebuild job {job['job_id']} failed: {e}")
+        try:
+            await lock_rebuild_job(unlock_rebuild_job_query, job["job_id"])
+        except Exception as e:
+            print(f"[-] Unable to release the lock of rebuild job {job['job_id']}: {e}")
+        rebuild_queue.task_done()
+
+async def enqueue_rebuild(
+    mode: str, customer_ids: Optional[List[int]] = None, since: Optional[date] = None
+) -> Dict[str, Any]:
+    global rebuild_queue, rebuild_worker, queued_full_rebuild
+    if rebuild_queue is None:
+        rebuild_queue = asyncio.Queue()
+    if rebuild_worker is None or rebuild_worker.done():
+        rebuild_worker = asyncio.create_task(process_rebuild_jobs())
+
+    if mode == "full" and queued_full_rebuild is not None:
+        return queued_full_rebuild["created"]
+
+    job = {"job_id": uuid.uuid4().hex, "mode": mode, "customer_ids": customer_ids, "since": since}
+    # locked before it exists, so that no other process takes it for a job left behind
+    await lock_rebuild_job(lock_rebuild_job_query, job["job_id"])
+    (job["created"],) = await execute_rebuild_query(insert_rebuild_job_query, job)
+    if mode == "full":
+        queued_full_rebuild = job
+    await rebuild_queue.put(job)
+    return job["created"]
+
+async def get_rebuild_job(job_id: str) -> Optional[Dict[str, Any]]:
+    # read from the primary, a replica may not have caught up with the latest job updates yet
+    async with write_session() as session:
+        await session.execute(text(rebuild_jobs_init_query))
+        job = (await session.execute(text(rebuild_job_query), {"job_id": job_id})).mappings().first()
+        if job is None:
+            return None
+        job = dict(job)
+        # stages are recorded by the build as they finish, the history table is created by the first build
+        history_exists = (await session.execute(text("SELECT to_regclass('cdp_run_history') IS NOT NULL"))).scalar()
+        stages = (
+            (await session.execute(text(rebuild_job_stages_query), {"job_id": job_id})).mappings().all()
+            if history_exists
+            else []
+        )
+        await session.commit()
+    job["stages"] = [dict(stage) for stage in stages]
+    job["stages_completed"] = sum(stage["status"] == "success" for stage in stages)
+    return job
+
+def get_snapshot_manifest(run_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    # the manifest of the customer_360 snapshot of a build, of the latest one by default. None when there is none.
+    if not SNAPSHOT_DIR:
+        return None
+    try:
+        if run_id is None:
+            with open(os.path.join(SNAPSHOT_DIR, "LATEST")) as f:
+                run_id = f.read().strip()
+        # run ids are file names, never paths
+        if os.path.basename(run_id) != run_id or run_id.startswith("."):
+            return None
+        with open(os.path.join(SNAPSHOT_DIR, run_id, "manifest.json"), "rb") as f:
+            manifest = orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+    for file in manifest["files"]:
+        file["url"] = f"/exports/customer_360/{run_id}/{file['file']}"
+    return manifest
+
+def get_snapshot_file(run_id: str, file_name: str) -> Optional[Dict[str, Any]]:
+    # the path and media type of a file of a snapshot, only files listed in its manifest are served
+    manifest = get_snapshot_manifest(run_id)
+    if manifest is None:
+        return None
+    for file in manifest["files"]:
+        if file["file"] == file_name:
+            return {
+                "path": os.path.join(SNAPSHOT_DIR, run_id, file_name),
+                "media_type": SNAPSHOT_MEDIA_TYPES[file["format"]],
+            }
+    return None
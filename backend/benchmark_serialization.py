@@ -0,0 +1,156 @@
+import json
+import time
+import asyncio
+import argparse
+import statistics
+from typing import Any, Awaitable, Callable, Dict, List
+
+import pandas as pd
+from colorama import Fore, Style
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.sql import text
+
+import backend_logic
+import db_routing
+from dashboard_queries import (
+    customer_segments_query,
+    monthly_revenue_query,
+    top_customers_query,
+    product_category_performance_query,
+    customer_satisfaction_query,
+    churn_risk_query,
+    rfm_segmentation_query,
+    cohort_retention_query,
+)
+
+# Micro-benchmark of the response path of the dashboard endpoints, against the database of DATABASE_URL. For every
+# endpoint it times the previous path (rows -> pandas DataFrame -> Plotly figure -> json.loads(fig.to_json()) ->
+# JSONResponse, or jsonable_encoder for plain records) against the current one (column arrays aggregated by postgres
+# -> Plotly figure -> pre-encoded orjson bytes), from the query to the response body.
+
+
+async def previous_chart(query: str, columns: List[str], figure: Callable, params: Dict[str, Any] = None) -> bytes:
+    async with db_routing.read_session() as session:
+        result = await session.execute(text(query), params or {})
+        df = pd.DataFrame(result.fetchall(), columns=columns)
+    return JSONResponse(content=json.loads(figure(df).to_json())).body
+
+
+async def previous_top_customers() -> bytes:
+    async with db_routing.read_session() as session:
+        result = await session.execute(text(top_customers_query))
+        df = pd.DataFrame(
+            result.fetchall(), columns=["customer_id", "first_name", "last_name", "total_lifetime_value"]
+        )
+    return JSONResponse(content=jsonable_encoder(df.to_dict(orient="records"))).body
+
+
+async def previous_customer_satisfaction() -> bytes:
+    async with db_routing.read_session() as session:
+        avg_satisfaction = (await session.execute(text(customer_satisfaction_query))).scalar()
+    fig = backend_logic.customer_satisfaction_figure(avg_satisfaction)
+    return JSONResponse(content=json.loads(fig.to_json())).body
+
+
+def current(get_payload: Callable[..., Awaitable[Any]], *args) -> Callable[[], Awaitable[bytes]]:
+    async def run():
+        return backend_logic.encode_json(await get_payload(*args))
+
+    return run
+
+
+def endpoints() -> Dict[str, tuple]:
+    # endpoint -> (previous path, current path)
+    return {
+        "customer_segments": (
+            lambda: previous_chart(
+                customer_segments_query, ["customer_segment", "count"], backend_logic.customer_segments_figure
+            ),
+            current(backend_logic.get_customer_segments),
+        ),
+        "monthly_revenue": (
+            lambda: previous_chart(
+                monthly_revenue_query.format(window_filter=""), ["month", "revenue"], backend_logic.monthly_revenue_figure
+            ),
+            current(backend_logic.get_monthly_revenue),
+        ),
+        "top_customers": (previous_top_customers, current(backend_logic.get_top_customers)),
+        "product_category_performance": (
+            lambda: previous_chart(
+                product_category_performance_query.format(window_filter=""),
+                ["category", "total_revenue"],
+                backend_logic.product_category_performance_figure,
+            ),
+            current(backend_logic.get_product_category_performance),
+        ),
+        "customer_satisfaction": (previous_customer_satisfaction, current(backend_logic.get_customer_satisfaction)),
+        "churn_risk": (
+            lambda: previous_chart(churn_risk_query, ["churn_risk_score", "count"], backend_logic.churn_risk_figure),
+            current(backend_logic.get_churn_risk),
+        ),
+        "rfm_segmentation": (
+            lambda: previous_chart(
+                rfm_segmentation_query,
+                ["recency_score", "frequency_score", "monetary_score"],
+                backend_logic.rfm_segmentation_figure,
+            ),
+            current(backend_logic.get_rfm_segmentation),
+        ),
+        "cohort_retention": (
+            lambda: previous_chart(
+                cohort_retention_query.format(window_filter=""),
+                ["cohort_month", "months_since", "cohort_size", "active_customers"],
+                backend_logic.cohort_retention_figure,
+            ),
+            current(backend_logic.get_cohort_retention),
+        ),
+    }
+
+
+async def compare(previous: Callable[[], Awaitable[bytes]], current_path: Callable[[], Awaitable[bytes]], repeat: int):
+    # median durations and response sizes of both paths, after a warm up call of each. The calls alternate, so
+    # that load and cache effects hit both alike.
+    durations = {previous: [], current_path: []}
+    sizes = {path: len(await path()) for path in durations}
+    for _ in range(repeat):
+        for path in durations:
+            start = time.perf_counter()
+            await path()
+            durations[path].append((time.perf_counter() - start) * 1000)
+    return [(statistics.median(durations[path]), sizes[path]) for path in (previous, current_path)]
+
+
+async def main(args):
+    report = {}
+    print(f"{'endpoint':30} {'previous':>10} {'current':>10} {'speedup':>8} {'bytes':>10}")
+    try:
+        for endpoint, (previous, current_path) in endpoints().items():
+            (previous_ms, previous_bytes), (current_ms, current_bytes) = await compare(
+                previous, current_path, args.repeat
+            )
+            speedup = previous_ms / current_ms if current_ms else float("inf")
+            color = Fore.GREEN if speedup >= 1 else Fore.RED
+            print(
+                f"{endpoint:30} {previous_ms:8.1f}ms {current_ms:8.1f}ms "
+                f"{color}{speedup:7.2f}x{Style.RESET_ALL} {current_bytes:10}"
+            )
+            report[endpoint] = {
+                "previous_ms": round(previous_ms, 2),
+                "current_ms": round(current_ms, 2),
+                "previous_bytes": previous_bytes,
+                "current_bytes": current_bytes,
+            }
+    finally:
+        await db_routing.dispose_pools()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the previous and current response path of every endpoint.")
+    parser.add_argument("--repeat", type=int, default=10, help="timed calls per endpoint and path")
+    parser.add_argument("--output", default=None, help="also write the medians to this JSON file")
+    asyncio.run(main(parser.parse_args()))
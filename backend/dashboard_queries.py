@@ -0,0 +1,121 @@
+# Queries of the dashboard charts of `backend_logic.py`. {window_filter} is either empty or a bound on the partition
+# key of purchase_transactions, which lets postgres prune every monthly partition outside the window.
+
+customer_segments_query = """SELECT customer_segment, COUNT(*) AS count
+FROM customer_360
+GROUP BY customer_segment"""
+
+monthly_revenue_query = """SELECT DATE_TRUNC('month', purchase_date) AS month, SUM(total_amount) AS revenue
+FROM purchase_transactions
+{window_filter}
+GROUP BY month
+ORDER BY month"""
+
+# some values in customer_360 are null
+top_customers_query = """SELECT customer_id, first_name, last_name, total_lifetime_value
+FROM customer_360
+WHERE total_lifetime_value IS NOT NULL
+ORDER BY total_lifetime_value DESC
+LIMIT 5"""
+
+product_category_performance_query = """SELECT pc.category, SUM(pt.total_amount) AS total_revenue
+FROM purchase_transactions pt
+JOIN product_catalog pc ON pt.product_id = pc.product_id
+{window_filter}
+GROUP BY pc.category
+ORDER BY total_revenue DESC"""
+
+customer_satisfaction_query = """SELECT AVG(average_satisfaction_score) AS avg_satisfaction
+FROM customer_360"""
+
+churn_risk_query = """SELECT churn_risk_score, COUNT(*) AS count
+FROM customer_360
+GROUP BY churn_risk_score"""
+
+# only customers with all three scores
+rfm_segmentation_query = """SELECT recency_score, frequency_score, monetary_score
+FROM customer_360
+WHERE recency_score IS NOT NULL
+AND frequency_score IS NOT NULL
+AND monetary_score IS NOT NULL"""
+
+# the matrix precomputed by the CDP build, {window_filter} keeps the cohorts of the last months
+cohort_retention_query = """SELECT cohort_month, months_since, cohort_size, active_customers
+FROM cohort_retention
+{window_filter}
+ORDER BY cohort_month, months_since"""
+
+product_query = """SELECT product_id, product_name, category, brand
+FROM product_catalog
+WHERE product_id = :product_id"""
+
+# the pairs of a product precomputed by the CDP build, read from the primary key index. {order} is one of support,
+# confidence or lift
+related_products_query = """SELECT pa.related_product_id AS product_id, pc.product_name, pc.category, pc.brand,
+    pa.customers, pa.support, pa.confidence, pa.lift
+FROM product_affinity pa
+JOIN product_catalog pc ON pc.product_id = pa.related_product_id
+WHERE pa.product_id = :product_id
+ORDER BY pa.{order} DESC, pa.related_product_id
+LIMIT :limit"""
+
+related_brands_query = """SELECT related_brand AS brand, customers, support, confidence, lift
+FROM brand_affinity
+WHERE brand = :brand
+ORDER BY {order} DESC, related_brand
+LIMIT :limit"""
+
+# Queries of the brand and category scoped dashboards, over the per-scope aggregates of the CDP build. Their
+# {window_filter} is either empty or an AND bound on the month of the aggregates.
+scope_condition = "scope_type = :scope_type AND scope = :scope"
+
+scopes_query = """SELECT scope_type, scope, customers, revenue
+FROM scope_metrics
+WHERE dimension = 'total'
+ORDER BY scope_type, revenue DESC"""
+
+scope_kpis_query = f"""SELECT customers, revenue, average_order_value, repeat_customers
+FROM scope_metrics
+WHERE {scope_condition} AND dimension = 'total'"""
+
+# {dimension} is customer_segment or churn_risk_score
+scope_dimension_query = f"""SELECT dimension_value AS {{dimension}}, customers AS count
+FROM scope_metrics
+WHERE {scope_condition} AND dimension = '{{dimension}}'"""
+
+scope_satisfaction_query = f"""SELECT average_satisfaction_score
+FROM scope_metrics
+WHERE {scope_condition} AND dimension = 'total'"""
+
+scope_monthly_revenue_query = f"""SELECT month, SUM(revenue) AS revenue
+FROM scope_revenue
+WHERE {scope_condition} {{window_filter}}
+GROUP BY month
+ORDER BY month"""
+
+scope_category_performance_query = f"""SELECT category, SUM(revenue) AS total_revenue
+FROM scope_revenue
+WHERE {scope_condition} {{window_filter}}
+GROUP BY category
+ORDER BY total_revenue DESC"""
+
+# the lifetime value of a customer in a scope is their revenue in it
+scope_top_customers_query = """SELECT sc.customer_id, c.first_name, c.last_name, sc.revenue AS total_lifetime_value
+FROM scope_customers sc
+JOIN customer_360 c ON c.customer_id = sc.customer_id
+WHERE sc.scope_type = :scope_type AND sc.scope = :scope
+ORDER BY sc.revenue DESC
+LIMIT 5"""
+
+scope_rfm_segmentation_query = """SELECT c.recency_score, c.frequency_score, c.monetary_score
+FROM scope_customers sc
+JOIN customer_360 c ON c.customer_id = sc.customer_id
+WHERE sc.scope_type = :scope_type AND sc.scope = :scope
+AND c.recency_score IS NOT NULL
+AND c.frequency_score IS NOT NULL
+AND c.monetary_score IS NOT NULL"""
+
+scope_cohort_retention_query = f"""SELECT cohort_month, months_since, cohort_size, active_customers
+FROM scope_cohort_retention
+WHERE {scope_condition} {{window_filter}}
+ORDER BY cohort_month, months_since"""
@@ -0,0 +1,211 @@
+# Queries used by `backend_logic.ingest_events()`. Each event type writes the whole batch with a single
+# INSERT ... SELECT FROM UNNEST(<column arrays>) and then brings the affected customer_360 rows up to date in the
+# same transaction. Aggregates that can be maintained from the batch alone (sums, counts, running averages, latest
+# dates) are applied as deltas, the ones that can't (distinct counts, most recent/most frequent values) are
+# recomputed for the affected customers only, through the customer_id indexes of the source tables.
+#
+# Batches of the same customer can run concurrently. Deltas are applied to the customer_360 row being updated, which
+# postgres re-reads once a concurrent batch committed, never to values read earlier in the statement. Recomputed
+# aggregates read the source tables, the batch first locks the customer_360 rows of its customers (in customer_id
+# order, so that batches don't deadlock) and its recomputation then sees every batch committed before.
+#
+# Every batch also records its customers in customer_360_ingestion_log, under the id of its transaction. A full build
+# reads the source tables from one snapshot and, before it replaces customer_360, rebuilds the customers of the
+# batches that snapshot doesn't see (cdp/cdp_procedure.py). Batches wait on the lock of the log while it does.
+#
+# The "most frequent" columns that depend on purchases (favorite category/brand) are left to the next CDP build.
+
+lock_customers_query = """SELECT customer_id
+FROM customer_360
+WHERE customer_id = ANY(CAST(:customer_ids AS INTEGER[]))
+ORDER BY customer_id
+FOR UPDATE;"""
+
+ingestion_log_init_query = """CREATE TABLE IF NOT EXISTS customer_360_ingestion_log (
+    customer_id INTEGER NOT NULL,
+    xact_id XID8 NOT NULL DEFAULT pg_current_xact_id()
+);"""
+
+log_customers_query = """INSERT INTO customer_360_ingestion_log (customer_id)
+SELECT UNNEST(CAST(:customer_ids AS INTEGER[]));"""
+
+ingestion_queries = {
+    "purchases": {
+        "columns": {
+            "customer_id": "INTEGER",
+            "product_id": "INTEGER",
+            "purchase_date": "DATE",
+            "quantity": "INTEGER",
+            "total_amount": "REAL",
+            "store_id": "INTEGER",
+        },
+        "queries": [
+            """WITH inserted AS (
+                INSERT INTO purchase_transactions (customer_id, product_id, purchase_date, quantity, total_amount, store_id)
+                SELECT * FROM UNNEST(
+                    CAST(:customer_id AS INTEGER[]), CAST(:product_id AS INTEGER[]), CAST(:purchase_date AS DATE[]),
+                    CAST(:quantity AS INTEGER[]), CAST(:total_amount AS REAL[]), CAST(:store_id AS INTEGER[])
+                )
+                RETURNING customer_id, purchase_date, total_amount
+            ), delta AS (
+                SELECT customer_id, SUM(total_amount) AS amount, COUNT(*) AS purchases, MAX(purchase_date) AS last_purchase_date
+                FROM inserted
+                GROUP BY customer_id
+            )
+            UPDATE customer_360 c SET
+                total_lifetime_value = COALESCE(c.total_lifetime_value, 0) + d.amount,
+                total_purchases = COALESCE(c.total_purchases, 0) + d.purchases,
+                last_purchase_date = GREATEST(c.last_purchase_date, d.last_purchase_date),
+                average_order_value = (COALESCE(c.total_lifetime_value, 0) + d.amount)
+                    / (COALESCE(c.total_purchases, 0) + d.purchases),
+                customer_segment = CASE
+                    WHEN COALESCE(c.total_lifetime_value, 0) + d.amount > 1000 THEN 'High Value'
+                    WHEN COALESCE(c.total_lifetime_value, 0) + d.amount > 500 THEN 'Medium Value'
+                    ELSE 'Low Value'
+                END,
+                recency_score = CURRENT_DATE - GREATEST(c.last_purchase_date, d.last_purchase_date),
+                frequency_score = COALESCE(c.total_purchases, 0) + d.purchases,
+                monetary_score = COALESCE(c.total_lifetime_value, 0) + d.amount,
+                churn_risk_score = CASE
+                    WHEN CURRENT_DATE - GREATEST(c.last_purchase_date, d.last_purchase_date) > 180 THEN 'High'
+                    WHEN CURRENT_DATE - GREATEST(c.last_purchase_date, d.last_purchase_date) > 90 THEN 'Medium'
+                    ELSE 'Low'
+                END
+            FROM delta d
+            WHERE c.customer_id = d.customer_id;""",
+        ],
+    },
+    "service_interactions": {
+        "columns": {
+            "customer_id": "INTEGER",
+            "interaction_date": "DATE",
+            "interaction_type": "TEXT",
+            "product_id": "INTEGER",
+            "resolution_status": "TEXT",
+            "satisfaction_score": "INTEGER",
+        },
+        "queries": [
+            lock_customers_query,
+            """INSERT INTO customer_service (customer_id, interaction_date, interaction_type, product_id, resolution_status, satisfaction_score)
+            SELECT * FROM UNNEST(
+                CAST(:customer_id AS INTEGER[]), CAST(:interaction_date AS DATE[]), CAST(:interaction_type AS TEXT[]),
+                CAST(:product_id AS INTEGER[]), CAST(:resolution_status AS TEXT[]), CAST(:satisfaction_score AS INTEGER[])
+            );""",
+            # website behaviour is only part of the engagement profile of customers with service interactions, so a
+            # customer's first interaction also brings in their website aggregates, like the full build does
+            """WITH engagement AS (
+                SELECT
+                    customer_id,
+                    MAX(interaction_date) AS last_interaction_date,
+                    (ARRAY_AGG(interaction_type ORDER BY interaction_date DESC))[1] AS last_interaction_type,
+                    AVG(satisfaction_score) AS average_satisfaction_score
+                FROM customer_service
+                WHERE customer_id = ANY(CAST(:customer_ids AS INTEGER[]))
+                GROUP BY customer_id
+            ), website AS (
+                SELECT
+                    wb.customer_id,
+                    COUNT(DISTINCT wb.session_id) AS total_website_visits,
+                    AVG(wb.time_spent) AS average_time_spent_on_site,
+                    MODE() WITHIN GROUP (ORDER BY pc.category) AS most_viewed_product_category
+                FROM website_behavior wb
+                LEFT JOIN product_catalog pc ON wb.pages_viewed = pc.product_id
+                WHERE wb.customer_id = ANY(CAST(:customer_ids AS INTEGER[]))
+                GROUP BY wb.customer_id
+            )
+            UPDATE customer_360 c SET
+                last_interaction_date = e.last_interaction_date,
+                last_interaction_type = e.last_interaction_type,
+                average_satisfaction_score = e.average_satisfaction_score,
+                total_website_visits = w.total_website_visits,
+                average_time_spent_on_site = w.average_time_spent_on_site,
+                most_viewed_product_category = w.most_viewed_product_category
+            FROM engagement e
+            LEFT JOIN website w ON e.customer_id = w.customer_id
+            WHERE c.customer_id = e.customer_id;""",
+        ],
+    },
+    "web_sessions": {
+        "columns": {
+            "customer_id": "INTEGER",
+            "visit_date": "DATE",
+            "pages_viewed": "INTEGER",
+            "time_spent": "INTEGER",
+            "source": "TEXT",
+        },
+        "queries": [
+            lock_customers_query,
+            # the most viewed category is recomputed. The rows inserted by the statement aren't visible to its own scan
+            # of website_behavior, they are added to it.
+            """WITH inserted AS (
+                INSERT INTO website_behavior (customer_id, visit_date, pages_viewed, time_spent, source)
+                SELECT * FROM UNNEST(
+                    CAST(:customer_id AS INTEGER[]), CAST(:visit_date AS DATE[]), CAST(:pages_viewed AS INTEGER[]),
+                    CAST(:time_spent AS INTEGER[]), CAST(:source AS TEXT[])
+                )
+                RETURNING customer_id, pages_viewed, time_spent
+            ), delta AS (
+                SELECT customer_id, COUNT(*) AS visits, SUM(time_spent) AS time_spent
+                FROM inserted
+                GROUP BY customer_id
+            ), categories AS (
+                SELECT v.customer_id, MODE() WITHIN GROUP (ORDER BY pc.category) AS most_viewed_product_category
+                FROM (
+                    SELECT customer_id, pages_viewed
+                    FROM website_behavior
+                    WHERE customer_id = ANY(CAST(:customer_ids AS INTEGER[]))
+                    UNION ALL
+                    SELECT customer_id, pages_viewed FROM inserted
+                ) v
+                JOIN product_catalog pc ON v.pages_viewed = pc.product_id
+                GROUP BY v.customer_id
+            )
+            UPDATE customer_360 c SET
+                total_website_visits = COALESCE(c.total_website_visits, 0) + d.visits,
+                average_time_spent_on_site = (
+                    COALESCE(c.average_time_spent_on_site * c.total_website_visits, 0) + d.time_spent
+                ) / (COALESCE(c.total_website_visits, 0) + d.visits),
+                most_viewed_product_category = v.most_viewed_product_category
+            FROM delta d
+            LEFT JOIN categories v ON v.customer_id = d.customer_id
+            WHERE c.customer_id = d.customer_id
+              AND c.last_interaction_date IS NOT NULL;""",
+        ],
+    },
+    "campaign_responses": {
+        "columns": {
+            "campaign_id": "INTEGER",
+            "customer_id": "INTEGER",
+            "response_date": "DATE",
+            "response_type": "TEXT",
+        },
+        "queries": [
+            lock_customers_query,
+            """INSERT INTO campaign_responses (campaign_id, customer_id, response_date, response_type)
+            SELECT * FROM UNNEST(
+                CAST(:campaign_id AS INTEGER[]), CAST(:customer_id AS INTEGER[]), CAST(:response_date AS DATE[]),
+                CAST(:response_type AS TEXT[])
+            );""",
+            # the response rate is divided by the number of distinct campaigns, which can't be maintained as a delta
+            """WITH responses AS (
+                SELECT
+                    cr.customer_id,
+                    COALESCE(
+                        CAST(SUM(CASE WHEN cr.response_type IN ('click', 'purchase') THEN 1 ELSE 0 END) AS FLOAT) /
+                        NULLIF(COUNT(DISTINCT cr.campaign_id), 0),
+                        0
+                    ) AS campaign_response_rate,
+                    MODE() WITHIN GROUP (ORDER BY mc.channel) AS preferred_marketing_channel
+                FROM campaign_responses cr
+                LEFT JOIN marketing_campaigns mc ON cr.campaign_id = mc.campaign_id
+                WHERE cr.customer_id = ANY(CAST(:customer_ids AS INTEGER[]))
+                GROUP BY cr.customer_id
+            )
+            UPDATE customer_360 c SET
+                campaign_response_rate = r.campaign_response_rate,
+                preferred_marketing_channel = r.preferred_marketing_channel
+            FROM responses r
+            WHERE c.customer_id = r.customer_id;""",
+        ],
+    },
+}
@@ -0,0 +1,105 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Lookalike search over the customers of customer_360: the customers nearest to the centroid of a set of seed customers,
+# by euclidean distance over their RFM and engagement features. The index is a float32 matrix of the features of every
+# customer, standardized so that each feature weighs the same: skewed counts and amounts are log scaled first, and a
+# missing value (a customer without purchases, visits or interactions) counts as the average one. It is built from a
+# build of customer_360 and rebuilt with the next one.
+#
+# A search scans the matrix in batches of LOOKALIKE_BATCH_ROWS customers, one matrix-vector product each, keeping only
+# the nearest customers of every batch. Memory of a search stays bounded however many customers there are.
+
+LOOKALIKE_FEATURES = [
+    "recency_score",
+    "frequency_score",
+    "monetary_score",
+    "total_lifetime_value",
+    "total_purchases",
+    "average_order_value",
+    "average_satisfaction_score",
+    "total_website_visits",
+    "average_time_spent_on_site",
+    "campaign_response_rate",
+]
+
+# Features scaled by log(1 + x) before standardization, their long tail would otherwise outweigh the other features
+LOG_SCALED_FEATURES = {
+    "total_lifetime_value",
+    "total_purchases",
+    "average_order_value",
+    "total_website_visits",
+    "average_time_spent_on_site",
+}
+
+LOOKALIKE_BATCH_ROWS = int(os.environ.get("LOOKALIKE_BATCH_ROWS", 65536))
+
+lookalike_features_query = """SELECT customer_id, {features}
+FROM customer_360
+ORDER BY customer_id""".format(features=", ".join(f"CAST({feature} AS DOUBLE PRECISION)" for feature in LOOKALIKE_FEATURES))
+
+
+class LookalikeIndex:
+    def __init__(self, customer_ids: np.ndarray, features: np.ndarray, build_version: Optional[str] = None):
+        # `features` holds one row per customer and one column per LOOKALIKE_FEATURES, NaN for a missing value
+        self.build_version = build_version
+        customer_ids = np.asarray(customer_ids, dtype=np.int64)
+        features = np.array(features, dtype=np.float64).reshape(len(customer_ids), len(LOOKALIKE_FEATURES))
+        # sorted by customer id, a customer is found by binary search
+        order = np.argsort(customer_ids, kind="stable")
+        self.customer_ids, features = customer_ids[order], features[order]
+        for column, feature in enumerate(LOOKALIKE_FEATURES):
+            if feature in LOG_SCALED_FEATURES:
+                features[:, column] = np.log1p(np.maximum(features[:, column], 0))
+        with np.errstate(invalid="ignore"):
+            self.mean = np.nan_to_num(np.nanmean(features, axis=0)) if len(features) else np.zeros(features.shape[1])
+            std = np.nan_to_num(np.nanstd(features, axis=0)) if len(features) else np.ones(features.shape[1])
+        self.std = np.where(std > 0, std, 1.0)
+        self.vectors = np.nan_to_num((features - self.mean) / self.std).astype(np.float32)
+        self.squared_norms = np.einsum("ij,ij->i", self.vectors, self.vectors)
+
+    def __len__(self) -> int:
+        return len(self.customer_ids)
+
+    def position(self, customer_id: int) -> Optional[int]:
+        position = int(np.searchsorted(self.customer_ids, customer_id))
+        if position < len(self) and self.customer_ids[position] == customer_id:
+            return position
+        return None
+
+    def search(self, seed_ids: List[int], k: int) -> Tuple[List[Dict[str, float]], List[int]]:
+        # the k customers nearest to the centroid of the known seeds, seeds excluded, and the unknown seeds
+        positions = {seed_id: self.position(seed_id) for seed_id in seed_ids}
+        seeds = [position for position in positions.values() if position is not None]
+        missing = [seed_id for seed_id, position in positions.items() if position is None]
+        if not seeds:
+            return [], missing
+        centroid = self.vectors[seeds].mean(axis=0)
+        excluded = np.zeros(len(self), dtype=bool)
+        excluded[seeds] = True
+        wanted = k + len(seeds)
+
+        candidates, distances = [], []
+        for start in range(0, len(self), LOOKALIKE_BATCH_ROWS):
+            end = min(start + LOOKALIKE_BATCH_ROWS, len(self))
+            # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, the last term is the same for every customer
+            batch = self.squared_norms[start:end] - 2 * (self.vectors[start:end] @ centroid)
+            if end - start > wanted:
+                nearest = np.argpartition(batch, wanted)[:wanted]
+            else:
+                nearest = np.arange(end - start)
+            candidates.append(nearest + start)
+            distances.append(batch[nearest])
+        candidates = np.concatenate(candidates)
+        distances = np.concatenate(distances)
+        keep = ~excluded[candidates]
+        candidates, distances = candidates[keep], distances[keep]
+        nearest = candidates[np.argsort(distances, kind="stable")[:k]]
+        # the expanded form loses float32 precision, the distances of the nearest are computed directly
+        distances = np.linalg.norm(self.vectors[nearest] - centroid, axis=1)
+        return [
+            {"customer_id": int(customer_id), "distance": round(float(distance), 4)}
+            for customer_id, distance in zip(self.customer_ids[nearest], distances)
+        ], missing
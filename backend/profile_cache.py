@@ -0,0 +1,57 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional
+
+# Size bounded LRU cache of customer profiles, shared by the requests of an API process. Entries belong to a build of
+# customer_360: when a newer build shows up in cdp_run_history the whole cache is dropped. Events ingested through
+# this process evict the profiles of their customers right away. Profiles updated by another API process are picked
+# up with the next build at the latest.
+
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 100000))
+
+# The build version is looked up at most this often
+BUILD_VERSION_CHECK_SECONDS = 5
+
+# Cached value of a customer that doesn't exist, told apart from a key that isn't cached
+MISSING = object()
+
+
+class ProfileCache:
+    def __init__(self, maxsize: int = PROFILE_CACHE_SIZE, check_interval: float = BUILD_VERSION_CHECK_SECONDS):
+        self.maxsize = maxsize
+        self.check_interval = check_interval
+        self.entries: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.build_version: Optional[str] = None
+        self.checked_at: Optional[float] = None
+        self.hits = 0
+        self.misses = 0
+
+    def version_check_due(self) -> bool:
+        return self.checked_at is None or time.monotonic() - self.checked_at >= self.check_interval
+
+    def set_build_version(self, build_version: Optional[str]):
+        if build_version != self.build_version:
+            self.entries.clear()
+            self.build_version = build_version
+        self.checked_at = time.monotonic()
+
+    def get(self, key: Hashable) -> Any:
+        # the cached value, MISSING for a known unknown customer, None when the key isn't cached
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def evict(self, keys: Iterable[Hashable]):
+        for key in keys:
+            self.entries.pop(key, None)
@@ -0,0 +1,32 @@
+# Queries used by `backend_logic.get_customer_profiles()`. A batch of customers is read with one statement per table:
+# customer_360 rows through its primary key, and the latest purchases and interactions of every customer through the
+# (customer_id, date) indexes, a LATERAL subquery per customer reads only the first rows of its index range.
+
+customer_profiles_query = """SELECT *
+FROM customer_360
+WHERE customer_id = ANY(CAST(:customer_ids AS INTEGER[]));"""
+
+recent_purchases_query = """SELECT ids.customer_id, p.transaction_id, p.product_id, p.purchase_date, p.quantity, p.total_amount, p.store_id
+FROM unnest(CAST(:customer_ids AS INTEGER[])) AS ids (customer_id)
+CROSS JOIN LATERAL (
+    SELECT * FROM purchase_transactions pt
+    WHERE pt.customer_id = ids.customer_id
+    ORDER BY pt.purchase_date DESC
+    LIMIT :limit
+) p;"""
+
+recent_interactions_query = """SELECT ids.customer_id, s.interaction_id, s.interaction_date, s.interaction_type, s.product_id, s.resolution_status, s.satisfaction_score
+FROM unnest(CAST(:customer_ids AS INTEGER[])) AS ids (customer_id)
+CROSS JOIN LATERAL (
+    SELECT * FROM customer_service cs
+    WHERE cs.customer_id = ids.customer_id
+    ORDER BY cs.interaction_date DESC
+    LIMIT :limit
+) s;"""
+
+# The version of customer_360 is the run id of the latest successful build (full or incremental)
+build_version_query = """SELECT run_id
+FROM cdp_run_history
+WHERE stage = 'total' AND status = 'success'
+ORDER BY finished_at DESC
+LIMIT 1;"""
@@ -0,0 +1,49 @@
+# Queries used by the customer_360 rebuild jobs of `backend_logic.py`. A job is a run of `cdp/cdp_procedure.py` by the
+# rebuild worker, the job id is the run id of the build, so the stages of a running build can be followed in
+# cdp_run_history where the build records them as they finish.
+
+rebuild_jobs_init_query = """CREATE TABLE IF NOT EXISTS cdp_rebuild_jobs (
+    job_id TEXT PRIMARY KEY,
+    mode TEXT NOT NULL,
+    customer_ids INTEGER[],
+    since DATE,
+    status TEXT NOT NULL DEFAULT 'queued',
+    requested_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    exit_code INTEGER,
+    output TEXT
+);"""
+
+insert_rebuild_job_query = """INSERT INTO cdp_rebuild_jobs (job_id, mode, customer_ids, since)
+VALUES (:job_id, :mode, :customer_ids, :since)
+RETURNING job_id, mode, status, requested_at;"""
+
+start_rebuild_job_query = """UPDATE cdp_rebuild_jobs
+SET status = 'running', started_at = now()
+WHERE job_id = :job_id;"""
+
+finish_rebuild_job_query = """UPDATE cdp_rebuild_jobs
+SET status = :status, finished_at = now(), exit_code = :exit_code, output = :output
+WHERE job_id = :job_id;"""
+
+# Every queued or running job is locked by its API process, with a session level advisory lock of the job id (in the
+# class of keys 3603). The lock goes away with the process, so a job that can be locked was left behind by a process
+# that stopped, and will never finish.
+lock_rebuild_job_query = "SELECT pg_advisory_lock(3603, hashtext(:job_id));"
+
+unlock_rebuild_job_query = "SELECT pg_advisory_unlock(3603, hashtext(:job_id));"
+
+fail_orphaned_rebuild_jobs_query = """UPDATE cdp_rebuild_jobs
+SET status = 'failed', finished_at = now(), output = 'The API process of the job stopped before the job finished'
+WHERE status IN ('queued', 'running') AND pg_try_advisory_xact_lock(3603, hashtext(job_id))
+RETURNING job_id;"""
+
+rebuild_job_query = """SELECT job_id, mode, customer_ids, since, status, requested_at, started_at, finished_at, exit_code, output
+FROM cdp_rebuild_jobs
+WHERE job_id = :job_id;"""
+
+rebuild_job_stages_query = """SELECT stage, status, started_at, finished_at, duration_ms, rows_produced, error
+FROM cdp_run_history
+WHERE run_id = :job_id AND stage <> 'total'
+ORDER BY started_at, stage_order;"""
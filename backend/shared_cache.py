@@ -0,0 +1,164 @@
+import os
+import time
+import fcntl
+import hashlib
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Optional
+from urllib.parse import urlparse
+
+# Dashboard payloads shared by the API processes of a deployment, so that N uvicorn workers compute each payload once
+# instead of N times. Payloads are stored as JSON under their build version, endpoint and arguments: a new build of
+# customer_360 starts from an empty cache. A payload expires after SHARED_CACHE_TTL_SECONDS, which bounds how long
+# events ingested since the build take to show in the charts of the source tables.
+#
+# SHARED_CACHE_URL selects the store, unset disables the cache:
+# - file:///dev/shm/cdp-cache: one file per payload in a directory shared by the workers of a host (a tmpfs keeps it
+#   in memory)
+# - redis://host:6379/0: a Redis compatible server shared by every host, needs the redis package
+#
+# While one process computes a payload, the others wait for it on a lock of the store, for at most
+# SHARED_CACHE_LOCK_TIMEOUT_SECONDS before computing it themselves.
+
+SHARED_CACHE_TTL_SECONDS = float(os.environ.get("SHARED_CACHE_TTL_SECONDS", 300))
+SHARED_CACHE_LOCK_TIMEOUT_SECONDS = float(os.environ.get("SHARED_CACHE_LOCK_TIMEOUT_SECONDS", 30))
+
+# How often a process waiting on a lock polls for it
+LOCK_POLL_SECONDS = 0.02
+
+# Expired files of the file store are removed at most this often
+SWEEP_INTERVAL_SECONDS = 60
+
+
+class FileStore:
+    def __init__(self, directory: str, ttl: float):
+        self.directory = directory
+        self.ttl = ttl
+        self.swept_at = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    async def get(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def set(self, key: str, value: bytes):
+        # written aside and renamed, a reader never sees a partial payload
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        os.replace(temporary_path, self.path(key))
+        if time.monotonic() - self.swept_at > SWEEP_INTERVAL_SECONDS:
+            self.sweep()
+
+    def sweep(self):
+        self.swept_at = time.monotonic()
+        for entry in os.scandir(self.directory):
+            try:
+                if time.time() - entry.stat().st_mtime > max(self.ttl, SHARED_CACHE_LOCK_TIMEOUT_SECONDS) * 2:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    @asynccontextmanager
+    async def lock(self, key: str, timeout: float):
+        # yields whether the lock was acquired before the timeout
+        with open(self.path(key) + ".lock", "a") as f:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        yield False
+                        return
+                    await asyncio.sleep(LOCK_POLL_SECONDS)
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class RedisStore:
+    def __init__(self, url: str, ttl: float):
+        try:
+            import redis.asyncio as redis
+            from redis.exceptions import LockError
+        except ImportError:
+            raise RuntimeError("SHARED_CACHE_URL points at Redis, install the redis package")
+        self.client = redis.from_url(url)
+        self.LockError = LockError
+        self.ttl = ttl
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes):
+        await self.client.set(key, value, ex=max(1, round(self.ttl)))
+
+    @asynccontextmanager
+    async def lock(self, key: str, timeout: float):
+        # the lock expires on its own if its holder dies while computing
+        lock = self.client.lock(f"{key}:lock", timeout=timeout, blocking_timeout=timeout, sleep=LOCK_POLL_SECONDS)
+        acquired = await lock.acquire()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    await lock.release()
+                except self.LockError:
+                    # expired during a computation longer than the timeout
+                    pass
+
+
+class SharedCache:
+    def __init__(self, store, lock_timeout: float = SHARED_CACHE_LOCK_TIMEOUT_SECONDS):
+        self.store = store
+        self.lock_timeout = lock_timeout
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value = await self.store.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def get_or_compute(
+        self, key: str, compute: Callable[..., Awaitable[Any]], serialize: Callable[[Any], bytes], *args
+    ) -> Any:
+        # the payload of `key`, as bytes when another process computed it, else as computed by `compute`
+        async with self.store.lock(key, self.lock_timeout) as locked:
+            if locked:
+                value = await self.store.get(key)
+                if value is not None:
+                    self.hits += 1
+                    return value
+            result = await compute(*args)
+            await self.store.set(key, serialize(result))
+            return result
+
+
+def create_shared_cache(url: Optional[str] = None, ttl: float = SHARED_CACHE_TTL_SECONDS) -> Optional[SharedCache]:
+    url = os.environ.get("SHARED_CACHE_URL") if url is None else url
+    if not url:
+        return None
+    scheme = urlparse(url).scheme
+    if scheme == "file":
+        return SharedCache(FileStore(urlparse(url).path, ttl))
+    if scheme in ("redis", "rediss"):
+        return SharedCache(RedisStore(url, ttl))
+    raise ValueError(f"Unsupported SHARED_CACHE_URL {url}")
@@ -0,0 +1,50 @@
+import math
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Estimates from the sketches maintained by the CDP build in kpi_sketches and kpi_hll_sketches (see `cdp/db_setup_queries.py`). The
+# parameters must match the ones of `cdp/cdp_procedure.py`.
+
+HLL_PRECISION = 14
+DDSKETCH_RELATIVE_ACCURACY = 0.01
+DDSKETCH_ZERO_BIN = -(2**31)
+
+HLL_REGISTERS = 2**HLL_PRECISION
+# the standard error of a HyperLogLog estimate, error bounds are reported at two standard errors (~95%)
+HLL_RELATIVE_ERROR = 2 * 1.04 / math.sqrt(HLL_REGISTERS)
+DDSKETCH_GAMMA = (1 + DDSKETCH_RELATIVE_ACCURACY) / (1 - DDSKETCH_RELATIVE_ACCURACY)
+
+
+def hll_estimate(register_sets: List[bytes]) -> float:
+    # register_sets: the registers of the merged buckets, one byte per register
+    m = HLL_REGISTERS
+    if not register_sets:
+        return 0.0
+    registers = np.maximum.reduce([np.frombuffer(registers, dtype=np.uint8) for registers in register_sets])
+    harmonic_sum = float(np.sum(np.ldexp(1.0, -registers.astype(np.int32))))
+    empty_registers = int(np.count_nonzero(registers == 0))
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / harmonic_sum
+    # small cardinalities are estimated by linear counting of the empty registers
+    if estimate <= 2.5 * m and empty_registers:
+        estimate = m * math.log(m / empty_registers)
+    return estimate
+
+
+def ddsketch_quantiles(bins: List[Tuple[int, float]], quantiles: List[float]) -> Dict[float, float]:
+    # bins: (bin, count) of the merged sketch. Every returned value is within DDSKETCH_RELATIVE_ACCURACY of an actual
+    # value of the requested rank.
+    bins = sorted(bins)
+    total = sum(count for _, count in bins)
+    results = {}
+    for quantile in quantiles:
+        if not total:
+            results[quantile] = None
+            continue
+        rank, cumulative = quantile * (total - 1), 0
+        for bin, count in bins:
+            cumulative += count
+            if cumulative > rank:
+                break
+        results[quantile] = 0.0 if bin == DDSKETCH_ZERO_BIN else 2 * DDSKETCH_GAMMA**bin / (DDSKETCH_GAMMA + 1)
+    return results
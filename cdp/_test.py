@@ -1,13 +1,20 @@
 import os
+import asyncio
 import cdp_procedure
+import cdp_vectorized
+import reconcile
+import numpy as np
+import pandas as pd
 import pg8000
 import sqlalchemy
 import pytest
-from google.cloud.sql.connector import Connector, IPTypes
+from google.cloud.sql.connector import Connector, IPTypes, create_async_connector
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.sql import text
 from colorama import Fore, Style
 from dotenv import load_dotenv
+from db_setup_queries import reconciliation_source_queries, reconciliation_target_query
 
 load_dotenv()  # Load environment variables
 
@@ -160,3 +167,130 @@ def test_frequency_score(db_session):
         result = s.execute(text(query)).fetchall()
 
     assert len(result) == 0, "Frequency score for each customer is not consistent before and after the transformation"
+
+
+def test_reconciliation(db_session):
+    """
+    Test that customer_360 passes every reconciliation rule of `reconcile.reconciliation_checks`, the same rules that
+    gate the publish of a build.
+    """
+    with db_session as s:
+        source_aggregates = {
+            table_name: dict(s.execute(text(query)).mappings().one())
+            for table_name, query in reconciliation_source_queries.items()
+        }
+        target_aggregates = dict(
+            s.execute(text(reconciliation_target_query.format(target_table="customer_360"))).mappings().one()
+        )
+
+    failed_checks = [
+        result for result in reconcile.evaluate_checks(source_aggregates, target_aggregates) if not result["passed"]
+    ]
+    assert not failed_checks, f"customer_360 doesn't reconcile with the source tables: {failed_checks}"
+
+
+# Columns that are ties postgres resolves arbitrarily (most frequent values, last interaction type) are not compared,
+# float columns are compared with a relative tolerance since the source amounts are stored as REAL.
+compared_columns = [
+    "total_lifetime_value",
+    "total_purchases",
+    "last_purchase_date",
+    "average_order_value",
+    "last_interaction_date",
+    "average_satisfaction_score",
+    "total_website_visits",
+    "average_time_spent_on_site",
+    "campaign_response_rate",
+    "customer_segment",
+    "recency_score",
+    "frequency_score",
+    "monetary_score",
+    "churn_risk_score",
+]
+
+
+def assert_same_customer_360(actual: pd.DataFrame, expected: pd.DataFrame, build: str):
+    assert list(actual.index) == list(expected.index), f"customer_ids differ between the SQL and the {build} build"
+    for column in compared_columns:
+        actual_values, expected_values = actual[column], expected[column]
+        if column.endswith("_date"):
+            matches = pd.to_datetime(actual_values).eq(pd.to_datetime(expected_values))
+        elif column in ("customer_segment", "churn_risk_score"):
+            matches = actual_values.eq(expected_values)
+        else:
+            matches = pd.Series(
+                np.isclose(actual_values.astype(float), expected_values.astype(float), rtol=1e-4),
+                index=actual_values.index,
+            )
+        matches |= actual_values.isna() & expected_values.isna()
+
+        assert matches.all(), (
+            f"{build.capitalize()} build differs from the SQL build for {column} on {int((~matches).sum())} "
+            f"customers, e.g. customer_ids {list(matches[~matches].index[:5])}"
+        )
+
+
+def test_vectorized_customer_360(db_session):
+    """
+    Test that the in-process vectorized build (`cdp_vectorized.build_customer_360`) produces the same customer_360 as the
+    SQL procedure.
+    """
+    with db_session as s:
+        connection = s.connection()
+        frames = {
+            table_name: pd.read_sql(text(f"SELECT * FROM {table_name}"), connection)
+            for table_name in cdp_vectorized.source_tables
+        }
+        sql_customer_360 = pd.read_sql(text("SELECT * FROM customer_360"), connection)
+        as_of = s.execute(text("SELECT CURRENT_DATE")).scalar()
+
+    expected = sql_customer_360.set_index("customer_id").sort_index()
+    actual = cdp_vectorized.build_customer_360(frames, as_of).set_index("customer_id").sort_index()
+    assert_same_customer_360(actual, expected, "vectorized")
+
+
+def test_incremental_build():
+    """
+    Test that an incremental build (`cdp_procedure.run_incremental_build`) of a few customers gives them the same
+    customer_360 rows as a full build.
+    """
+
+    async def build():
+        connector = None if os.environ.get("DATABASE_URL") else await create_async_connector()
+        engine = await cdp_procedure.init_connection_pool(connector)
+        Session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+        try:
+            async with Session() as session:
+                customer_ids = list(
+                    (await session.execute(text("SELECT customer_id FROM customer_info ORDER BY customer_id LIMIT 10")))
+                    .scalars()
+                    .all()
+                )
+            await cdp_procedure.run_incremental_build(Session, customer_ids=customer_ids)
+
+            # the full build goes to a temporary table, rolled back with its transaction
+            async with Session() as session:
+                await cdp_procedure.run_customer_360_stages(session, "test", target_table="pg_temp.customer_360_full")
+                frames = [
+                    pd.DataFrame(
+                        (
+                            await session.execute(
+                                text(f"SELECT * FROM {table_name} WHERE customer_id = ANY(:customer_ids)"),
+                                {"customer_ids": customer_ids},
+                            )
+                        )
+                        .mappings()
+                        .all()
+                    )
+                    for table_name in ("customer_360", "customer_360_full")
+                ]
+                await session.rollback()
+        finally:
+            await engine.dispose()
+            if connector:
+                await connector.close_async()
+        return [frame.set_index("customer_id").sort_index() for frame in frames]
+
+    incremental, full = asyncio.run(build())
+    assert len(full) == 10, f"Expected 10 customers, got {len(full)}"
+    assert_same_customer_360(incremental, full, "incremental")
@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import text
+from colorama import Fore, Style
+
+import db_setup
+import cdp_procedure
+from db_setup_queries import table_schema_init_queries, index_init_queries, run_stages_query
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+import backend_logic  # noqa: E402
+import db_routing  # noqa: E402
+
+# End to end benchmark of the CDP pipeline on a scratch database: for every scale factor the CDP tables are dropped,
+# recreated and loaded by the `db_setup.py` generator, customer_360 is built by `cdp_procedure.py` and every backend
+# read endpoint is called. Timings go to a JSON report that can be compared against a stored baseline.
+#
+# The database at --database-url is wiped of all CDP tables, never point it at a database holding real data.
+
+cdp_tables = [
+    "customer_360",
+    "cohort_retention",
+    "kpi_sketches",
+    "kpi_hll_sketches",
+    "product_affinity",
+    "brand_affinity",
+    "scope_customers",
+    "scope_metrics",
+    "scope_revenue",
+    "scope_cohort_retention",
+    "website_behavior",
+    "campaign_responses",
+    "customer_service",
+    "purchase_transactions",
+    "marketing_campaigns",
+    "product_catalog",
+    "customer_info",
+    "cdp_load_checkpoints",
+]
+
+backend_queries = {
+    "kpis": backend_logic.get_kpis,
+    "customer_segments": backend_logic.get_customer_segments,
+    "monthly_revenue": backend_logic.get_monthly_revenue,
+    "top_customers": backend_logic.get_top_customers,
+    "product_category_performance": backend_logic.get_product_category_performance,
+    "customer_satisfaction": backend_logic.get_customer_satisfaction,
+    "churn_risk": backend_logic.get_churn_risk,
+    "rfm_segmentation": backend_logic.get_rfm_segmentation,
+}
+
+
+async def timed(coroutine) -> tuple:
+    start = time.perf_counter()
+    result = await coroutine
+    return result, round((time.perf_counter() - start) * 1000, 1)
+
+
+async def reset_database(Session):
+    async with Session() as session:
+        for table_name in cdp_tables:
+            await session.execute(text(f"DROP TABLE IF EXISTS {table_name} CASCADE"))
+        await session.commit()
+
+
+async def table_rows(Session) -> Dict[str, int]:
+    async with Session() as session:
+        return {
+            table_name: (await session.execute(text(f"SELECT COUNT(*) FROM {table_name}"))).scalar()
+            for table_name in cdp_tables
+            if table_name != "cdp_load_checkpoints"
+        }
+
+
+async def benchmark_scale_factor(Session, scale_factor: float, args) -> Dict[str, Any]:
+    timings_ms = {}
+    await reset_database(Session)
+
+    async def init_schema():
+        await db_setup.initiate_schema(Session, table_schema_init_queries)
+        await db_setup.initiate_partitions(Session)
+        await db_setup.initiate_indexes(Session, index_init_queries)
+
+    _, timings_ms["schema_init"] = await timed(init_schema())
+    loaded, timings_ms["load"] = await timed(
+        db_setup.insert_fake_data(
+            Session, scale_factor=scale_factor, seed=args.seed, connections=args.connections, fast_load=args.fast_load
+        )
+    )
+    if not loaded:
+        raise RuntimeError(f"Loading scale factor {scale_factor} failed")
+
+    async def analyze():
+        async with Session() as session:
+            await session.execute(text("ANALYZE"))
+            await session.commit()
+
+    _, timings_ms["analyze"] = await timed(analyze())
+    run_id, timings_ms["procedure"] = await timed(cdp_procedure.create_and_run_procedure(Session))
+
+    async with Session() as session:
+        result = await session.execute(text(run_stages_query), {"run_id": run_id})
+        stages_ms = {row.stage: row.duration_ms for row in result}
+
+    # the calls go through the connection pools of the backend, the median of --repeat calls is reported
+    queries_ms = {}
+    for name, query in backend_queries.items():
+        durations = [(await timed(query()))[1] for _ in range(args.repeat)]
+        queries_ms[name] = {"median": statistics.median(durations), "min": min(durations)}
+
+    return {
+        "rows": await table_rows(Session),
+        "timings_ms": timings_ms,
+        "stages_ms": stages_ms,
+        "queries_ms": queries_ms,
+    }
+
+
+def flatten_metrics(report: Dict[str, Any]) -> Dict[str, float]:
+    # "<scale factor>/<group>/<metric>" -> milliseconds, the medians for backend queries
+    metrics = {}
+    for scale_factor, result in report["scale_factors"].items():
+        for group in ("timings_ms", "stages_ms"):
+            for name, value in result[group].items():
+                metrics[f"sf={scale_factor}/{group[:-3]}/{name}"] = value
+        for name, value in result["queries_ms"].items():
+            metrics[f"sf={scale_factor}/queries/{name}"] = value["median"]
+    return metrics
+
+
+def compare_to_baseline(
+    report: Dict[str, Any], baseline: Dict[str, Any], threshold: float, min_delta_ms: float
+) -> List[Dict[str, Any]]:
+    # a metric regressed when it is `threshold` times slower and at least `min_delta_ms` slower, so that noise on
+    # metrics of a few milliseconds isn't flagged
+    current, previous = flatten_metrics(report), flatten_metrics(baseline)
+    comparison = []
+    for metric in sorted(current.keys() & previous.keys()):
+        if not previous[metric] or current[metric] is None:
+            continue
+        ratio = current[metric] / previous[metric]
+        comparison.append(
+            {
+                "metric": metric,
+                "baseline_ms": previous[metric],
+                "current_ms": current[metric],
+                "ratio": round(ratio, 3),
+                "regression": ratio > threshold and current[metric] - previous[metric] >= min_delta_ms,
+            }
+        )
+    return comparison
+
+
+def print_comparison(comparison: List[Dict[str, Any]]):
+    print(f"\n{'metric':<60}{'baseline ms':>14}{'current ms':>14}{'ratio':>8}")
+    for row in comparison:
+        color = Fore.RED if row["regression"] else ""
+        print(
+            f"{color}{row['metric']:<60}{row['baseline_ms']:>14,.1f}{row['current_ms']:>14,.1f}"
+            f"{row['ratio']:>8.2f}{Style.RESET_ALL}"
+        )
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args) -> bool:
+    # DATABASE_URL points the connection pools of the backend at the same database
+    os.environ["DATABASE_URL"] = args.database_url
+    engine = create_async_engine(args.database_url, pool_size=max(5, args.connections))
+    Session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    try:
+        async with Session() as session:
+            server_version = (await session.execute(text("SHOW server_version"))).scalar()
+
+        report = {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "git_commit": git_commit(),
+            "environment": {"python": platform.python_version(), "postgres": server_version},
+            "settings": {"seed": args.seed, "connections": args.connections, "fast_load": args.fast_load},
+            "scale_factors": {},
+        }
+        for scale_factor in args.scale_factors:
+            print(f"{Fore.GREEN}{Style.BRIGHT}[+] Benchmarking scale factor {scale_factor}{Style.RESET_ALL}")
+            report["scale_factors"][str(scale_factor)] = await benchmark_scale_factor(Session, scale_factor, args)
+    finally:
+        await db_routing.dispose_pools()
+        await engine.dispose()
+
+    succeeded = True
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            report["comparison"] = compare_to_baseline(report, json.load(f), args.threshold, args.min_delta_ms)
+        print_comparison(report["comparison"])
+        succeeded = not (args.fail_on_regression and any(row["regression"] for row in report["comparison"]))
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nReport written to {args.output}")
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    return succeeded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark load, build and backend queries at several scale factors.")
+    parser.add_argument(
+        "--database-url",
+        default=os.environ.get("DATABASE_URL"),
+        help="scratch database, e.g. postgresql+asyncpg://postgres@localhost/cdp_bench (default: $DATABASE_URL)",
+    )
+    parser.add_argument("--scale-factors", type=float, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--seed", type=int, default=db_setup.DEFAULT_SEED)
+    parser.add_argument("--connections", type=int, default=db_setup.LOAD_CONNECTIONS)
+    parser.add_argument("--fast-load", action="store_true", help="benchmark the fast-load mode of the loader")
+    parser.add_argument("--repeat", type=int, default=5, help="calls per backend query")
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="report to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument(
+        "--threshold", type=float, default=cdp_procedure.REGRESSION_THRESHOLD, help="ratio flagged as a regression"
+    )
+    parser.add_argument("--min-delta-ms", type=float, default=20, help="smallest slowdown flagged as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with 1 when a metric regressed")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("--database-url or DATABASE_URL is required")
+    if not asyncio.run(main(args)):
+        raise SystemExit(1)
@@ -0,0 +1,267 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# In-process reference implementation of the `create_customer_360()` procedure in `cdp_procedure.py`.
+# Every stage is a group-by over columnar frames, there are no per-customer Python loops, so it can be used to
+# validate the SQL build offline and to build customer_360 locally from snapshot files of the source tables.
+#
+# "Most frequent" columns (favorite category/brand, most viewed category, preferred channel) and the last
+# interaction type are ties in SQL that postgres resolves arbitrarily, here ties are broken deterministically
+# by the smallest value (or the highest interaction_id for the last interaction).
+
+source_tables = [
+    "customer_info",
+    "product_catalog",
+    "purchase_transactions",
+    "customer_service",
+    "marketing_campaigns",
+    "campaign_responses",
+    "website_behavior",
+]
+
+customer_360_columns = [
+    "customer_id",
+    "first_name",
+    "last_name",
+    "email",
+    "phone_number",
+    "date_of_birth",
+    "registration_date",
+    "total_lifetime_value",
+    "total_purchases",
+    "last_purchase_date",
+    "average_order_value",
+    "favorite_product_category",
+    "favorite_brand",
+    "last_interaction_date",
+    "last_interaction_type",
+    "average_satisfaction_score",
+    "total_website_visits",
+    "average_time_spent_on_site",
+    "most_viewed_product_category",
+    "campaign_response_rate",
+    "preferred_marketing_channel",
+    "customer_segment",
+    "recency_score",
+    "frequency_score",
+    "monetary_score",
+    "churn_risk_score",
+]
+
+date_columns = {
+    "customer_info": ["date_of_birth", "registration_date"],
+    "product_catalog": ["launch_date"],
+    "purchase_transactions": ["purchase_date"],
+    "customer_service": ["interaction_date"],
+    "marketing_campaigns": ["start_date", "end_date"],
+    "campaign_responses": ["response_date"],
+    "website_behavior": ["visit_date"],
+}
+
+
+def most_frequent(df: pd.DataFrame, key: str, value: str, name: str) -> pd.Series:
+    # argmax of the per (key, value) counts: sort once by count desc / value asc and keep the first row per key
+    counts = df.groupby([key, value], sort=False).size().reset_index(name="count")
+    counts = counts.sort_values([key, "count", value], ascending=[True, False, True], kind="stable")
+    return counts.drop_duplicates(key).set_index(key)[value].rename(name)
+
+
+def purchase_stats(purchases: pd.DataFrame, products: pd.DataFrame) -> pd.DataFrame:
+    grouped = purchases.groupby("customer_id")
+    stats = pd.DataFrame(
+        {
+            "total_lifetime_value": grouped["total_amount"].sum(),
+            "total_purchases": grouped["transaction_id"].nunique(),
+            "last_purchase_date": grouped["purchase_date"].max(),
+            "average_order_value": grouped["total_amount"].mean(),
+        }
+    )
+
+    with_products = purchases[["customer_id", "product_id"]].merge(
+        products[["product_id", "category", "brand"]], on="product_id"
+    )
+    stats = stats.join(most_frequent(with_products, "customer_id", "category", "favorite_product_category"))
+    return stats.join(most_frequent(with_products, "customer_id", "brand", "favorite_brand"))
+
+
+def engagement_stats(service: pd.DataFrame, behavior: pd.DataFrame, products: pd.DataFrame) -> pd.DataFrame:
+    grouped = service.groupby("customer_id")
+    latest = service.sort_values(["customer_id", "interaction_date", "interaction_id"], kind="stable")
+    engagement = pd.DataFrame(
+        {
+            "last_interaction_date": grouped["interaction_date"].max(),
+            "last_interaction_type": latest.drop_duplicates("customer_id", keep="last").set_index("customer_id")[
+                "interaction_type"
+            ],
+            "average_satisfaction_score": grouped["satisfaction_score"].mean(),
+        }
+    )
+
+    visits = behavior.groupby("customer_id")
+    website = pd.DataFrame(
+        {
+            "total_website_visits": visits["session_id"].nunique(),
+            "average_time_spent_on_site": visits["time_spent"].mean(),
+        }
+    )
+    viewed = behavior[["customer_id", "pages_viewed"]].merge(
+        products[["product_id", "category"]], left_on="pages_viewed", right_on="product_id"
+    )
+    website = website.join(most_frequent(viewed, "customer_id", "category", "most_viewed_product_category"))
+
+    # same as the SQL build, website behaviour is only attached to customers that have service interactions
+    return engagement.join(website, how="left")
+
+
+def campaign_stats(responses: pd.DataFrame, campaigns: pd.DataFrame) -> pd.DataFrame:
+    positive = responses["response_type"].isin(["click", "purchase"]).astype(np.int64)
+    grouped = responses.assign(positive=positive).groupby("customer_id")
+    response_rate = (grouped["positive"].sum() / grouped["campaign_id"].nunique().replace(0, np.nan)).fillna(0.0)
+
+    with_channel = responses[["customer_id", "campaign_id"]].merge(campaigns[["campaign_id", "channel"]], on="campaign_id")
+    return pd.DataFrame({"campaign_response_rate": response_rate.astype(np.float64)}).join(
+        most_frequent(with_channel, "customer_id", "channel", "preferred_marketing_channel")
+    )
+
+
+def prepare_frames(frames: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+    prepared = {}
+    for table_name in source_tables:
+        frame = frames[table_name].copy()
+        for column in date_columns[table_name]:
+            frame[column] = pd.to_datetime(frame[column])
+        prepared[table_name] = frame
+    return prepared
+
+
+def build_customer_360(frames: Dict[str, pd.DataFrame], as_of: Optional[date] = None) -> pd.DataFrame:
+    frames = prepare_frames(frames)
+    as_of = pd.Timestamp(as_of or date.today())
+    products = frames["product_catalog"]
+
+    customer_360 = (
+        frames["customer_info"]
+        .set_index("customer_id")[customer_360_columns[1:7]]
+        .join(purchase_stats(frames["purchase_transactions"], products))
+        .join(engagement_stats(frames["customer_service"], frames["website_behavior"], products))
+        .join(campaign_stats(frames["campaign_responses"], frames["marketing_campaigns"]))
+        .reset_index()
+    )
+
+    ltv = customer_360["total_lifetime_value"]
+    customer_360["customer_segment"] = np.select(
+        [ltv > 1000, ltv > 500], ["High Value", "Medium Value"], default="Low Value"
+    )
+    recency = (as_of - customer_360["last_purchase_date"]).dt.days
+    customer_360["recency_score"] = recency.astype("Int64")
+    customer_360["frequency_score"] = customer_360["total_purchases"].astype("Int64")
+    customer_360["total_purchases"] = customer_360["total_purchases"].astype("Int64")
+    customer_360["total_website_visits"] = customer_360["total_website_visits"].astype("Int64")
+    customer_360["monetary_score"] = ltv
+    # comparisons against a missing recency are false, so customers without purchases end up as 'Low' like in SQL
+    customer_360["churn_risk_score"] = np.select(
+        [recency.gt(180).to_numpy(), recency.gt(90).to_numpy()], ["High", "Medium"], default="Low"
+    )
+
+    return customer_360[customer_360_columns]
+
+
+def split_customer_ranges(customer_ids: pd.Series, shards: int) -> List[Tuple[int, int]]:
+    # equal sized chunks of the sorted ids, so shards stay balanced even when the ids have gaps
+    chunks = np.array_split(np.sort(customer_ids.unique()), shards)
+    return [(int(chunk[0]), int(chunk[-1])) for chunk in chunks if len(chunk)]
+
+
+def shard_frames(frames: Dict[str, pd.DataFrame], customer_range: Tuple[int, int]) -> Dict[str, pd.DataFrame]:
+    lo, hi = customer_range
+    shard = {}
+    for table_name, frame in frames.items():
+        if "customer_id" in frame.columns:
+            # frames are sorted by customer_id once up front, so a shard is two binary searches and a slice
+            ids = frame["customer_id"].to_numpy()
+            shard[table_name] = frame.iloc[np.searchsorted(ids, lo, "left") : np.searchsorted(ids, hi, "right")]
+        else:
+            shard[table_name] = frame
+    return shard
+
+
+def build_customer_360_sharded(
+    frames: Dict[str, pd.DataFrame],
+    workers: int,
+    shards: Optional[int] = None,
+    max_retries: int = 2,
+    as_of: Optional[date] = None,
+) -> pd.DataFrame:
+    as_of = as_of or date.today()
+    frames = {
+        table_name: frame.sort_values("customer_id", kind="stable") if "customer_id" in frame.columns else frame
+        for table_name, frame in frames.items()
+    }
+    customer_ranges = split_customer_ranges(frames["customer_info"]["customer_id"], shards or workers)
+    results = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {shard: 0 for shard in range(len(customer_ranges))}
+        while pending:
+            futures = {
+                shard: executor.submit(build_customer_360, shard_frames(frames, customer_ranges[shard]), as_of)
+                for shard in pending
+            }
+            for shard, future in futures.items():
+                try:
+                    results[shard] = future.result()
+                    del pending[shard]
+                except Exception as e:
+                    # only the failed shards are submitted again
+                    pending[shard] += 1
+                    print(f"Shard {shard} {customer_ranges[shard]} failed on attempt {pending[shard]}: {e}")
+                    if pending[shard] > max_retries:
+                        raise
+
+    return pd.concat([results[shard] for shard in sorted(results)], ignore_index=True)
+
+
+def load_snapshot(snapshot_dir: str) -> Dict[str, pd.DataFrame]:
+    # Snapshot directories contain one `<table>.parquet` or `<table>.csv` file per source table
+    frames = {}
+    for table_name in source_tables:
+        parquet_path = os.path.join(snapshot_dir, f"{table_name}.parquet")
+        csv_path = os.path.join(snapshot_dir, f"{table_name}.csv")
+        if os.path.exists(parquet_path):
+            frames[table_name] = pd.read_parquet(parquet_path)
+        elif os.path.exists(csv_path):
+            frames[table_name] = pd.read_csv(csv_path)
+        else:
+            raise FileNotFoundError(f"No snapshot file found for {table_name} in {snapshot_dir}")
+    return frames
+
+
+def write_customer_360(customer_360: pd.DataFrame, output_path: str):
+    if output_path.endswith(".parquet"):
+        customer_360.to_parquet(output_path, index=False)
+    else:
+        customer_360.to_csv(output_path, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build customer_360 locally from snapshot files of the source tables.")
+    parser.add_argument("snapshot_dir", help="directory with one <table>.parquet or <table>.csv file per source table")
+    parser.add_argument("output", help="output file, .parquet or .csv")
+    parser.add_argument("--as-of", type=date.fromisoformat, default=None, help="date used for recency (default: today)")
+    parser.add_argument("--workers", type=int, default=1, help="build customer_id shards in this many processes")
+    parser.add_argument("--shards", type=int, default=None, help="number of customer_id shards (default: --workers)")
+    args = parser.parse_args()
+
+    frames = load_snapshot(args.snapshot_dir)
+    if args.workers > 1:
+        customer_360 = build_customer_360_sharded(frames, args.workers, args.shards, as_of=args.as_of)
+    else:
+        customer_360 = build_customer_360(frames, args.as_of)
+    write_customer_360(customer_360, args.output)
+    print(f"customer_360 built with {len(customer_360)} rows: {args.output}")
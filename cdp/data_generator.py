@@ -0,0 +1,270 @@
+import os
+import argparse
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from faker import Faker
+
+# Seeded, vectorized generator of the CDP source tables, TPC style: `--scale-factor 1` is the original fake dataset
+# (1,000 customers, 5,000 purchases, ...) and every other table grows linearly with it, except the product catalog and
+# the campaigns which are fixed size dimensions.
+#
+# Tables are generated in chunks of NumPy columns. Every chunk has its own random generator seeded from
+# (seed, table, chunk index), so a chunk can be regenerated on its own and the output for a given seed, scale factor
+# and chunk size is identical no matter in which order or on how many workers the chunks are produced. Faker is only
+# used to fill small value pools up front (names, words, catch phrases), rows pick from the pools by index.
+#
+# Primary keys are generated explicitly (1..N per table), foreign keys are drawn uniformly from the parent keys.
+
+DEFAULT_SEED = 42
+DEFAULT_CHUNK_SIZE = 5000
+POOL_SIZE = 1000
+
+# Row counts at scale factor 1
+base_row_counts = {
+    "customer_info": 1000,
+    "product_catalog": 100,
+    "marketing_campaigns": 20,
+    "purchase_transactions": 5000,
+    "customer_service": 2000,
+    "campaign_responses": 10000,
+    "website_behavior": 20000,
+}
+
+fixed_size_tables = {"product_catalog", "marketing_campaigns"}
+
+# Serial primary key of every table, generated explicitly so the sequences have to be moved past them after a load
+id_columns = {
+    "customer_info": "customer_id",
+    "product_catalog": "product_id",
+    "marketing_campaigns": "campaign_id",
+    "purchase_transactions": "transaction_id",
+    "customer_service": "interaction_id",
+    "campaign_responses": "response_id",
+    "website_behavior": "session_id",
+}
+
+categories = ["Home Care", "Personal Care", "Baby Care", "Fabric Care", "Hair Care"]
+brands = ["Tide", "Pampers", "Gillette", "Pantene", "Oral-B", "Olay", "Dawn", "Bounty", "Charmin", "Crest"]
+interaction_types = ["complaint", "inquiry", "feedback"]
+resolution_statuses = ["resolved", "pending", "escalated"]
+channels = ["email", "social media", "TV", "print", "radio"]
+target_audiences = ["all", "young adults", "parents", "seniors"]
+response_types = ["click", "purchase", "unsubscribe"]
+sources = ["organic search", "paid ad", "direct", "social media", "email"]
+
+
+def row_counts(scale_factor: float) -> Dict[str, int]:
+    return {
+        table_name: count if table_name in fixed_size_tables else max(1, round(count * scale_factor))
+        for table_name, count in base_row_counts.items()
+    }
+
+
+def build_pools(seed: int) -> Dict[str, np.ndarray]:
+    fake = Faker()
+    fake.seed_instance(seed)
+    first_names = [fake.first_name() for _ in range(POOL_SIZE)]
+    last_names = [fake.last_name() for _ in range(POOL_SIZE)]
+    return {
+        "first_name": np.array(first_names, dtype=object),
+        "last_name": np.array(last_names, dtype=object),
+        "email_first": np.array([name.lower() for name in first_names], dtype=object),
+        "email_last": np.array([name.lower() for name in last_names], dtype=object),
+        "email_domain": np.array([fake.free_email_domain() for _ in range(20)], dtype=object),
+        "word": np.array([fake.word().capitalize() for _ in range(POOL_SIZE)], dtype=object),
+        "catch_phrase": np.array([fake.catch_phrase() for _ in range(POOL_SIZE)], dtype=object),
+    }
+
+
+def pick(rng: np.random.Generator, values, size: int) -> np.ndarray:
+    values = np.asarray(values, dtype=object)
+    return values[rng.integers(0, len(values), size)]
+
+
+def concat(*parts) -> np.ndarray:
+    # element-wise concatenation of string arrays and scalars
+    result = np.asarray(parts[0], dtype=str)
+    for part in parts[1:]:
+        result = np.char.add(result, np.asarray(part, dtype=str))
+    return result.astype(object)
+
+
+def days_before(rng: np.random.Generator, as_of: np.datetime64, low: int, high: int, size: int) -> np.ndarray:
+    # dates between `high` and `low` days before as_of, both ends included
+    return as_of - rng.integers(low, high + 1, size).astype("timedelta64[D]")
+
+
+def generate_customers(rng, ids, counts, pools, as_of) -> Dict[str, np.ndarray]:
+    n = len(ids)
+    first, last = rng.integers(0, POOL_SIZE, n), rng.integers(0, POOL_SIZE, n)
+    domains = pick(rng, pools["email_domain"], n)
+    area, exchange, line = rng.integers(200, 1000, n), rng.integers(200, 1000, n), rng.integers(0, 10000, n)
+    return {
+        "customer_id": ids,
+        "first_name": pools["first_name"][first],
+        "last_name": pools["last_name"][last],
+        # the customer id keeps emails unique however small the name pools are
+        "email": concat(
+            pools["email_first"][first], ".", pools["email_last"][last], ids.astype(str), "@", domains
+        ),
+        "phone_number": concat(
+            area.astype(str), "-", exchange.astype(str), "-", np.char.zfill(line.astype(str), 4)
+        ),
+        "date_of_birth": days_before(rng, as_of, 18 * 365, 80 * 365, n),
+        "registration_date": days_before(rng, as_of, 0, 5 * 365, n),
+    }
+
+
+def generate_products(rng, ids, counts, pools, as_of) -> Dict[str, np.ndarray]:
+    n = len(ids)
+    return {
+        "product_id": ids,
+        "product_name": pick(rng, pools["word"], n) + " " + pick(rng, pools["word"], n),
+        "category": pick(rng, categories, n),
+        "brand": pick(rng, brands, n),
+        "price": np.round(rng.uniform(5, 100, n), 2),
+        "launch_date": days_before(rng, as_of, 0, 3 * 365, n),
+    }
+
+
+def generate_campaigns(rng, ids, counts, pools, as_of) -> Dict[str, np.ndarray]:
+    n = len(ids)
+    start_date = days_before(rng, as_of, 0, 182, n)
+    return {
+        "campaign_id": ids,
+        "campaign_name": pick(rng, pools["catch_phrase"], n),
+        "start_date": start_date,
+        "end_date": start_date + rng.integers(7, 91, n).astype("timedelta64[D]"),
+        "channel": pick(rng, channels, n),
+        "target_audience": pick(rng, target_audiences, n),
+    }
+
+
+def generate_purchases(rng, ids, counts, pools, as_of) -> Dict[str, np.ndarray]:
+    n = len(ids)
+    return {
+        "transaction_id": ids,
+        "customer_id": rng.integers(1, counts["customer_info"] + 1, n),
+        "product_id": rng.integers(1, counts["product_catalog"] + 1, n),
+        "purchase_date": days_before(rng, as_of, 0, 365, n),
+        "quantity": rng.integers(1, 6, n),
+        "total_amount": np.round(rng.uniform(10, 500, n), 2),
+        "store_id": rng.integers(1, 51, n),
+    }
+
+
+def generate_service(rng, ids, counts, pools, as_of) -> Dict[str, np.ndarray]:
+    n = len(ids)
+    return {
+        "interaction_id": ids,
+        "customer_id": rng.integers(1, counts["customer_info"] + 1, n),
+        "interaction_date": days_before(rng, as_of, 0, 365, n),
+        "interaction_type": pick(rng, interaction_types, n),
+        "product_id": rng.integers(1, counts["product_catalog"] + 1, n),
+        "resolution_status": pick(rng, resolution_statuses, n),
+        "satisfaction_score": rng.integers(1, 11, n),
+    }
+
+
+def generate_responses(rng, ids, counts, pools, as_of) -> Dict[str, np.ndarray]:
+    n = len(ids)
+    return {
+        "response_id": ids,
+        "campaign_id": rng.integers(1, counts["marketing_campaigns"] + 1, n),
+        "customer_id": rng.integers(1, counts["customer_info"] + 1, n),
+        "response_date": days_before(rng, as_of, 0, 182, n),
+        "response_type": pick(rng, response_types, n),
+    }
+
+
+def generate_behavior(rng, ids, counts, pools, as_of) -> Dict[str, np.ndarray]:
+    n = len(ids)
+    return {
+        "session_id": ids,
+        "customer_id": rng.integers(1, counts["customer_info"] + 1, n),
+        "visit_date": days_before(rng, as_of, 0, 365, n),
+        "pages_viewed": rng.integers(1, 21, n),
+        "time_spent": rng.integers(30, 1801, n),
+        "source": pick(rng, sources, n),
+    }
+
+
+table_generators = {
+    "customer_info": generate_customers,
+    "product_catalog": generate_products,
+    "marketing_campaigns": generate_campaigns,
+    "purchase_transactions": generate_purchases,
+    "customer_service": generate_service,
+    "campaign_responses": generate_responses,
+    "website_behavior": generate_behavior,
+}
+
+
+class DataGenerator:
+    def __init__(
+        self,
+        scale_factor: float = 1.0,
+        seed: int = DEFAULT_SEED,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        as_of: Optional[date] = None,
+    ):
+        self.scale_factor = scale_factor
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.as_of = np.datetime64(as_of or date.today(), "D")
+        self.counts = row_counts(scale_factor)
+        self.pools = build_pools(seed)
+
+    def chunk_count(self, table_name: str) -> int:
+        return -(-self.counts[table_name] // self.chunk_size)
+
+    def generate_columns(self, table_name: str, chunk: int) -> Dict[str, np.ndarray]:
+        table_index = list(table_generators).index(table_name)
+        rng = np.random.default_rng([self.seed, table_index, chunk])
+        first_id = chunk * self.chunk_size + 1
+        ids = np.arange(first_id, min(first_id + self.chunk_size, self.counts[table_name] + 1))
+        return table_generators[table_name](rng, ids, self.counts, self.pools, self.as_of)
+
+    def iter_columns(
+        self, table_name: str, skip: Iterable[int] = ()
+    ) -> Iterator[Tuple[int, Dict[str, np.ndarray]]]:
+        # chunks in `skip`, e.g. already loaded ones, aren't generated at all
+        skip = set(skip)
+        for chunk in range(self.chunk_count(table_name)):
+            if chunk not in skip:
+                yield chunk, self.generate_columns(table_name, chunk)
+
+    def iter_records(self, table_name: str, skip: Iterable[int] = ()) -> Iterator[Tuple[int, List[str], List[tuple]]]:
+        # (chunk, columns, rows) with native Python values (int, float, str, datetime.date), as the loader expects
+        for chunk, columns in self.iter_columns(table_name, skip):
+            yield chunk, list(columns), list(zip(*(values.tolist() for values in columns.values())))
+
+
+def write_snapshot(generator: DataGenerator, output_dir: str):
+    # One parquet file per table, written a record batch per chunk, in the layout `cdp_vectorized.load_snapshot()` reads
+    os.makedirs(output_dir, exist_ok=True)
+    for table_name in table_generators:
+        writer = None
+        for _, columns in generator.iter_columns(table_name):
+            batch = pa.RecordBatch.from_pydict(columns)
+            if writer is None:
+                writer = pq.ParquetWriter(os.path.join(output_dir, f"{table_name}.parquet"), batch.schema)
+            writer.write_batch(batch)
+        writer.close()
+        print(f"{table_name}: {generator.counts[table_name]} rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the CDP source tables as parquet files.")
+    parser.add_argument("output_dir", help="directory to write one <table>.parquet file per source table to")
+    parser.add_argument("--scale-factor", type=float, default=1.0, help="1 = 1,000 customers, 5,000 purchases, ...")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--as-of", type=date.fromisoformat, default=None, help="dates are generated up to this day")
+    args = parser.parse_args()
+
+    write_snapshot(DataGenerator(args.scale_factor, args.seed, args.chunk_size, args.as_of), args.output_dir)
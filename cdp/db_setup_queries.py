@@ -17,16 +17,17 @@ table_schema_init_queries = {
         launch_date DATE
     );""",
     "purchase_transactions": """CREATE TABLE IF NOT EXISTS purchase_transactions (
-        transaction_id SERIAL PRIMARY KEY,
+        transaction_id SERIAL,
         customer_id INTEGER,
         product_id INTEGER,
         purchase_date DATE,
         quantity INTEGER,
         total_amount REAL,
         store_id INTEGER,
+        PRIMARY KEY (transaction_id, purchase_date),
         FOREIGN KEY (customer_id) REFERENCES customer_info (customer_id),
         FOREIGN KEY (product_id) REFERENCES product_catalog (product_id)
-    );""",
+    ) PARTITION BY RANGE (purchase_date);""",
     "customer_service": """CREATE TABLE IF NOT EXISTS customer_service (
         interaction_id SERIAL PRIMARY KEY,
         customer_id INTEGER,
@@ -48,21 +49,720 @@ table_schema_init_queries = {
     );""",
     "campaign_responses": """
         CREATE TABLE IF NOT EXISTS campaign_responses (
-        response_id SERIAL PRIMARY KEY,
+        response_id SERIAL,
         campaign_id INTEGER,
         customer_id INTEGER,
         response_date DATE,
         response_type TEXT,
+        PRIMARY KEY (response_id, response_date),
         FOREIGN KEY (campaign_id) REFERENCES marketing_campaigns (campaign_id),
         FOREIGN KEY (customer_id) REFERENCES customer_info (customer_id)
-    );""",
+    ) PARTITION BY RANGE (response_date);""",
     "website_behavior": """CREATE TABLE IF NOT EXISTS website_behavior (
-        session_id SERIAL PRIMARY KEY,
+        session_id SERIAL,
         customer_id INTEGER,
         visit_date DATE,
         pages_viewed INTEGER,
         time_spent INTEGER,
         source TEXT,
+        PRIMARY KEY (session_id, visit_date),
         FOREIGN KEY (customer_id) REFERENCES customer_info (customer_id)
-    );""",
+    ) PARTITION BY RANGE (visit_date);""",
+}
+
+# Secondary indexes, the customer_id indexes serve the per-customer lookups and recomputes of the backend. Purchases
+# and interactions are also ordered by date, so the most recent ones of a customer are read straight off the index.
+index_init_queries = {
+    "purchase_transactions_customer_id_date_idx": "CREATE INDEX IF NOT EXISTS purchase_transactions_customer_id_date_idx ON purchase_transactions (customer_id, purchase_date DESC);",
+    "customer_service_customer_id_date_idx": "CREATE INDEX IF NOT EXISTS customer_service_customer_id_date_idx ON customer_service (customer_id, interaction_date DESC);",
+    "campaign_responses_customer_id_idx": "CREATE INDEX IF NOT EXISTS campaign_responses_customer_id_idx ON campaign_responses (customer_id);",
+    "website_behavior_customer_id_idx": "CREATE INDEX IF NOT EXISTS website_behavior_customer_id_idx ON website_behavior (customer_id);",
+}
+
+# Indexes replaced by one of `index_init_queries` under a new name, dropped when the indexes are created. CREATE INDEX
+# IF NOT EXISTS only looks at the name, an index redefined under the same name would never reach existing databases.
+retired_indexes = [
+    "purchase_transactions_customer_id_idx",  # (customer_id), now (customer_id, purchase_date DESC)
+    "customer_service_customer_id_idx",  # (customer_id), now (customer_id, interaction_date DESC)
+]
+
+# Fact tables that are range partitioned by month, mapped to their partition key.
+# Monthly partitions are named `<table>_pYYYYMM`, rows outside the managed window land in `<table>_default`.
+partitioned_tables = {
+    "purchase_transactions": "purchase_date",
+    "campaign_responses": "response_date",
+    "website_behavior": "visit_date",
+}
+
+partition_management_queries = {
+    "ensure_monthly_partitions": """CREATE OR REPLACE FUNCTION ensure_monthly_partitions(
+        parent_table TEXT,
+        from_month DATE,
+        months_ahead INTEGER
+    ) RETURNS INTEGER
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        month_start DATE := DATE_TRUNC('month', from_month)::DATE;
+        last_month DATE := (DATE_TRUNC('month', CURRENT_DATE) + MAKE_INTERVAL(months => months_ahead))::DATE;
+        default_partition TEXT := parent_table || '_default';
+        partition_key TEXT;
+        partition_name TEXT;
+        default_rows BOOLEAN;
+        created INTEGER := 0;
+    BEGIN
+        EXECUTE FORMAT('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I DEFAULT', default_partition, parent_table);
+        SELECT a.attname INTO partition_key
+        FROM pg_partitioned_table p
+        JOIN pg_attribute a ON a.attrelid = p.partrelid AND a.attnum = p.partattrs[0]
+        WHERE p.partrelid = parent_table::REGCLASS;
+
+        WHILE month_start <= last_month LOOP
+            partition_name := parent_table || '_p' || TO_CHAR(month_start, 'YYYYMM');
+            IF TO_REGCLASS(partition_name) IS NULL THEN
+                -- Rows of the month that landed in the default partition (future dates, or months not created in
+                -- time) would make the new partition fail its check against the default one: they are moved out
+                -- first, and routed to the new partition once it exists
+                EXECUTE FORMAT(
+                    'SELECT EXISTS (SELECT 1 FROM %I WHERE %I >= %L AND %I < %L)',
+                    default_partition, partition_key, month_start,
+                    partition_key, (month_start + INTERVAL '1 month')::DATE
+                ) INTO default_rows;
+                IF default_rows THEN
+                    EXECUTE FORMAT(
+                        'CREATE TEMPORARY TABLE default_partition_rows AS SELECT * FROM %I WITH NO DATA',
+                        default_partition
+                    );
+                    EXECUTE FORMAT(
+                        'WITH moved AS (DELETE FROM %I WHERE %I >= %L AND %I < %L RETURNING *) '
+                        'INSERT INTO default_partition_rows SELECT * FROM moved',
+                        default_partition, partition_key, month_start,
+                        partition_key, (month_start + INTERVAL '1 month')::DATE
+                    );
+                END IF;
+                EXECUTE FORMAT(
+                    'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                    partition_name, parent_table, month_start, (month_start + INTERVAL '1 month')::DATE
+                );
+                IF default_rows THEN
+                    EXECUTE FORMAT('INSERT INTO %I SELECT * FROM default_partition_rows', parent_table);
+                    DROP TABLE default_partition_rows;
+                END IF;
+                created := created + 1;
+            END IF;
+            month_start := (month_start + INTERVAL '1 month')::DATE;
+        END LOOP;
+
+        RETURN created;
+    END;
+    $$;""",
+    "detach_monthly_partitions": """CREATE OR REPLACE FUNCTION detach_monthly_partitions(
+        parent_table TEXT,
+        older_than DATE
+    ) RETURNS INTEGER
+    LANGUAGE plpgsql
+    AS $$
+    DECLARE
+        partition_name TEXT;
+        detached INTEGER := 0;
+    BEGIN
+        -- Only partitions that end on or before the month of `older_than` are detached,
+        -- the detached tables are kept so they can be archived or dropped separately.
+        FOR partition_name IN
+            SELECT child.relname
+            FROM pg_inherits i
+            JOIN pg_class child ON child.oid = i.inhrelid
+            JOIN pg_class parent ON parent.oid = i.inhparent
+            WHERE parent.relname = parent_table
+              AND child.relname ~ ('^' || parent_table || '_p[0-9]{6}$')
+              AND TO_DATE(RIGHT(child.relname, 6), 'YYYYMM') + INTERVAL '1 month' <= DATE_TRUNC('month', older_than)
+            ORDER BY child.relname
+        LOOP
+            EXECUTE FORMAT('ALTER TABLE %I DETACH PARTITION %I', parent_table, partition_name);
+            detached := detached + 1;
+        END LOOP;
+
+        RETURN detached;
+    END;
+    $$;""",
+}
+
+ensure_partitions_query = """SELECT ensure_monthly_partitions(
+    :table_name,
+    (CURRENT_DATE - MAKE_INTERVAL(months => :months_back))::DATE,
+    :months_ahead
+);"""
+
+detach_partitions_query = "SELECT detach_monthly_partitions(:table_name, :older_than);"
+
+# Tables of `partitioned_tables` that earlier versions created unpartitioned. CREATE TABLE IF NOT EXISTS leaves them as
+# they are, db_setup.py migrates them (`migrate_to_partitioned()`).
+unpartitioned_tables_query = """SELECT relname AS table_name
+FROM pg_class
+WHERE oid IN (SELECT TO_REGCLASS(table_name) FROM UNNEST(CAST(:table_names AS TEXT[])) AS table_name)
+  AND relkind = 'r';"""
+
+table_indexes_query = """SELECT CAST(CAST(indexrelid AS REGCLASS) AS TEXT) AS index_name
+FROM pg_index
+WHERE indrelid = CAST(:table_name AS REGCLASS);"""
+
+run_history_init_query = """CREATE TABLE IF NOT EXISTS cdp_run_history (
+    run_id TEXT,
+    stage TEXT,
+    stage_order INTEGER,
+    status TEXT,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    duration_ms DOUBLE PRECISION,
+    rows_produced BIGINT,
+    hit_blocks BIGINT,
+    read_blocks BIGINT,
+    temp_written_blocks BIGINT,
+    error TEXT,
+    PRIMARY KEY (run_id, stage)
+);"""
+
+insert_run_history_query = """INSERT INTO cdp_run_history (
+    run_id, stage, stage_order, status, started_at, finished_at, duration_ms,
+    rows_produced, hit_blocks, read_blocks, temp_written_blocks, error
+) VALUES (
+    :run_id, :stage, :stage_order, :status, :started_at, :finished_at, :duration_ms,
+    :rows_produced, :hit_blocks, :read_blocks, :temp_written_blocks, :error
+);"""
+
+latest_run_query = """SELECT run_id FROM cdp_run_history
+WHERE stage = 'total'
+ORDER BY started_at DESC
+LIMIT 1;"""
+
+run_stages_query = """SELECT stage, status, duration_ms, rows_produced, hit_blocks, read_blocks, error
+FROM cdp_run_history
+WHERE run_id = :run_id
+ORDER BY stage_order, stage;"""
+
+previous_runs_stage_average_query = """WITH previous_runs AS (
+    SELECT run_id FROM cdp_run_history
+    WHERE stage = 'total' AND status = 'success'
+      AND started_at < (SELECT started_at FROM cdp_run_history WHERE run_id = :run_id AND stage = 'total')
+    ORDER BY started_at DESC
+    LIMIT :compare_runs
+)
+SELECT stage, AVG(duration_ms) AS avg_duration_ms, AVG(rows_produced) AS avg_rows_produced
+FROM cdp_run_history
+WHERE run_id IN (SELECT run_id FROM previous_runs)
+GROUP BY stage;"""
+
+customer_ranges_query = """SELECT MIN(customer_id), MAX(customer_id)
+FROM (
+    SELECT customer_id, NTILE(:shards) OVER (ORDER BY customer_id) AS shard
+    FROM customer_info
+) shards
+GROUP BY shard
+ORDER BY shard;"""
+
+customer_360_primary_key_query = "ALTER TABLE customer_360 ADD PRIMARY KEY (customer_id);"
+
+# Cohort retention matrix: customers of a registration month (cohort) active, i.e. purchasing, in each later month
+cohort_retention_init_query = """CREATE TABLE IF NOT EXISTS cohort_retention (
+    cohort_month DATE,
+    activity_month DATE,
+    months_since INTEGER,
+    cohort_size INTEGER,
+    active_customers INTEGER,
+    PRIMARY KEY (cohort_month, activity_month)
+);"""
+
+# Recomputes the cells of the activity months matched by {activity_filter}, an incremental refresh only reads the
+# purchase partitions of those months
+cohort_retention_refresh_query = """INSERT INTO cohort_retention
+WITH cohorts AS (
+    SELECT customer_id, CAST(DATE_TRUNC('month', registration_date) AS DATE) AS cohort_month
+    FROM customer_info
+), cohort_sizes AS (
+    SELECT cohort_month, COUNT(*) AS cohort_size
+    FROM cohorts
+    GROUP BY cohort_month
+), activity AS (
+    SELECT DISTINCT customer_id, CAST(DATE_TRUNC('month', purchase_date) AS DATE) AS activity_month
+    FROM purchase_transactions
+    WHERE {activity_filter}
+)
+SELECT
+    c.cohort_month,
+    a.activity_month,
+    CAST((EXTRACT(YEAR FROM a.activity_month) - EXTRACT(YEAR FROM c.cohort_month)) * 12
+        + EXTRACT(MONTH FROM a.activity_month) - EXTRACT(MONTH FROM c.cohort_month) AS INTEGER) AS months_since,
+    s.cohort_size,
+    COUNT(*) AS active_customers
+FROM activity a
+JOIN cohorts c ON a.customer_id = c.customer_id
+JOIN cohort_sizes s ON c.cohort_month = s.cohort_month
+WHERE a.activity_month >= c.cohort_month
+GROUP BY c.cohort_month, a.activity_month, s.cohort_size;"""
+
+# Cohorts can still gain customers after an incremental refresh of later months, their older cells get the new size
+cohort_sizes_update_query = """UPDATE cohort_retention r
+SET cohort_size = s.cohort_size
+FROM (
+    SELECT CAST(DATE_TRUNC('month', registration_date) AS DATE) AS cohort_month, COUNT(*) AS cohort_size
+    FROM customer_info
+    GROUP BY 1
+) s
+WHERE r.cohort_month = s.cohort_month AND r.cohort_size <> s.cohort_size;"""
+
+# Mergeable sketches behind the approximate KPIs of the backend. Buckets are months: registration months for the
+# customer_* sketches, purchase months for the purchase_* sketches, so a window of months is answered by merging its
+# buckets. kpi_sketches holds one row per (sketch, bucket, bin): *_dd sketches are DDSketch histograms (bin = log
+# bucket, value = count), every other sketch is a single additive counter in bin 0, both merge by SUM.
+# kpi_hll_sketches holds HyperLogLog registers, one byte (the rank) per register, they merge by MAX.
+kpi_sketches_init_query = """CREATE TABLE IF NOT EXISTS kpi_sketches (
+    sketch TEXT,
+    bucket DATE,
+    bin INTEGER,
+    value DOUBLE PRECISION,
+    PRIMARY KEY (sketch, bucket, bin)
+);"""
+
+kpi_hll_sketches_init_query = """CREATE TABLE IF NOT EXISTS kpi_hll_sketches (
+    sketch TEXT,
+    bucket DATE,
+    registers BYTEA,
+    PRIMARY KEY (sketch, bucket)
+);"""
+
+# DDSketch bin of a positive value x: ceil(log_gamma(x)), values <= 0 go to {zero_bin}
+customer_sketches_query = """INSERT INTO kpi_sketches (sketch, bucket, bin, value)
+WITH customers AS (
+    SELECT
+        COALESCE(CAST(DATE_TRUNC('month', registration_date) AS DATE), DATE '-infinity') AS bucket,
+        total_lifetime_value,
+        total_purchases,
+        average_order_value
+    FROM customer_360
+), counters AS (
+    SELECT
+        bucket,
+        COUNT(*) AS customers,
+        COUNT(*) FILTER (WHERE total_purchases > 1) AS repeat_customers,
+        SUM(total_lifetime_value) AS lifetime_value,
+        SUM(average_order_value) AS average_order_value_sum,
+        COUNT(average_order_value) AS average_order_value_count
+    FROM customers
+    GROUP BY bucket
+)
+SELECT c.sketch, counters.bucket, 0, COALESCE(c.value, 0)
+FROM counters
+CROSS JOIN LATERAL (
+    VALUES
+        ('customer_count', CAST(counters.customers AS DOUBLE PRECISION)),
+        ('customer_repeat_count', counters.repeat_customers),
+        ('customer_lifetime_value', counters.lifetime_value),
+        ('customer_average_order_value_sum', counters.average_order_value_sum),
+        ('customer_average_order_value_count', counters.average_order_value_count)
+) AS c (sketch, value)
+UNION ALL
+SELECT 'customer_lifetime_value_dd', bucket, bin, COUNT(*)
+FROM (
+    SELECT
+        bucket,
+        CASE
+            WHEN total_lifetime_value > 0 THEN CAST(CEIL(LN(total_lifetime_value) / LN({gamma})) AS INTEGER)
+            ELSE {zero_bin}
+        END AS bin
+    FROM customers
+    WHERE total_lifetime_value IS NOT NULL
+) bins
+GROUP BY bucket, bin;"""
+
+purchase_sketches_query = """INSERT INTO kpi_sketches (sketch, bucket, bin, value)
+WITH purchases AS (
+    SELECT CAST(DATE_TRUNC('month', purchase_date) AS DATE) AS bucket, total_amount
+    FROM purchase_transactions
+    WHERE {purchase_filter}
+)
+SELECT 'purchase_amount_dd', bucket, bin, COUNT(*)
+FROM (
+    SELECT
+        bucket,
+        CASE
+            WHEN total_amount > 0 THEN CAST(CEIL(LN(total_amount) / LN({gamma})) AS INTEGER)
+            ELSE {zero_bin}
+        END AS bin
+    FROM purchases
+    WHERE total_amount IS NOT NULL
+) bins
+GROUP BY bucket, bin
+UNION ALL
+SELECT 'purchase_revenue', bucket, 0, SUM(total_amount)
+FROM purchases
+GROUP BY bucket
+UNION ALL
+SELECT 'purchase_count', bucket, 0, COUNT(*)
+FROM purchases
+GROUP BY bucket;"""
+
+# HyperLogLog over a 64 bit hash of customer_id: the low {precision} bits pick the register, the rank is the position
+# of the first 1 bit among the next {rank_bits} bits. The registers of a month are written as one dense byte string.
+purchase_hll_sketches_query = """INSERT INTO kpi_hll_sketches (sketch, bucket, registers)
+WITH registers AS (
+    SELECT bucket, bin, MAX(rank) AS rank
+    FROM (
+        SELECT
+            bucket,
+            CAST(h & {register_mask} AS INTEGER) AS bin,
+            {rank_bits} + 1 - LENGTH(LTRIM(CAST(CAST(h >> {precision} AS BIT({rank_bits})) AS TEXT), '0')) AS rank
+        FROM (
+            SELECT CAST(DATE_TRUNC('month', purchase_date) AS DATE) AS bucket, hashint8extended(customer_id, 0) AS h
+            FROM purchase_transactions
+            WHERE {purchase_filter}
+        ) hashed
+    ) ranks
+    GROUP BY bucket, bin
+)
+SELECT
+    'purchase_customers_hll',
+    buckets.bucket,
+    DECODE(STRING_AGG(LPAD(TO_HEX(COALESCE(r.rank, 0)), 2, '0'), '' ORDER BY b.bin), 'hex')
+FROM (SELECT DISTINCT bucket FROM registers) buckets
+CROSS JOIN generate_series(0, {register_mask}) AS b (bin)
+LEFT JOIN registers r ON r.bucket = buckets.bucket AND r.bin = b.bin
+GROUP BY buckets.bucket;"""
+
+# Market basket affinity between products and between brands, a customer's purchases being one basket. Only the pairs
+# bought together by at least {min_customers} customers are kept, so the tables stay sparse and the related items of
+# one item are a range of the primary key. For an item A and a related item B:
+# support = customers(A and B) / customers, confidence = customers(A and B) / customers(A), lift = confidence /
+# (customers(B) / customers).
+product_affinity_init_query = """CREATE TABLE IF NOT EXISTS product_affinity (
+    product_id INTEGER,
+    related_product_id INTEGER,
+    customers INTEGER,
+    support REAL,
+    confidence REAL,
+    lift REAL,
+    PRIMARY KEY (product_id, related_product_id)
+);"""
+
+brand_affinity_init_query = """CREATE TABLE IF NOT EXISTS brand_affinity (
+    brand TEXT,
+    related_brand TEXT,
+    customers INTEGER,
+    support REAL,
+    confidence REAL,
+    lift REAL,
+    PRIMARY KEY (brand, related_brand)
+);"""
+
+# The (customer, item) baskets of one kind of item, {item} being pt.product_id or pc.brand. They are materialized and
+# analyzed before the pairs are counted, with the estimates of a CTE the planner can pick a nested loop self join.
+affinity_baskets_query = """CREATE TEMPORARY TABLE affinity_baskets AS
+SELECT DISTINCT pt.customer_id, {item} AS item
+FROM purchase_transactions pt
+JOIN product_catalog pc ON pc.product_id = pt.product_id
+WHERE {item} IS NOT NULL;"""
+
+# Every pair is counted once, by a single self join of the baskets, and written in both directions
+affinity_refresh_query = """INSERT INTO {table}
+WITH item_customers AS (
+    SELECT item, COUNT(*) AS customers
+    FROM affinity_baskets
+    GROUP BY item
+),
+total AS (
+    SELECT COUNT(DISTINCT customer_id) AS customers
+    FROM affinity_baskets
+),
+pairs AS (
+    SELECT a.item, b.item AS related_item, COUNT(*) AS customers
+    FROM affinity_baskets a
+    JOIN affinity_baskets b ON a.customer_id = b.customer_id AND a.item < b.item
+    GROUP BY a.item, b.item
+    HAVING COUNT(*) >= {min_customers}
+),
+directed_pairs AS (
+    SELECT item, related_item, customers FROM pairs
+    UNION ALL
+    SELECT related_item, item, customers FROM pairs
+)
+SELECT
+    p.item,
+    p.related_item,
+    p.customers,
+    CAST(p.customers AS DOUBLE PRECISION) / t.customers,
+    CAST(p.customers AS DOUBLE PRECISION) / i.customers,
+    CAST(p.customers AS DOUBLE PRECISION) * t.customers / (CAST(i.customers AS DOUBLE PRECISION) * r.customers)
+FROM directed_pairs p
+JOIN item_customers i ON i.item = p.item
+JOIN item_customers r ON r.item = p.related_item
+CROSS JOIN total t;"""
+
+# Aggregates of the brand and category scoped dashboards. A scope is a brand or a category of product_catalog
+# (scope_type 'brand' or 'category'), its customers are the customers who bought its products and its revenue the
+# revenue of its products. Every scope of both types is aggregated in one pass, by GROUPING SETS.
+
+# The customers of every scope with their revenue and purchases in it. Built aside and swapped in, like customer_360:
+# its index is built once over all the rows instead of updated row by row. The index serves both the customers of a
+# scope and its top customers by revenue.
+scope_customers_build_query = """CREATE TABLE scope_customers_staging AS
+SELECT
+    CASE WHEN GROUPING(pc.brand) = 0 THEN 'brand' ELSE 'category' END AS scope_type,
+    CASE WHEN GROUPING(pc.brand) = 0 THEN pc.brand ELSE pc.category END AS scope,
+    pt.customer_id,
+    SUM(CAST(pt.total_amount AS DOUBLE PRECISION)) AS revenue,
+    CAST(COUNT(*) AS INTEGER) AS purchases
+FROM purchase_transactions pt
+JOIN product_catalog pc ON pc.product_id = pt.product_id
+WHERE pt.customer_id IS NOT NULL
+GROUP BY GROUPING SETS ((pc.brand, pt.customer_id), (pc.category, pt.customer_id))
+HAVING CASE WHEN GROUPING(pc.brand) = 0 THEN pc.brand ELSE pc.category END IS NOT NULL;"""
+
+scope_customers_index_query = """CREATE INDEX scope_customers_staging_revenue_idx
+ON scope_customers_staging (scope_type, scope, revenue DESC);"""
+
+# One row per scope with dimension 'total', and one per customer segment and churn risk score of its customers
+scope_metrics_init_query = """CREATE TABLE IF NOT EXISTS scope_metrics (
+    scope_type TEXT,
+    scope TEXT,
+    dimension TEXT,
+    dimension_value TEXT,
+    customers INTEGER,
+    revenue DOUBLE PRECISION,
+    average_order_value DOUBLE PRECISION,
+    repeat_customers INTEGER,
+    average_satisfaction_score DOUBLE PRECISION
+);"""
+
+scope_metrics_index_query = """CREATE INDEX IF NOT EXISTS scope_metrics_scope_idx
+ON scope_metrics (scope_type, scope, dimension);"""
+
+# Revenue of a scope per purchase month and product category
+scope_revenue_init_query = """CREATE TABLE IF NOT EXISTS scope_revenue (
+    scope_type TEXT,
+    scope TEXT,
+    month DATE,
+    category TEXT,
+    revenue DOUBLE PRECISION,
+    PRIMARY KEY (scope_type, scope, month, category)
+);"""
+
+# The cohort retention matrix of every scope, the cohorts being the customers of the scope
+scope_cohort_retention_init_query = """CREATE TABLE IF NOT EXISTS scope_cohort_retention (
+    scope_type TEXT,
+    scope TEXT,
+    cohort_month DATE,
+    months_since INTEGER,
+    cohort_size INTEGER,
+    active_customers INTEGER,
+    PRIMARY KEY (scope_type, scope, cohort_month, months_since)
+);"""
+
+# The totals, segments and churn risk scores of every scope in one pass over the new scope customers. A NULL segment
+# or score is a group of its own, GROUPING tells it apart from the totals.
+scope_metrics_refresh_query = """INSERT INTO scope_metrics
+SELECT
+    sc.scope_type,
+    sc.scope,
+    CASE
+        WHEN GROUPING(c.customer_segment) = 0 THEN 'customer_segment'
+        WHEN GROUPING(c.churn_risk_score) = 0 THEN 'churn_risk_score'
+        ELSE 'total'
+    END,
+    CASE WHEN GROUPING(c.customer_segment) = 0 THEN c.customer_segment ELSE c.churn_risk_score END,
+    COUNT(*),
+    SUM(sc.revenue),
+    AVG(sc.revenue / sc.purchases),
+    COUNT(*) FILTER (WHERE sc.purchases > 1),
+    AVG(c.average_satisfaction_score)
+FROM scope_customers_staging sc
+JOIN customer_360 c ON c.customer_id = sc.customer_id
+GROUP BY GROUPING SETS (
+    (sc.scope_type, sc.scope),
+    (sc.scope_type, sc.scope, c.customer_segment),
+    (sc.scope_type, sc.scope, c.churn_risk_score)
+);"""
+
+scope_revenue_refresh_query = """INSERT INTO scope_revenue
+SELECT
+    CASE WHEN GROUPING(pc.brand) = 0 THEN 'brand' ELSE 'category' END,
+    CASE WHEN GROUPING(pc.brand) = 0 THEN pc.brand ELSE pc.category END,
+    CAST(DATE_TRUNC('month', pt.purchase_date) AS DATE),
+    pc.category,
+    SUM(CAST(pt.total_amount AS DOUBLE PRECISION))
+FROM purchase_transactions pt
+JOIN product_catalog pc ON pc.product_id = pt.product_id
+WHERE pc.category IS NOT NULL
+GROUP BY GROUPING SETS (
+    (pc.brand, DATE_TRUNC('month', pt.purchase_date), pc.category),
+    (DATE_TRUNC('month', pt.purchase_date), pc.category)
+)
+HAVING GROUPING(pc.brand) = 1 OR pc.brand IS NOT NULL;"""
+
+# Active customers of every scope, cohort and month in one pass over the purchases, the cohort sizes from the new
+# scope customers
+scope_cohort_retention_refresh_query = """INSERT INTO scope_cohort_retention
+WITH active AS (
+    SELECT
+        CASE WHEN GROUPING(pc.brand) = 0 THEN 'brand' ELSE 'category' END AS scope_type,
+        CASE WHEN GROUPING(pc.brand) = 0 THEN pc.brand ELSE pc.category END AS scope,
+        CAST(DATE_TRUNC('month', ci.registration_date) AS DATE) AS cohort_month,
+        CAST(DATE_TRUNC('month', pt.purchase_date) AS DATE) AS activity_month,
+        COUNT(DISTINCT pt.customer_id) AS active_customers
+    FROM purchase_transactions pt
+    JOIN product_catalog pc ON pc.product_id = pt.product_id
+    JOIN customer_info ci ON ci.customer_id = pt.customer_id
+    WHERE pt.purchase_date >= DATE_TRUNC('month', ci.registration_date)
+    GROUP BY GROUPING SETS (
+        (pc.brand, DATE_TRUNC('month', ci.registration_date), DATE_TRUNC('month', pt.purchase_date)),
+        (pc.category, DATE_TRUNC('month', ci.registration_date), DATE_TRUNC('month', pt.purchase_date))
+    )
+), cohort_sizes AS (
+    SELECT
+        sc.scope_type,
+        sc.scope,
+        CAST(DATE_TRUNC('month', ci.registration_date) AS DATE) AS cohort_month,
+        COUNT(*) AS cohort_size
+    FROM scope_customers_staging sc
+    JOIN customer_info ci ON ci.customer_id = sc.customer_id
+    GROUP BY 1, 2, 3
+)
+SELECT
+    a.scope_type,
+    a.scope,
+    a.cohort_month,
+    CAST((EXTRACT(YEAR FROM a.activity_month) - EXTRACT(YEAR FROM a.cohort_month)) * 12
+        + EXTRACT(MONTH FROM a.activity_month) - EXTRACT(MONTH FROM a.cohort_month) AS INTEGER),
+    s.cohort_size,
+    a.active_customers
+FROM active a
+JOIN cohort_sizes s ON s.scope_type = a.scope_type AND s.scope = a.scope AND s.cohort_month = a.cohort_month;"""
+
+# Customers rebuilt by an incremental build
+refresh_customers_init_query = "CREATE TEMPORARY TABLE temp_refresh_customers (customer_id INTEGER PRIMARY KEY) ON COMMIT DROP;"
+
+refresh_customers_by_id_query = """INSERT INTO temp_refresh_customers
+SELECT DISTINCT customer_id FROM unnest(CAST(:customer_ids AS INTEGER[])) AS customer_id;"""
+
+refresh_customers_since_query = """INSERT INTO temp_refresh_customers
+SELECT customer_id FROM customer_info WHERE registration_date >= :since
+UNION
+SELECT customer_id FROM purchase_transactions WHERE purchase_date >= :since
+UNION
+SELECT customer_id FROM customer_service WHERE interaction_date >= :since
+UNION
+SELECT customer_id FROM campaign_responses WHERE response_date >= :since
+UNION
+SELECT customer_id FROM website_behavior WHERE visit_date >= :since;"""
+
+# A full build reads the source tables from one exported snapshot, held open by a repeatable read transaction
+build_snapshot_query = "SELECT pg_export_snapshot() AS snapshot_id, CAST(pg_current_snapshot() AS TEXT) AS snapshot;"
+
+# Customers of the batches ingested by the backend, under the id of the transaction that ingested them. The backend
+# creates the same table (backend/ingestion_queries.py).
+ingestion_log_init_query = """CREATE TABLE IF NOT EXISTS customer_360_ingestion_log (
+    customer_id INTEGER NOT NULL,
+    xact_id XID8 NOT NULL DEFAULT pg_current_xact_id()
+);"""
+
+# Batches write the log first, so holding it locked keeps them away from customer_360. Taking the lock waits for the
+# batches already running to commit.
+ingestion_log_lock_query = "LOCK TABLE customer_360_ingestion_log IN EXCLUSIVE MODE;"
+
+# Customers of a build, full or incremental, with batches committed after the snapshot the build was made from
+ingested_customers_init_query = "CREATE TEMPORARY TABLE temp_ingested_customers (customer_id INTEGER PRIMARY KEY) ON COMMIT DROP;"
+
+ingested_customers_query = """INSERT INTO temp_ingested_customers
+SELECT DISTINCT customer_id
+FROM customer_360_ingestion_log
+WHERE NOT pg_visible_in_snapshot(xact_id, CAST(CAST(:snapshot AS TEXT) AS pg_snapshot))
+  AND customer_id IN (SELECT customer_id FROM {target_table});"""
+
+# With the log locked, every batch it holds is in the build being published. Builds run one at a time, so no other
+# build needs the batches of the log.
+trim_ingestion_log_query = "DELETE FROM customer_360_ingestion_log;"
+
+# Moves the serial sequence of a table past the explicitly generated primary keys
+reset_sequence_query = """SELECT setval(
+    pg_get_serial_sequence('{table_name}', '{id_column}'),
+    (SELECT COALESCE(MAX({id_column}), 0) + 1 FROM {table_name}),
+    false
+);"""
+
+# Foreign keys declared on the given tables. Constraints cloned onto partitions (conparentid <> 0) are left out, they
+# follow the constraint of their partitioned parent.
+foreign_keys_query = """SELECT conrelid::regclass::text AS table_name, conname AS constraint_name, pg_get_constraintdef(oid) AS definition
+FROM pg_constraint
+WHERE contype = 'f'
+  AND conparentid = 0
+  AND conrelid::regclass::text = ANY(CAST(:table_names AS TEXT[]))
+ORDER BY table_name, constraint_name;"""
+
+# One row per chunk committed by the loader, written in the same transaction as the chunk itself. A load is identified
+# by its generator settings (`load_key`), a rerun of the same load skips the chunks recorded here.
+load_checkpoints_init_query = """CREATE TABLE IF NOT EXISTS cdp_load_checkpoints (
+    load_key TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    chunk INTEGER NOT NULL,
+    rows_loaded INTEGER NOT NULL,
+    loaded_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (load_key, table_name, chunk)
+);"""
+
+insert_load_checkpoint_query = """INSERT INTO cdp_load_checkpoints (load_key, table_name, chunk, rows_loaded)
+VALUES (:load_key, :table_name, :chunk, :rows_loaded);"""
+
+load_checkpoints_query = """SELECT table_name, chunk, rows_loaded
+FROM cdp_load_checkpoints
+WHERE load_key = :load_key;"""
+
+delete_load_checkpoints_query = """DELETE FROM cdp_load_checkpoints
+WHERE load_key = :load_key AND table_name = :table_name;"""
+
+table_columns_query = """SELECT column_name, data_type
+FROM information_schema.columns
+WHERE table_schema = current_schema() AND table_name = :table_name
+ORDER BY ordinal_position;"""
+
+# Reconciliation aggregates of the customer_360 build, one scan per table (see reconcile.py). Sums are taken in double
+# precision, the REAL columns would otherwise be accumulated in single precision.
+reconciliation_source_queries = {
+    "customer_info": """SELECT
+        COUNT(*) AS customers,
+        AVG(CASE WHEN first_name IS NULL THEN 1.0 ELSE 0.0 END) AS first_name_null_rate,
+        AVG(CASE WHEN email IS NULL THEN 1.0 ELSE 0.0 END) AS email_null_rate
+    FROM customer_info;""",
+    "purchase_transactions": """WITH per_customer AS (
+        SELECT customer_id, SUM(total_amount) AS lifetime_value, COUNT(DISTINCT transaction_id) AS purchases
+        FROM purchase_transactions
+        GROUP BY customer_id
+    )
+    SELECT
+        COUNT(*) AS purchasing_customers,
+        SUM(CAST(lifetime_value AS DOUBLE PRECISION)) AS lifetime_value,
+        SUM(purchases) AS purchases,
+        COUNT(*) FILTER (WHERE lifetime_value > 1000) AS high_value_customers,
+        COUNT(*) FILTER (WHERE lifetime_value > 500 AND lifetime_value <= 1000) AS medium_value_customers
+    FROM per_customer;""",
+    "customer_service": """SELECT COUNT(DISTINCT customer_id) AS engaged_customers FROM customer_service;""",
+    # website behaviour only counts for customers with service interactions, like in the build
+    "website_behavior": """SELECT COUNT(DISTINCT wb.session_id) AS website_visits
+    FROM website_behavior wb
+    WHERE EXISTS (SELECT 1 FROM customer_service cs WHERE cs.customer_id = wb.customer_id);""",
+    "campaign_responses": """SELECT COUNT(DISTINCT customer_id) AS responding_customers FROM campaign_responses;""",
 }
+
+reconciliation_target_query = """SELECT
+    COUNT(*) AS rows,
+    COUNT(DISTINCT customer_id) AS customers,
+    COUNT(total_purchases) AS purchasing_customers,
+    SUM(CAST(total_lifetime_value AS DOUBLE PRECISION)) AS lifetime_value,
+    SUM(total_purchases) AS purchases,
+    COUNT(*) FILTER (WHERE customer_segment = 'High Value') AS high_value_customers,
+    COUNT(*) FILTER (WHERE customer_segment = 'Medium Value') AS medium_value_customers,
+    COUNT(last_interaction_date) AS engaged_customers,
+    COALESCE(SUM(total_website_visits), 0) AS website_visits,
+    COUNT(campaign_response_rate) AS responding_customers,
+    AVG(CASE WHEN first_name IS NULL THEN 1.0 ELSE 0.0 END) AS first_name_null_rate,
+    AVG(CASE WHEN email IS NULL THEN 1.0 ELSE 0.0 END) AS email_null_rate,
+    AVG(CASE WHEN customer_segment IS NULL THEN 1.0 ELSE 0.0 END) AS segment_null_rate,
+    AVG(CASE WHEN churn_risk_score IS NULL THEN 1.0 ELSE 0.0 END) AS churn_risk_null_rate
+FROM {target_table};"""
@@ -0,0 +1,191 @@
+import os
+import csv
+import gzip
+import hashlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+# Reads CSV and Parquet extracts of the CDP source tables in Arrow record batches and turns them into the
+# (table_name, chunk, columns, records) work items of the loader in `db_setup.py`. Files are memory mapped and read a
+# batch at a time, so an extract is never materialized in memory as a whole.
+#
+# Every batch is cast to the column types of the target table. A batch that doesn't cast is split in halves until the
+# offending rows are isolated, those rows (and CSV lines that don't parse) are written to a reject file instead of
+# failing the load.
+
+DEFAULT_BATCH_SIZE = 50000
+CSV_BLOCK_SIZE = 16 << 20
+
+# Postgres data types of the source tables mapped to the Arrow types batches are cast to
+arrow_types = {
+    "integer": pa.int32(),
+    "real": pa.float32(),
+    "text": pa.string(),
+    "date": pa.date32(),
+}
+
+
+def table_for_path(path: str, table_names: Iterable[str]) -> str:
+    # `purchase_transactions.csv`, `purchase_transactions_2024_10.parquet`, ... -> purchase_transactions
+    stem = os.path.basename(path).split(".")[0]
+    matches = [table_name for table_name in table_names if stem == table_name or stem.startswith(f"{table_name}_")]
+    if not matches:
+        raise ValueError(f"Can't tell which table {path} belongs to, name it <table>[_suffix].csv/.parquet or pass --table")
+    return max(matches, key=len)
+
+
+class FileSource:
+    def __init__(self, path: str, table_name: str, column_types: Dict[str, pa.DataType], batch_size: int):
+        self.path = path
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.is_parquet = path.endswith(".parquet")
+        file_columns = self.read_columns()
+        # columns missing from the file are left to their defaults (serial ids) or NULL
+        self.column_types = {column: type_ for column, type_ in column_types.items() if column in file_columns}
+        if not self.column_types:
+            raise ValueError(f"{path} has none of the columns of {table_name}")
+
+    def read_columns(self) -> List[str]:
+        if self.is_parquet:
+            return pq.ParquetFile(self.path, memory_map=True).schema_arrow.names
+        with open_text(self.path) as f:
+            return next(csv.reader(f))
+
+    @property
+    def num_rows(self) -> Optional[int]:
+        # only known up front for parquet, from the footer
+        return pq.ParquetFile(self.path, memory_map=True).metadata.num_rows if self.is_parquet else None
+
+    @property
+    def signature(self) -> str:
+        stat = os.stat(self.path)
+        return f"{os.path.abspath(self.path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+    def iter_batches(self, malformed: List[str]) -> Iterator[pa.RecordBatch]:
+        columns = list(self.column_types)
+        if self.is_parquet:
+            yield from pq.ParquetFile(self.path, memory_map=True).iter_batches(self.batch_size, columns=columns)
+            return
+
+        def skip_malformed(row):
+            malformed.append(row.text)
+            return "skip"
+
+        reader = pv.open_csv(
+            # compressed extracts are decompressed by arrow on the fly, they can't be memory mapped
+            self.path if self.path.endswith(".gz") else pa.memory_map(self.path),
+            read_options=pv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+            parse_options=pv.ParseOptions(invalid_row_handler=skip_malformed),
+            # everything is read as text and cast afterwards, so a bad value rejects a row instead of the whole file
+            convert_options=pv.ConvertOptions(
+                include_columns=columns,
+                column_types={column: pa.string() for column in columns},
+                strings_can_be_null=True,
+            ),
+        )
+        for batch in reader:
+            # CSV blocks are sized in bytes, re-slice them to the batch size
+            for offset in range(0, batch.num_rows, self.batch_size):
+                yield batch.slice(offset, self.batch_size)
+
+
+def open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", newline="")
+    return open(path, newline="")
+
+
+def cast_batch(batch: pa.RecordBatch, column_types: Dict[str, pa.DataType]) -> pa.Table:
+    arrays = [pc.cast(batch.column(column), type_) for column, type_ in column_types.items()]
+    return pa.Table.from_arrays(arrays, names=list(column_types))
+
+
+def coerce_batch(
+    batch: pa.RecordBatch, column_types: Dict[str, pa.DataType]
+) -> Tuple[List[pa.Table], List[Tuple[dict, str]]]:
+    # (cast tables, rejected rows with the reason), the common case is a single vectorized cast of the whole batch
+    try:
+        return [cast_batch(batch, column_types)], []
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        if batch.num_rows == 1:
+            return [], [(batch.to_pylist()[0], str(e))]
+    middle = batch.num_rows // 2
+    head_tables, head_rejects = coerce_batch(batch.slice(0, middle), column_types)
+    tail_tables, tail_rejects = coerce_batch(batch.slice(middle), column_types)
+    return head_tables + tail_tables, head_rejects + tail_rejects
+
+
+class RejectWriter:
+    # `<reject_dir>/<file name>.rejects.csv`, only created once a row is rejected
+    def __init__(self, reject_dir: str, source: FileSource, append: bool):
+        self.path = os.path.join(reject_dir, f"{os.path.basename(source.path)}.rejects.csv")
+        self.columns = list(source.column_types)
+        self.mode = "a" if append else "w"
+        self.file = None
+        self.writer = None
+        self.count = 0
+
+    def write(self, rows: List[Tuple[dict, str]], malformed: List[str]):
+        if not rows and not malformed:
+            return
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            write_header = self.mode == "w" or not os.path.exists(self.path)
+            self.file = open(self.path, self.mode, newline="")
+            self.writer = csv.writer(self.file)
+            if write_header:
+                self.writer.writerow(self.columns + ["reject_reason"])
+        for row, reason in rows:
+            self.writer.writerow([row.get(column) for column in self.columns] + [reason])
+        for line in malformed:
+            self.writer.writerow([line] + [None] * (len(self.columns) - 1) + ["malformed CSV row"])
+        self.count += len(rows) + len(malformed)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            print(f"{self.count} rejected rows written to {self.path}")
+
+
+def sources_key(sources: List[FileSource]) -> str:
+    # Checkpoints are only valid for a rerun over the same, unchanged files with the same batch size
+    signatures = "|".join(f"{source.signature}:{source.batch_size}" for source in sources)
+    return f"files:{hashlib.sha1(signatures.encode()).hexdigest()}"
+
+
+def file_work_items(
+    sources: List[FileSource],
+    table_names: Iterable[str],
+    checkpoints: Dict[str, Dict[int, int]],
+    reject_dir: str,
+) -> Iterator[tuple]:
+    # Chunks are numbered per table across all of its files, checkpointed chunks are read but not loaded again
+    for table_name in table_names:
+        chunk = 0
+        done = checkpoints.get(table_name, {})
+        for source in (source for source in sources if source.table_name == table_name):
+            rejects = RejectWriter(reject_dir, source, append=bool(done))
+            try:
+                malformed = []
+                for batch in source.iter_batches(malformed):
+                    if chunk in done:
+                        chunk += 1
+                        malformed.clear()
+                        continue
+                    tables, rejected = coerce_batch(batch, source.column_types)
+                    rejects.write(rejected, malformed)
+                    malformed.clear()
+                    records = [
+                        record
+                        for table in tables
+                        for record in zip(*(column.to_pylist() for column in table.columns))
+                    ]
+                    yield table_name, chunk, list(source.column_types), records
+                    chunk += 1
+            finally:
+                rejects.close()
@@ -0,0 +1,106 @@
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.sql import text
+from colorama import Fore, Style
+
+from db_setup_queries import reconciliation_source_queries, reconciliation_target_query
+
+# Reconciliation of a customer_360 build against its source tables. Every source table and the built table are
+# aggregated in a single scan each, all scans run concurrently on separate connections, and the aggregates are then
+# compared by the rules below. `cdp_procedure.py` runs it on the staging table before publishing a build, with the
+# source tables read from the snapshot the build was made from, so that events ingested meanwhile don't count.
+
+# name, expected value (source table and aggregate, or a constant), customer_360 aggregate,
+# absolute tolerance, relative tolerance
+reconciliation_checks: List[Tuple[str, Any, str, float, float]] = [
+    ("customer_count", ("customer_info", "customers"), "customers", 0, 0),
+    ("one_row_per_customer", ("customer_info", "customers"), "rows", 0, 0),
+    ("purchasing_customers", ("purchase_transactions", "purchasing_customers"), "purchasing_customers", 0, 0),
+    ("purchase_count", ("purchase_transactions", "purchases"), "purchases", 0, 0),
+    # REAL amounts are summed per customer in single precision, so the totals only agree up to rounding
+    ("lifetime_value_sum", ("purchase_transactions", "lifetime_value"), "lifetime_value", 0.01, 1e-5),
+    # customers right at a segment boundary can land on either side of it depending on the summation order
+    ("high_value_customers", ("purchase_transactions", "high_value_customers"), "high_value_customers", 0, 1e-3),
+    ("medium_value_customers", ("purchase_transactions", "medium_value_customers"), "medium_value_customers", 0, 1e-3),
+    ("engaged_customers", ("customer_service", "engaged_customers"), "engaged_customers", 0, 0),
+    ("website_visits", ("website_behavior", "website_visits"), "website_visits", 0, 0),
+    ("responding_customers", ("campaign_responses", "responding_customers"), "responding_customers", 0, 0),
+    ("first_name_null_rate", ("customer_info", "first_name_null_rate"), "first_name_null_rate", 0, 1e-9),
+    ("email_null_rate", ("customer_info", "email_null_rate"), "email_null_rate", 0, 1e-9),
+    ("segment_null_rate", 0, "segment_null_rate", 0, 0),
+    ("churn_risk_null_rate", 0, "churn_risk_null_rate", 0, 0),
+]
+
+
+class ReconciliationError(Exception):
+    def __init__(self, failed_checks: List[Dict[str, Any]]):
+        self.failed_checks = failed_checks
+        super().__init__(
+            "Reconciliation failed: "
+            + ", ".join(f"{c['check']} (expected {c['expected']}, got {c['actual']})" for c in failed_checks)
+        )
+
+
+def evaluate_checks(
+    source_aggregates: Dict[str, Dict[str, Any]], target_aggregates: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    results = []
+    for check, expected, actual_name, absolute_tolerance, relative_tolerance in reconciliation_checks:
+        if isinstance(expected, tuple):
+            table_name, aggregate = expected
+            expected = source_aggregates[table_name][aggregate]
+        # aggregates over no rows are NULL
+        expected = float(expected or 0)
+        actual = float(target_aggregates[actual_name] or 0)
+        tolerance = max(absolute_tolerance, relative_tolerance * abs(expected))
+        results.append(
+            {
+                "check": check,
+                "expected": expected,
+                "actual": actual,
+                "tolerance": tolerance,
+                "passed": abs(actual - expected) <= tolerance,
+            }
+        )
+    return results
+
+
+async def import_snapshot(session, snapshot_id: str):
+    # has to start the transaction, the snapshot is only available while the transaction that exported it is open
+    await session.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+    await session.execute(text(f"SET TRANSACTION SNAPSHOT '{snapshot_id}'"))
+
+
+async def fetch_aggregates(Session, query: str, snapshot_id: Optional[str] = None) -> Dict[str, Any]:
+    async with Session() as session:
+        if snapshot_id:
+            await import_snapshot(session, snapshot_id)
+        result = await session.execute(text(query))
+        return dict(result.mappings().one())
+
+
+async def reconcile(
+    Session, target_table: str = "customer_360", snapshot_id: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    table_names = list(reconciliation_source_queries)
+    aggregates = await asyncio.gather(
+        *(
+            fetch_aggregates(Session, reconciliation_source_queries[table_name], snapshot_id)
+            for table_name in table_names
+        ),
+        # the target was committed after the snapshot, it is read as of now
+        fetch_aggregates(Session, reconciliation_target_query.format(target_table=target_table)),
+    )
+    return evaluate_checks(dict(zip(table_names, aggregates[:-1])), aggregates[-1])
+
+
+def print_reconciliation(results: List[Dict[str, Any]], target_table: Optional[str] = None):
+    print(f"\nReconciliation of {target_table or 'customer_360'}:")
+    print(f"{'check':<28}{'expected':>18}{'actual':>18}{'tolerance':>12}")
+    for result in results:
+        color = "" if result["passed"] else Fore.RED
+        print(
+            f"{color}{result['check']:<28}{result['expected']:>18,.4f}{result['actual']:>18,.4f}"
+            f"{result['tolerance']:>12,.4f}{Style.RESET_ALL}"
+        )
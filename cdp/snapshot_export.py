@@ -0,0 +1,211 @@
+import os
+import json
+import shutil
+from datetime import datetime, timezone
+from typing import Any, Dict, List
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy.sql import text
+
+# Columnar snapshots of customer_360 for bulk consumers, written by the build after it published a version. The
+# snapshot of a build is a directory named after its run id, with:
+# - part-NNNNN.parquet: zstd compressed, in row groups of SNAPSHOT_BATCH_ROWS customers with min/max statistics, so
+#   readers skip the row groups of the customers they don't need
+# - part-NNNNN.arrow: the same rows as uncompressed Arrow IPC, which readers memory map instead of decoding
+# - manifest.json: the schema and the files of the snapshot
+# Parts hold SNAPSHOT_ROWS_PER_FILE customers in customer_id order. Low cardinality text columns are dictionary
+# encoded in both formats, with one dictionary per column shared by all the parts. The snapshot is read in one
+# repeatable read transaction, events ingested meanwhile don't tear it.
+#
+# A snapshot is written to a temporary directory and renamed once complete, then LATEST is pointed at it. Only the
+# snapshots of the last SNAPSHOT_KEEP builds are kept.
+
+SNAPSHOT_KEEP = int(os.environ.get("SNAPSHOT_KEEP", 3))
+SNAPSHOT_ROWS_PER_FILE = int(os.environ.get("SNAPSHOT_ROWS_PER_FILE", 1000000))
+
+# Rows fetched from postgres at a time, also the row groups of the parquet files
+SNAPSHOT_BATCH_ROWS = 50000
+
+MANIFEST_FILE = "manifest.json"
+LATEST_FILE = "LATEST"
+
+# Postgres data types of customer_360 mapped to the Arrow types of the snapshot, numeric columns are read as doubles
+arrow_types = {
+    "integer": pa.int32(),
+    "bigint": pa.int64(),
+    "real": pa.float32(),
+    "double precision": pa.float64(),
+    "numeric": pa.float64(),
+    "text": pa.string(),
+    "date": pa.date32(),
+}
+
+dictionary_columns = {
+    "favorite_product_category",
+    "favorite_brand",
+    "last_interaction_type",
+    "most_viewed_product_category",
+    "preferred_marketing_channel",
+    "customer_segment",
+    "churn_risk_score",
+}
+
+customer_360_columns_query = """SELECT column_name, data_type
+FROM information_schema.columns
+WHERE table_schema = current_schema() AND table_name = 'customer_360'
+ORDER BY ordinal_position;"""
+
+
+async def snapshot_schema(session) -> pa.Schema:
+    fields = []
+    for column, data_type in (await session.execute(text(customer_360_columns_query))).fetchall():
+        if data_type not in arrow_types:
+            raise ValueError(f"customer_360.{column} is of type {data_type}, which has no Arrow type")
+        arrow_type = arrow_types[data_type]
+        if column in dictionary_columns:
+            arrow_type = pa.dictionary(pa.int32(), arrow_type)
+        fields.append(pa.field(column, arrow_type, nullable=column != "customer_id"))
+    return pa.schema(fields)
+
+
+async def snapshot_dictionaries(session, schema: pa.Schema) -> Dict[str, pa.Array]:
+    # the distinct values of every dictionary encoded column, in one scan
+    columns = [field.name for field in schema if pa.types.is_dictionary(field.type)]
+    if not columns:
+        return {}
+    aggregates = ", ".join(f"array_agg(DISTINCT {column}) FILTER (WHERE {column} IS NOT NULL)" for column in columns)
+    values = (await session.execute(text(f"SELECT {aggregates} FROM customer_360"))).fetchone()
+    return {
+        column: pa.array(column_values or [], type=schema.field(column).type.value_type)
+        for column, column_values in zip(columns, values)
+    }
+
+
+def column_array(values: list, field: pa.Field, dictionaries: Dict[str, pa.Array]) -> pa.Array:
+    if pa.types.is_dictionary(field.type):
+        dictionary = dictionaries[field.name]
+        indices = pc.index_in(pa.array(values, type=dictionary.type), value_set=dictionary)
+        return pa.DictionaryArray.from_arrays(indices.cast(field.type.index_type), dictionary)
+    return pa.array(values, type=field.type)
+
+
+def select_query(schema: pa.Schema) -> str:
+    columns = [
+        f"CAST({field.name} AS DOUBLE PRECISION) AS {field.name}" if field.type == pa.float64() else field.name
+        for field in schema
+    ]
+    return f"SELECT {', '.join(columns)} FROM customer_360 ORDER BY customer_id"
+
+
+class SnapshotPart:
+    # Writer of one part, in both formats
+    def __init__(self, directory: str, number: int, schema: pa.Schema):
+        self.name = f"part-{number:05d}"
+        self.paths = {
+            "parquet": os.path.join(directory, f"{self.name}.parquet"),
+            "arrow": os.path.join(directory, f"{self.name}.arrow"),
+        }
+        self.parquet_writer = pq.ParquetWriter(self.paths["parquet"], schema, compression="zstd", write_statistics=True)
+        self.arrow_writer = pa.ipc.new_file(self.paths["arrow"], schema)
+        self.rows = 0
+        self.min_customer_id = None
+        self.max_customer_id = None
+
+    def write(self, batch: pa.RecordBatch):
+        self.parquet_writer.write_batch(batch)
+        self.arrow_writer.write_batch(batch)
+        customer_ids = batch.column("customer_id")
+        if self.min_customer_id is None:
+            self.min_customer_id = customer_ids[0].as_py()
+        self.max_customer_id = customer_ids[-1].as_py()
+        self.rows += batch.num_rows
+
+    def close(self) -> List[Dict[str, Any]]:
+        self.parquet_writer.close()
+        self.arrow_writer.close()
+        return [
+            {
+                "file": os.path.basename(path),
+                "format": file_format,
+                "rows": self.rows,
+                "bytes": os.path.getsize(path),
+                "min_customer_id": self.min_customer_id,
+                "max_customer_id": self.max_customer_id,
+            }
+            for file_format, path in self.paths.items()
+        ]
+
+
+async def write_snapshot(Session, run_id: str, snapshot_dir: str) -> Dict[str, Any]:
+    # Writes the current customer_360 as the snapshot of `run_id` and returns its manifest
+    os.makedirs(snapshot_dir, exist_ok=True)
+    directory = os.path.join(snapshot_dir, run_id)
+    temporary_directory = os.path.join(snapshot_dir, f".{run_id}.tmp")
+    shutil.rmtree(temporary_directory, ignore_errors=True)
+    os.makedirs(temporary_directory)
+
+    files = []
+    rows = 0
+    part = None
+    try:
+        async with Session() as session:
+            await session.execute(text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+            schema = await snapshot_schema(session)
+            dictionaries = await snapshot_dictionaries(session, schema)
+            result = await session.stream(text(select_query(schema)))
+            async for chunk in result.partitions(SNAPSHOT_BATCH_ROWS):
+                batch = pa.RecordBatch.from_arrays(
+                    [column_array([row[i] for row in chunk], field, dictionaries) for i, field in enumerate(schema)],
+                    schema=schema,
+                )
+                # a batch is split where a part fills up
+                offset = 0
+                while offset < batch.num_rows:
+                    if part is None:
+                        part = SnapshotPart(temporary_directory, len(files) // 2, schema)
+                    length = min(batch.num_rows - offset, SNAPSHOT_ROWS_PER_FILE - part.rows)
+                    part.write(batch.slice(offset, length))
+                    offset += length
+                    if part.rows == SNAPSHOT_ROWS_PER_FILE:
+                        files.extend(part.close())
+                        part = None
+                rows += batch.num_rows
+        if part is not None:
+            files.extend(part.close())
+            part = None
+
+        manifest = {
+            "run_id": run_id,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "rows": rows,
+            "schema": [{"name": field.name, "type": str(field.type)} for field in schema],
+            "files": files,
+        }
+        with open(os.path.join(temporary_directory, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temporary_directory, directory)
+    except Exception:
+        if part is not None:
+            part.close()
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        raise
+
+    latest_path = os.path.join(snapshot_dir, LATEST_FILE)
+    with open(f"{latest_path}.tmp", "w") as f:
+        f.write(run_id)
+    os.replace(f"{latest_path}.tmp", latest_path)
+    prune_snapshots(snapshot_dir)
+    return manifest
+
+
+def prune_snapshots(snapshot_dir: str, keep: int = SNAPSHOT_KEEP):
+    snapshots = [
+        entry for entry in os.scandir(snapshot_dir)
+        if entry.is_dir() and os.path.exists(os.path.join(entry.path, MANIFEST_FILE))
+    ]
+    snapshots.sort(key=lambda entry: os.path.getmtime(os.path.join(entry.path, MANIFEST_FILE)), reverse=True)
+    for entry in snapshots[keep:]:
+        shutil.rmtree(entry.path, ignore_errors=True)